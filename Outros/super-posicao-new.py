@@ -58,9 +58,81 @@ def consolidate_series_positions(position_series):
         "total_positions_used": len(position_series)
     }
 
+# --- CONSOLIDAÇÃO COM DECAIMENTO EXPONENCIAL (MEIA-VIDA) ---
+
+def consolidate_series_positions_decayed(position_series, half_life_s):
+    """
+    Igual à consolidação acima, mas cada posição também pesa
+    2^(-idade / meia-vida), com a idade contada a partir da posição mais
+    recente (campo 'timestamp', em segundos). Uma passada só, com as somas
+    reescaladas quando chega uma posição mais nova; posições sem
+    'timestamp' contam como recentes.
+    """
+    latitude_weighted = 0.0
+    longitude_weighted = 0.0
+    error_weighted = 0.0
+    total_weight = 0.0
+    t_ref = None
+
+    print(f"\n--- DETALHES DA PONDERAÇÃO (meia-vida de {half_life_s / 3600:g} h) ---")
+
+    for i, pos in enumerate(position_series):
+        lat = pos.get('lat')
+        lon = pos.get('lon')
+        error_radius = pos.get('error')
+
+        if error_radius is None or error_radius <= 0 or lat is None or lon is None:
+            print(f"Aviso: Posição #{i+1} ignorada devido a erro <= 0 ou dados ausentes.")
+            continue
+
+        t = pos.get('timestamp')
+        age_factor = 1.0
+        if t is not None:
+            if t_ref is None:
+                t_ref = t
+            elif t > t_ref:
+                # Posição mais nova: tudo o que já foi somado envelhece
+                factor = 0.5 ** ((t - t_ref) / half_life_s)
+                latitude_weighted *= factor
+                longitude_weighted *= factor
+                error_weighted *= factor
+                total_weight *= factor
+                t_ref = t
+            else:
+                age_factor = 0.5 ** ((t_ref - t) / half_life_s)
+
+        weight = age_factor / (error_radius ** 2)
+
+        print(f"Posição #{i+1} (Erro: {error_radius}m, fator de idade {age_factor:.4f}): Peso = {weight:.8f}")
+
+        latitude_weighted += (lat * weight)
+        longitude_weighted += (lon * weight)
+        error_weighted += (error_radius * weight)
+        total_weight += weight
+
+    if total_weight == 0:
+        return None
+
+    return {
+        "final_latitude": latitude_weighted / total_weight,
+        "final_longitude": longitude_weighted / total_weight,
+        "final_error_radius_m": error_weighted / total_weight,
+        "total_positions_used": len(position_series)
+    }
+
 # --- FUNÇÃO PRINCIPAL DE INTERAÇÃO (LEITURA DO ARQUIVO/PIPE) ---
 
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Consolidação temporal de posições (super-posição)")
+    parser.add_argument("--meia-vida", type=float, metavar="HORAS",
+                        help="Esquece posições antigas: peso cai pela metade a cada HORAS")
+    args = parser.parse_args()
+    # Mesma regra do DecayedSuperPosition: zero ou negativa inverteria os pesos
+    if args.meia_vida is not None and not 0 < args.meia_vida < float("inf"):
+        parser.error("--meia-vida deve ser um número de horas positivo")
+
     print("=========================================================")
     print("  ✨ Consolidação Temporal de Posições (Super-Posição) ✨")
     print("=========================================================")
@@ -99,7 +171,10 @@ def main():
     
     # Processa e exibe o resultado
     if input_results:
-        result = consolidate_series_positions(input_results)
+        if args.meia_vida is not None:
+            result = consolidate_series_positions_decayed(input_results, args.meia_vida * 3600)
+        else:
+            result = consolidate_series_positions(input_results)
         
         print("\n=========================================================")
         print("  ✅ RESULTADO DA SUPER-POSIÇÃO CONSOLIDADA")
@@ -0,0 +1,6 @@
+"""
+Núcleo compartilhado das ferramentas de análise LoRa P2P.
+
+Os módulos deste pacote não dependem do Streamlit, para poderem ser usados
+tanto pelas páginas (`pages/`) quanto por scripts de linha de comando.
+"""
@@ -0,0 +1,345 @@
+import json
+import math
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from lora.reader import iter_packets
+from lora.triangulation import parse_gateway_report
+
+# ==========================================
+# ARQUIVO COLUNAR DE RELATÓRIOS DE GATEWAY (.lpa)
+# ==========================================
+# Guarda só os campos usados pela triangulação, em colunas de largura fixa
+# (lat/lon como int32 cru do hardware, RSSI float32, fix int8), em blocos
+# (chunks) de CHUNK_ROWS linhas. O rodapé JSON traz, por bloco, o intervalo
+# de tempo e os seriais presentes, então uma consulta por período/serial
+# só toca os blocos necessários.
+#
+# Layout do arquivo:
+#   MAGIC | colunas do bloco 0 | colunas do bloco 1 | ... | rodapé JSON | <Q tamanho do rodapé> | MAGIC
+#
+# Sem compressão (padrão), as colunas são lidas direto do mmap, sem cópia
+# nem parse. Com compression="zlib" cada coluna é comprimida à parte
+# (arquivo menor, mas a leitura passa a descomprimir o bloco).
+#
+# RSSI em float32: frações de dBm são preservadas (a reconstrução
+# arredonda para RSSI_DECIMALS casas, bem acima do que os rádios reportam);
+# RSSI inteiro volta inteiro. Arquivos da versão 1 (RSSI int16) continuam
+# legíveis: o tipo de cada coluna vem do rodapé.
+#
+# Cada relatório é validado em `append` contra o tipo das colunas (int32,
+# int8, RSSI finito): um valor fora da faixa descarta só aquela linha,
+# contada em `skipped`, e não o bloco inteiro.
+
+MAGIC = b"LPA1"
+CHUNK_ROWS = 65536
+ALIGNMENT = 8
+
+COLUMNS = [
+    ("timestamp", "<f8"),
+    ("serial_id", "<i4"),
+    ("sequence", "<i4"),
+    ("lat", "<i4"),
+    ("lon", "<i4"),
+    ("rssi", "<f4"),
+    ("fix_state", "<i1"),
+]
+
+# Sentinelas para campos ausentes no pacote original
+MISSING_SEQUENCE = -1
+MISSING_RSSI = -32768
+RSSI_DECIMALS = 3
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+INT8_MIN, INT8_MAX = -128, 127
+
+
+def report_to_packet(serial, sequence, timestamp, lat, lon, rssi, fix_state):
+    """Reconstrói o pacote no formato original (data.gatewayPosition/loraRadio)."""
+    payload = {
+        "gatewayPosition": [{"latitude": lat, "longitude": lon}],
+        "gatewayGps": {"fixState": fix_state},
+        "loraRadio": {} if rssi == MISSING_RSSI else {"RSSI": _rssi_value(rssi)},
+    }
+    if sequence != MISSING_SEQUENCE:
+        payload["sequenceNumber"] = sequence
+    if not math.isnan(timestamp):
+        payload["deviceDateTime"] = timestamp
+    return {"serial": serial, "data": payload}
+
+
+def _rssi_value(rssi):
+    # float32 -> valor original: inteiro como int, fração arredondada
+    return int(rssi) if float(rssi).is_integer() else round(rssi, RSSI_DECIMALS)
+
+
+def _row(report):
+    """Linha das colunas (mesma ordem de COLUMNS sem o serial) ou None se algum valor não cabe no tipo."""
+    sequence = MISSING_SEQUENCE if report['sequence'] is None else report['sequence']
+    rssi = MISSING_RSSI if report['rssi'] is None else float(report['rssi'])
+    lat, lon, fix_state = report['lat_raw'], report['lon_raw'], report['fix_state']
+    if not (INT32_MIN <= sequence <= INT32_MAX and INT32_MIN <= lat <= INT32_MAX
+            and INT32_MIN <= lon <= INT32_MAX and INT8_MIN <= fix_state <= INT8_MAX):
+        return None
+    if report['rssi'] is not None and not (math.isfinite(rssi) and MISSING_RSSI < rssi < -MISSING_RSSI):
+        return None
+    timestamp = math.nan if report['timestamp'] is None else report['timestamp']
+    return timestamp, sequence, lat, lon, rssi, fix_state
+
+
+class ArchiveWriter:
+    """Escreve relatórios em blocos colunares. Use como context manager."""
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS, compression=None):
+        if compression not in (None, "zlib"):
+            raise ValueError(f"Compressão não suportada: {compression}")
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self._pad()
+        self.serials = []
+        self._serial_ids = {}
+        self.chunks = []
+        self.rows = 0
+        self.skipped = 0
+        self._buffer = {name: [] for name, _ in COLUMNS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _pad(self):
+        pos = self.f.tell()
+        if pos % ALIGNMENT:
+            self.f.write(b"\0" * (ALIGNMENT - pos % ALIGNMENT))
+
+    def _serial_id(self, serial):
+        serial = serial or "Desconhecido"
+        sid = self._serial_ids.get(serial)
+        if sid is None:
+            sid = self._serial_ids[serial] = len(self.serials)
+            self.serials.append(serial)
+        return sid
+
+    def append(self, report):
+        """
+        Acrescenta um relatório já extraído por `parse_gateway_report`.
+        Retorna False (e conta em `skipped`) se algum valor não cabe nas colunas.
+        """
+        try:
+            row = _row(report)
+        except (TypeError, ValueError):
+            row = None
+        if row is None:
+            self.skipped += 1
+            return False
+        timestamp, sequence, lat, lon, rssi, fix_state = row
+        b = self._buffer
+        b["timestamp"].append(timestamp)
+        b["serial_id"].append(self._serial_id(report['serial']))
+        b["sequence"].append(sequence)
+        b["lat"].append(lat)
+        b["lon"].append(lon)
+        b["rssi"].append(rssi)
+        b["fix_state"].append(fix_state)
+        if len(b["timestamp"]) >= self.chunk_rows:
+            self._flush_chunk()
+        return True
+
+    def append_packet(self, packet):
+        """Extrai e acrescenta um pacote cru. Retorna False se foi descartado."""
+        try:
+            report = parse_gateway_report(packet)
+        except (KeyError, IndexError, ValueError, TypeError):
+            return False
+        if report is None:
+            return False
+        return self.append(report)
+
+    def _flush_chunk(self):
+        n = len(self._buffer["timestamp"])
+        if n == 0:
+            return
+        arrays = {name: np.asarray(self._buffer[name], dtype=dtype) for name, dtype in COLUMNS}
+        ts = arrays["timestamp"]
+        valid_ts = ts[~np.isnan(ts)]
+        meta = {
+            "rows": n,
+            "t_min": float(valid_ts.min()) if valid_ts.size else None,
+            "t_max": float(valid_ts.max()) if valid_ts.size else None,
+            "serial_ids": np.unique(arrays["serial_id"]).tolist(),
+            "columns": {},
+        }
+        for name, _ in COLUMNS:
+            data = arrays[name].tobytes()
+            if self.compression == "zlib":
+                data = zlib.compress(data, 6)
+            self._pad()
+            meta["columns"][name] = [self.f.tell(), len(data)]
+            self.f.write(data)
+        self.chunks.append(meta)
+        self.rows += n
+        self._buffer = {name: [] for name, _ in COLUMNS}
+
+    def close(self):
+        if self.f.closed:
+            return
+        self._flush_chunk()
+        self._pad()
+        footer = json.dumps({
+            "version": 2,
+            "columns": COLUMNS,
+            "compression": self.compression,
+            "rows": self.rows,
+            "serials": self.serials,
+            "chunks": self.chunks,
+        }).encode("utf-8")
+        self.f.write(footer)
+        self.f.write(struct.pack("<Q", len(footer)))
+        self.f.write(MAGIC)
+        self.f.close()
+
+
+class ArchiveReader:
+    """
+    Lê um arquivo .lpa via mmap. Em arquivos sem compressão, as colunas
+    devolvidas são views somente-leitura sobre o mmap (zero cópia).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:4] != MAGIC or self.mm[-4:] != MAGIC:
+            raise ValueError(f"Arquivo não é um arquivo .lpa válido: {path}")
+        (footer_len,) = struct.unpack("<Q", self.mm[-12:-4])
+        footer = json.loads(self.mm[-12 - footer_len:-12].decode("utf-8"))
+        self.compression = footer["compression"]
+        self.rows = footer["rows"]
+        self.serials = footer["serials"]
+        self.chunks = footer["chunks"]
+        self.dtypes = dict((name, np.dtype(dtype)) for name, dtype in footer["columns"])
+        self._serial_ids = {s: i for i, s in enumerate(self.serials)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def select_chunks(self, since=None, until=None, serial=None):
+        """Índices dos blocos que podem conter linhas do período/serial."""
+        sid = None
+        if serial is not None:
+            sid = self._serial_ids.get(serial)
+            if sid is None:
+                return []
+        selected = []
+        for i, c in enumerate(self.chunks):
+            if since is not None and c["t_max"] is not None and c["t_max"] < since:
+                continue
+            if until is not None and c["t_min"] is not None and c["t_min"] > until:
+                continue
+            if sid is not None and sid not in c["serial_ids"]:
+                continue
+            selected.append(i)
+        return selected
+
+    def read_chunk(self, i):
+        """Colunas do bloco `i` como dict nome -> ndarray."""
+        c = self.chunks[i]
+        columns = {}
+        for name, (offset, nbytes) in c["columns"].items():
+            dtype = self.dtypes[name]
+            if self.compression == "zlib":
+                columns[name] = np.frombuffer(zlib.decompress(self.mm[offset:offset + nbytes]), dtype=dtype)
+            else:
+                columns[name] = np.frombuffer(self.mm, dtype=dtype, count=c["rows"], offset=offset)
+        return columns
+
+    def iter_columns(self, since=None, until=None, serial=None):
+        """Percorre os blocos selecionados, já filtrados linha a linha."""
+        sid = self._serial_ids.get(serial) if serial is not None else None
+        for i in self.select_chunks(since, until, serial):
+            cols = self.read_chunk(i)
+            mask = None
+            if since is not None:
+                mask = cols["timestamp"] >= since
+            if until is not None:
+                m = cols["timestamp"] <= until
+                mask = m if mask is None else mask & m
+            if sid is not None:
+                m = cols["serial_id"] == sid
+                mask = m if mask is None else mask & m
+            if mask is not None:
+                cols = {name: col[mask] for name, col in cols.items()}
+            yield cols
+
+    def iter_packets(self, since=None, until=None, serial=None):
+        """Pacotes reconstruídos no formato original, na ordem do arquivo."""
+        serials = self.serials
+        for cols in self.iter_columns(since, until, serial):
+            rows = zip(
+                cols["serial_id"].tolist(), cols["sequence"].tolist(), cols["timestamp"].tolist(),
+                cols["lat"].tolist(), cols["lon"].tolist(), cols["rssi"].tolist(), cols["fix_state"].tolist(),
+            )
+            for sid, seq, ts, lat, lon, rssi, fix in rows:
+                yield report_to_packet(serials[sid], seq, ts, lat, lon, rssi, fix)
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError:
+            # Ainda há arrays apontando para o mmap; ele é liberado junto com eles
+            pass
+        self.f.close()
+
+
+# ==========================================
+# LINHA DE COMANDO (python -m lora.archive)
+# ==========================================
+
+def main():
+    import argparse
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description="Arquivo colunar de relatórios de gateway (.lpa)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_pack = sub.add_parser("pack", help="Converte JSON/NDJSON (ou .gz) para .lpa")
+    p_pack.add_argument("entrada")
+    p_pack.add_argument("saida")
+    p_pack.add_argument("--zlib", action="store_true", help="Comprime cada coluna com zlib")
+    p_info = sub.add_parser("info", help="Mostra o índice de um .lpa")
+    p_info.add_argument("arquivo")
+    args = parser.parse_args()
+
+    if args.cmd == "pack":
+        start = time.perf_counter()
+        total = kept = 0
+        # Leitura em streaming: JSON, NDJSON ou .gz de qualquer tamanho
+        with open(args.entrada, "rb") as f, \
+                ArchiveWriter(args.saida, compression="zlib" if args.zlib else None) as writer:
+            for packet in iter_packets(f):
+                total += 1
+                kept += writer.append_packet(packet)
+        elapsed = time.perf_counter() - start
+        print(f"{kept}/{total} pacotes gravados em {elapsed:.2f} s ({writer.skipped} com valores fora da faixa)")
+        print(f"JSON: {os.path.getsize(args.entrada) / 1024:.1f} KB -> LPA: {os.path.getsize(args.saida) / 1024:.1f} KB")
+    else:
+        with ArchiveReader(args.arquivo) as reader:
+            print(f"Linhas: {reader.rows} | Blocos: {len(reader.chunks)} | Seriais: {len(reader.serials)} "
+                  f"| Compressão: {reader.compression or 'nenhuma'}")
+            for i, c in enumerate(reader.chunks):
+                print(f"  bloco {i}: {c['rows']} linhas, t=[{c['t_min']}, {c['t_max']}], {len(c['serial_ids'])} seriais")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import numpy as np
+
+from lora.archive import MISSING_RSSI, MISSING_SEQUENCE
+from lora.cluster import CLUSTER_DENSITY, CLUSTER_LEADER, dominant_cluster_batch
+from lora.triangulation import GATEWAY_COORDINATE_DIVISOR, MAX_DISTANCE_KM, parse_gateway_report
+
+# ==========================================
+# TRIANGULAÇÃO EM LOTE (NUMPY)
+# ==========================================
+# Muitos grupos (serial, sequência) de uma vez, em matrizes (G, M): uma
+# linha por grupo, uma coluna por gateway, com máscara para as posições
+# vazias (grupos com menos de M gateways) e para os gateways inválidos
+# (fix < 2 ou sem RSSI). O centróide em lote reproduz `process_triangulation`
+# (líder, corte de MAX_DISTANCE_KM ou cluster por densidade, peso
+# 10^(RSSI/10), raio de erro, GDOP) e serve de base para os outros motores
+# vetorizados (multilateração).
+#
+# A matriz de distâncias entre gateways é (G, M, M), então os grupos são
+# processados em fatias de BATCH_GROUPS para limitar a memória.
+
+EARTH_RADIUS_KM = 6371.0
+BATCH_GROUPS = 4096
+MIN_ERROR_M = 3.0
+
+
+class GroupBatch:
+    """
+    Grupos empacotados: lat/lon em graus, rssi em dBm (float, NaN se
+    ausente), valid = gateway utilizável. `serials`, `sequences` e
+    `timestamps` têm uma entrada por grupo.
+    """
+
+    def __init__(self, lat, lon, rssi, valid, serials, sequences, timestamps):
+        self.lat = lat
+        self.lon = lon
+        self.rssi = rssi
+        self.valid = valid
+        self.serials = serials
+        self.sequences = sequences
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.lat)
+
+    def slice(self, start, stop):
+        return GroupBatch(self.lat[start:stop], self.lon[start:stop], self.rssi[start:stop],
+                          self.valid[start:stop], self.serials[start:stop],
+                          self.sequences[start:stop], self.timestamps[start:stop])
+
+
+def pack_groups(groups):
+    """
+    Empacota grupos no formato do PacketGrouper: (serial, sequência, pacotes).
+    Pacotes corrompidos ou sem posição ficam de fora, como na triangulação.
+    """
+    rows = []
+    for serial, sequence, packets in groups:
+        gateways = []
+        timestamp = None
+        for packet in packets:
+            try:
+                report = parse_gateway_report(packet)
+            except (KeyError, IndexError, ValueError, TypeError):
+                continue
+            if report is None:
+                continue
+            if timestamp is None:
+                timestamp = report['timestamp']
+            gateways.append(report)
+        rows.append((serial, sequence, timestamp, gateways))
+
+    width = max((len(r[3]) for r in rows), default=0) or 1
+    shape = (len(rows), width)
+    lat = np.zeros(shape)
+    lon = np.zeros(shape)
+    rssi = np.full(shape, np.nan)
+    valid = np.zeros(shape, dtype=bool)
+    for i, (_, _, _, gateways) in enumerate(rows):
+        for j, g in enumerate(gateways):
+            lat[i, j] = g['lat_raw'] / GATEWAY_COORDINATE_DIVISOR
+            lon[i, j] = g['lon_raw'] / GATEWAY_COORDINATE_DIVISOR
+            if g['rssi'] is not None:
+                rssi[i, j] = g['rssi']
+            valid[i, j] = g['fix_state'] >= 2 and g['rssi'] is not None
+
+    timestamps = np.array([np.nan if r[2] is None else r[2] for r in rows], dtype=float)
+    return GroupBatch(lat, lon, rssi, valid, [r[0] for r in rows],
+                      np.array([-1 if r[1] is None else r[1] for r in rows]), timestamps)
+
+
+def pack_columns(cols, serials):
+    """
+    Empacota colunas de um bloco do arquivo .lpa (`ArchiveReader.iter_columns`)
+    sem passar por dicts: as linhas são ordenadas por (serial, sequência) e
+    cada grupo vira uma linha da matriz. Linhas sem número de sequência não
+    têm como ser agrupadas e ficam de fora. Um grupo dividido entre dois
+    blocos vira dois grupos.
+    """
+    keep = cols["sequence"] != MISSING_SEQUENCE
+    sid = cols["serial_id"][keep]
+    seq = cols["sequence"][keep]
+    order = np.lexsort((seq, sid))
+    sid = sid[order]
+    seq = seq[order]
+
+    starts = np.flatnonzero(np.r_[True, (sid[1:] != sid[:-1]) | (seq[1:] != seq[:-1])]) if len(sid) else \
+        np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.r_[starts, len(sid)])
+    group_of_row = np.repeat(np.arange(len(starts)), counts)
+    column = np.arange(len(sid)) - starts[group_of_row]
+
+    shape = (len(starts), int(counts.max()) if len(counts) else 1)
+    lat = np.zeros(shape)
+    lon = np.zeros(shape)
+    rssi = np.full(shape, np.nan)
+    valid = np.zeros(shape, dtype=bool)
+
+    raw_rssi = cols["rssi"][keep][order]
+    has_rssi = raw_rssi != MISSING_RSSI
+    lat[group_of_row, column] = cols["lat"][keep][order] / GATEWAY_COORDINATE_DIVISOR
+    lon[group_of_row, column] = cols["lon"][keep][order] / GATEWAY_COORDINATE_DIVISOR
+    rssi[group_of_row, column] = np.where(has_rssi, raw_rssi, np.nan)
+    valid[group_of_row, column] = has_rssi & (cols["fix_state"][keep][order] >= 2)
+
+    return GroupBatch(lat, lon, rssi, valid, [serials[i] for i in sid[starts].tolist()],
+                      seq[starts], cols["timestamp"][keep][order][starts])
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Haversine vetorizado (graus -> km), com broadcast entre os argumentos."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def gdop_batch(gw_lat, gw_lon, used, lat, lon):
+    """`geometry_dop` de todos os grupos: gateways (G, M) vistos de (lat, lon) (G,)."""
+    dx = (gw_lon - lon[:, None]) * np.cos(np.radians(lat))[:, None]
+    dy = gw_lat - lat[:, None]
+    rho2 = dx * dx + dy * dy
+    # Gateway fora do grupo (ou na própria posição) não entra: 1/inf = 0
+    rho2[~used | (rho2 < 1e-18)] = np.inf
+    inv = 1.0 / rho2
+    dx_inv = dx * inv
+    a00 = (dx * dx_inv).sum(axis=1)
+    a01 = (dy * dx_inv).sum(axis=1)
+    a11 = (dy * dy * inv).sum(axis=1)
+    det = a00 * a11 - a01 * a01
+    singular = det < 1e-9
+    gdop = np.sqrt((a00 + a11) / np.where(singular, 1.0, det))
+    gdop[singular] = np.inf
+    return gdop
+
+
+def _centroid_slice(b, cluster_mode):
+    lat, lon, valid = b.lat, b.lon, b.valid
+    n_valid = valid.sum(axis=1)
+
+    pair = haversine_km(lat[:, :, None], lon[:, :, None], lat[:, None, :], lon[:, None, :])
+    if cluster_mode == CLUSTER_DENSITY:
+        power = np.where(valid, 10.0 ** (np.where(valid, b.rssi, 0.0) / 10.0), 0.0)
+        used = dominant_cluster_batch(pair, valid, power)
+    else:
+        # Líder: menor soma de distâncias aos demais gateways válidos
+        dist_sum = np.where(valid[:, None, :], pair, 0.0).sum(axis=2)
+        dist_sum[~valid] = np.inf
+        leader = np.argmin(dist_sum, axis=1)
+        used = valid & (pair[np.arange(len(b)), leader] < MAX_DISTANCE_KM)
+    weight = np.where(used, 10.0 ** (np.where(used, b.rssi, 0.0) / 10.0), 0.0)
+    total_w = weight.sum(axis=1)
+    ok = (n_valid > 0) & used.any(axis=1) & (total_w > 0)
+    safe_w = np.where(ok, total_w, 1.0)
+
+    max_rssi = np.where(used, b.rssi, -np.inf).max(axis=1)
+    error = np.maximum(np.abs(max_rssi) * 0.85, MIN_ERROR_M)
+    final_lat = (lat * weight).sum(axis=1) / safe_w
+    final_lon = (lon * weight).sum(axis=1) / safe_w
+    return {
+        "lat": final_lat,
+        "lon": final_lon,
+        "error": np.where(ok, error, np.nan),
+        "max_rssi": np.where(ok, max_rssi, np.nan),
+        "gdop": np.where(ok, gdop_batch(lat, lon, used, final_lat, final_lon), np.nan),
+        "used": used,
+        "ok": ok,
+    }
+
+
+def centroid_batch(batch, batch_groups=BATCH_GROUPS, cluster_mode=CLUSTER_LEADER):
+    """
+    Centróide ponderado por RSSI de todos os grupos. Retorna dict de arrays
+    alinhados com os grupos: lat, lon, error, max_rssi, gdop, ok (grupo
+    aceito) e used (G, M: gateways que sobraram depois do corte por distância).
+    """
+    parts = [_centroid_slice(batch.slice(i, i + batch_groups), cluster_mode)
+             for i in range(0, len(batch), batch_groups)]
+    if not parts:
+        return {"lat": np.zeros(0), "lon": np.zeros(0), "error": np.zeros(0), "max_rssi": np.zeros(0),
+                "gdop": np.zeros(0),
+                "used": np.zeros((0, batch.lat.shape[1]), dtype=bool), "ok": np.zeros(0, dtype=bool)}
+    return {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
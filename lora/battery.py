@@ -0,0 +1,150 @@
+import math
+import time
+from datetime import datetime, timedelta
+
+# ==========================================
+# DIAGNÓSTICO DE BATERIA (A40B v3)
+# ==========================================
+
+# --- Constantes do Hardware (Modelo A40 Primário) ---
+BATTERY_CAPACITY_NOMINAL = 1850  # mAh
+EFFICIENCY_FACTOR = 0.85         # 85% (Margem para picos e autodescarga)
+BATTERY_CAPACITY_REAL = BATTERY_CAPACITY_NOMINAL * EFFICIENCY_FACTOR # 1572.5 mAh
+
+# Maior duração que o datetime/timedelta representa (uptime/sono acima disso é lixo)
+MAX_DURATION_S = timedelta.max.total_seconds()
+
+# --- Funções Auxiliares ---
+
+def format_duration(seconds: int) -> str:
+    """Formata segundos em H:M:S legível."""
+    if seconds < 0: seconds = 0
+    return str(timedelta(seconds=int(seconds))).split('.')[0]
+
+def is_battery_packet(packet: dict) -> bool:
+    """Pacote de diagnóstico do rastreador (tem 'accessories'), não relatório de gateway."""
+    return isinstance(packet, dict) and 'accessories' in packet.get('data', {})
+
+def _finite(raw, field, limit=None):
+    """float(raw), com ValueError se não é finito ou passa de `limit` em módulo."""
+    value = float(raw)
+    if not math.isfinite(value) or (limit is not None and abs(value) > limit):
+        raise ValueError(f"{field} fora da faixa: {raw!r}")
+    return value
+
+def analyze_battery_packet(packet: dict):
+    """
+    Extrai e calcula os dados cruciais do JSON com tratamento de tipos.
+    Lança KeyError/IndexError/TypeError/ValueError se a estrutura não bate
+    ou se algum valor não cabe no calendário (ex.: deviceDateTime=1e20).
+    """
+    data = packet.get('data', {})
+    diag = data['accessories'][0]['diagnostic']
+
+    # --- ÁREA DE CORREÇÃO (Blindagem contra Strings) ---
+    raw_ts = data.get('deviceDateTime', time.time())
+    device_ts = _finite(raw_ts, 'deviceDateTime')
+    try:
+        device_dt = datetime.fromtimestamp(device_ts)
+    except (OverflowError, OSError, ValueError) as e:
+        raise ValueError(f"deviceDateTime fora da faixa: {raw_ts!r}") from e
+    serial = packet.get('serial', 'Desconhecido')
+
+    interval_total_use_mas = _finite(diag['battery']['intervalTotalUse'], 'intervalTotalUse')
+    uptime_seconds = _finite(data['flags']['deviceInfo']['uptime'], 'uptime', MAX_DURATION_S)
+    sleep_ms = _finite(diag['core']['intervalSleep'], 'intervalSleep', MAX_DURATION_S * 1000.0)
+    # --- FIM DA ÁREA DE CORREÇÃO ---
+
+    # Cálculos
+    sleep_seconds = sleep_ms / 1000.0
+    active_seconds = uptime_seconds - sleep_seconds
+
+    # 2. Cálculos da Bateria (Matemática do Coulomb Counting)
+    used_mah = interval_total_use_mas / 3600.0
+    remaining_mah = BATTERY_CAPACITY_REAL - used_mah
+
+    remaining_mah = max(0.0, remaining_mah)
+
+    pct_used = (used_mah / BATTERY_CAPACITY_REAL) * 100.0
+    pct_remaining = (remaining_mah / BATTERY_CAPACITY_REAL) * 100.0
+
+    # 3. Cálculo de Predição
+    uptime_hours = uptime_seconds / 3600.0
+    prediction_data = None
+
+    if uptime_hours > 0.1 and used_mah > 0:
+        hourly_rate_mah = used_mah / uptime_hours
+        hours_left = remaining_mah / hourly_rate_mah
+        try:
+            end_date = (device_dt + timedelta(hours=hours_left)).strftime("%d/%m/%Y às %H:%M")
+        except OverflowError:
+            # Consumo ínfimo: a previsão passa do ano 9999
+            end_date = "depois de 31/12/9999"
+
+        prediction_data = {
+            'hourly_rate': hourly_rate_mah,
+            'hours_left': hours_left,
+            'end_date': end_date,
+            'days_left': hours_left / 24.0
+        }
+
+    return {
+        'serial': serial,
+        'device_ts': device_dt.strftime("%d/%m/%Y %H:%M:%S"),
+        'uptime_str': format_duration(uptime_seconds),
+        'sleep_str': format_duration(sleep_seconds),
+        'active_str': format_duration(active_seconds),
+        'sleep_pct': (sleep_seconds / uptime_seconds) * 100 if uptime_seconds > 0 else 0,
+        'used_mah': used_mah,
+        'remaining_mah': remaining_mah,
+        'pct_used': pct_used,
+        'pct_remaining': pct_remaining,
+        'prediction': prediction_data,
+        'timestamp': device_ts,
+        'uptime_s': uptime_seconds
+    }
+
+
+# ==========================================
+# TENDÊNCIA DE CONSUMO POR DISPOSITIVO
+# ==========================================
+
+class BatteryTrend:
+    """
+    Regressão linear incremental (mínimos quadrados) do consumo acumulado
+    (mAh) contra o tempo do dispositivo (h). Estado O(1): só as somas.
+    """
+
+    __slots__ = ("n", "sx", "sy", "sxx", "sxy", "t0", "last")
+
+    def __init__(self):
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.t0 = None
+        self.last = None
+
+    def add(self, result):
+        """Acrescenta o resultado de `analyze_battery_packet`."""
+        if self.t0 is None:
+            self.t0 = result['timestamp']
+        x = (result['timestamp'] - self.t0) / 3600.0
+        y = result['used_mah']
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+        self.last = result
+
+    def hourly_rate(self):
+        """Consumo em mAh/h pela inclinação da reta (None com menos de 2 pontos distintos)."""
+        denom = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denom <= 0:
+            return None
+        return (self.n * self.sxy - self.sx * self.sy) / denom
+
+    def hours_left(self):
+        rate = self.hourly_rate()
+        if not rate or rate <= 0 or self.last is None:
+            return None
+        return self.last['remaining_mah'] / rate
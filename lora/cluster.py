@@ -0,0 +1,362 @@
+import math
+
+import numpy as np
+
+# ==========================================
+# FILTRO DE GATEWAYS POR DENSIDADE (DBSCAN ADAPTATIVO)
+# ==========================================
+# Alternativa ao corte fixo de MAX_DISTANCE_KM em volta do líder: os
+# gateways de um grupo são agrupados no estilo DBSCAN e fica o cluster
+# dominante (maior soma de potência em mW, como os pesos do centróide).
+#
+# O raio de vizinhança (eps) se adapta ao lugar: EPS_FACTOR × a mediana da
+# distância de cada gateway ao vizinho mais próximo, limitado a
+# [EPS_MIN_KM, EPS_MAX_KM]. Em área rural, com gateways a quilômetros uns
+# dos outros, eps cresce e nenhum é descartado; numa área densa eps fica
+# pequeno e uma reflexão distante vira ruído.
+#
+# Versão escalar: o vizinho mais próximo sai de uma árvore k-d na projeção
+# local, O(n log n) (força bruta nos grupos pequenos, que são a regra); as
+# vizinhanças de eps usam um índice de grade (células de eps, 3x3 células em
+# volta), O(n + pares vizinhos). Com o eps adaptativo cada gateway tem
+# poucos vizinhos e o total fica ~O(n log n) por grupo; o pior caso (todos a
+# menos de eps uns dos outros) tem n² pares vizinhos. Medido com
+# `python -m lora.cluster --scaling`. A versão
+# em lote usa a matriz de distâncias (G, M, M) que o centróide em lote já
+# calcula e rotula os componentes por propagação do menor índice. As duas
+# dão o mesmo resultado: rótulo de cluster = menor índice de gateway
+# núcleo do componente, borda vai para o cluster de menor rótulo entre os
+# núcleos vizinhos, empate de potência fica com o cluster maior e depois
+# com o de menor rótulo. Sem nenhum cluster (todos ruído), fica o gateway
+# mais forte sozinho.
+
+CLUSTER_LEADER = "leader"
+CLUSTER_DENSITY = "density"
+CLUSTER_MODES = (CLUSTER_LEADER, CLUSTER_DENSITY)
+
+EPS_FACTOR = 3.0
+EPS_MIN_KM = 0.2
+EPS_MAX_KM = 5.0
+# Vizinhos (contando o próprio gateway) para ser núcleo de um cluster
+MIN_PTS = 2
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG = EARTH_RADIUS_KM * math.pi / 180.0
+# Folga da célula da grade sobre eps (projeção local vs. haversine)
+_CELL_MARGIN = 1.01
+# Vizinho mais próximo: força bruta até este tamanho de grupo, árvore k-d acima
+_BRUTE_FORCE_MAX = 32
+_KD_LEAF_SIZE = 8
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def _median(values):
+    s = sorted(values)
+    return (s[(len(s) - 1) // 2] + s[len(s) // 2]) / 2
+
+
+def adaptive_eps(nn_km):
+    """eps (km) a partir das distâncias ao vizinho mais próximo (infinito = sem vizinho até EPS_MAX_KM)."""
+    finite = [d for d in nn_km if d <= EPS_MAX_KM]
+    if not finite:
+        return EPS_MAX_KM
+    return min(EPS_MAX_KM, max(EPS_MIN_KM, EPS_FACTOR * _median(finite)))
+
+
+class _GridIndex:
+    """Pontos em células quadradas de `cell_km` numa projeção local (equiretangular)."""
+
+    def __init__(self, lats, lons, cell_km):
+        self.lats, self.lons = lats, lons
+        self.cell = cell_km * _CELL_MARGIN
+        self.k_lon = KM_PER_DEG * math.cos(math.radians(lats[0]))
+        self.cells = {}
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            self.cells.setdefault(self._key(lat, lon), []).append(i)
+
+    def _key(self, lat, lon):
+        return (math.floor(lat * KM_PER_DEG / self.cell), math.floor(lon * self.k_lon / self.cell))
+
+    def candidates(self, i):
+        cy, cx = self._key(self.lats[i], self.lons[i])
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                yield from self.cells.get((cy + dy, cx + dx), ())
+
+    def neighbors(self, i, radius_km):
+        """Índices a até `radius_km` de i (inclui i), em ordem crescente."""
+        lat, lon = self.lats[i], self.lons[i]
+        return sorted(j for j in self.candidates(i)
+                      if j == i or _haversine_km(lat, lon, self.lats[j], self.lons[j]) <= radius_km)
+
+
+def _kd_build(idx, xs, ys, axis=0):
+    """Árvore k-d sobre as coordenadas projetadas: folha = (None, índices), nó = (eixo, corte, esq., dir.)."""
+    if len(idx) <= _KD_LEAF_SIZE:
+        return (None, idx)
+    coord = xs if axis == 0 else ys
+    idx = sorted(idx, key=coord.__getitem__)
+    mid = len(idx) // 2
+    return (axis, coord[idx[mid]], _kd_build(idx[:mid], xs, ys, 1 - axis), _kd_build(idx[mid:], xs, ys, 1 - axis))
+
+
+def nearest_neighbor_km(lats, lons):
+    """
+    Distância (km) de cada ponto ao vizinho mais próximo, ou infinito se não
+    há nenhum até EPS_MAX_KM. Grupos pequenos: força bruta. Grupos grandes:
+    árvore k-d na projeção local (a diferença num eixo é o limite inferior
+    da distância, com a folga de _CELL_MARGIN), O(n log n).
+    """
+    n = len(lats)
+    if n <= _BRUTE_FORCE_MAX:
+        nn = []
+        for i in range(n):
+            d = min(_haversine_km(lats[i], lons[i], lats[j], lons[j]) for j in range(n) if j != i)
+            nn.append(d if d <= EPS_MAX_KM else math.inf)
+        return nn
+
+    k_lon = KM_PER_DEG * math.cos(math.radians(lats[0]))
+    xs = [lon * k_lon for lon in lons]
+    ys = [lat * KM_PER_DEG for lat in lats]
+    root = _kd_build(list(range(n)), xs, ys)
+    nn = [math.inf] * n
+    for i in range(n):
+        lat, lon, point = lats[i], lons[i], (xs[i], ys[i])
+        best = EPS_MAX_KM
+        stack = [(root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound > best * _CELL_MARGIN:
+                continue
+            axis, split = node[0], node[1]
+            if axis is None:
+                for j in split:
+                    if j != i:
+                        d = _haversine_km(lat, lon, lats[j], lons[j])
+                        if d <= best:
+                            best = d
+                            nn[i] = d
+                continue
+            diff = point[axis] - split
+            # O lado mais perto por último na pilha: é visitado primeiro
+            if diff < 0:
+                stack.append((node[3], -diff))
+                stack.append((node[2], bound))
+            else:
+                stack.append((node[2], diff))
+                stack.append((node[3], bound))
+    return nn
+
+
+def dominant_cluster(lats, lons, weights):
+    """
+    Índices (crescentes) dos gateways do cluster dominante. `weights` são
+    as potências em mW. ~O(n log n) por grupo (ver o cabeçalho).
+    """
+    n = len(lats)
+    if n <= 1:
+        return list(range(n))
+
+    # eps adaptativo: vizinho mais próximo procurado até EPS_MAX_KM
+    eps = adaptive_eps(nearest_neighbor_km(lats, lons))
+
+    index = _GridIndex(lats, lons, eps)
+    neighbors = [index.neighbors(i, eps) for i in range(n)]
+    core = [len(nb) >= MIN_PTS for nb in neighbors]
+
+    # Componentes dos núcleos (rótulo = menor índice do componente)
+    label = [None] * n
+    for i in range(n):
+        if not core[i] or label[i] is not None:
+            continue
+        component, stack = [i], [i]
+        label[i] = i
+        while stack:
+            for j in neighbors[stack.pop()]:
+                if core[j] and label[j] is None:
+                    label[j] = i
+                    component.append(j)
+                    stack.append(j)
+    # Bordas: cluster de menor rótulo entre os núcleos vizinhos
+    for i in range(n):
+        if not core[i]:
+            labels = [label[j] for j in neighbors[i] if core[j]]
+            if labels:
+                label[i] = min(labels)
+
+    clusters = {}
+    for i in range(n):
+        if label[i] is not None:
+            c = clusters.setdefault(label[i], [0.0, 0, []])
+            c[0] += weights[i]
+            c[1] += 1
+            c[2].append(i)
+    if not clusters:
+        return [max(range(n), key=lambda i: (weights[i], -i))]
+    best = max(clusters, key=lambda l: (clusters[l][0], clusters[l][1], -l))
+    return clusters[best][2]
+
+
+def dominant_cluster_batch(pair_km, valid, weights):
+    """
+    Versão em lote: `pair_km` (G, M, M) distâncias entre os gateways de cada
+    grupo, `valid` (G, M), `weights` (G, M) em mW. Retorna a máscara (G, M)
+    do cluster dominante.
+    """
+    g, m = valid.shape
+    both = valid[:, :, None] & valid[:, None, :]
+    eye = np.eye(m, dtype=bool)[None]
+
+    # eps adaptativo (mediana das distâncias ao vizinho mais próximo até EPS_MAX_KM)
+    nn = np.where(both & ~eye, pair_km, np.inf).min(axis=2)
+    nn = np.where(valid & (nn <= EPS_MAX_KM), nn, np.inf)
+    count = np.isfinite(nn).sum(axis=1)
+    nn_sorted = np.sort(nn, axis=1)
+    rows = np.arange(g)
+    lo = nn_sorted[rows, np.maximum(count - 1, 0) // 2]
+    hi = nn_sorted[rows, np.minimum(count // 2, m - 1)]
+    eps = np.where(count > 0, np.clip(EPS_FACTOR * (lo + hi) / 2, EPS_MIN_KM, EPS_MAX_KM), EPS_MAX_KM)
+
+    adj = both & ((pair_km <= eps[:, None, None]) | eye)
+    core = valid & (adj.sum(axis=2) >= MIN_PTS)
+
+    # Propagação do menor índice entre núcleos conectados
+    big = m
+    label = np.where(core, np.arange(m)[None], big)
+    core_adj = adj & core[:, :, None] & core[:, None, :]
+    for _ in range(m):
+        new = np.where(core_adj, label[:, None, :], big).min(axis=2)
+        new = np.where(core, np.minimum(label, new), big)
+        if (new == label).all():
+            break
+        label = new
+    border = valid & ~core
+    border_label = np.where(adj & core[:, None, :], label[:, None, :], big).min(axis=2)
+    label = np.where(border, border_label, label)
+
+    # Potência e tamanho de cada cluster (rótulo l = coluna l)
+    one_hot = label[:, :, None] == np.arange(m)[None, None, :]
+    cluster_w = (np.where(one_hot, weights[:, :, None], 0.0)).sum(axis=1)
+    cluster_n = one_hot.sum(axis=1)
+    has_cluster = cluster_n > 0
+    best_w = np.where(has_cluster, cluster_w, -np.inf).max(axis=1)
+    cand = has_cluster & (cluster_w == best_w[:, None])
+    best_n = np.where(cand, cluster_n, -1).max(axis=1)
+    cand &= cluster_n == best_n[:, None]
+    best = np.argmax(cand, axis=1)   # menor rótulo entre os empatados
+    mask = (label == best[:, None]) & has_cluster.any(axis=1)[:, None]
+
+    # Sem cluster: gateway mais forte sozinho
+    no_cluster = valid.any(axis=1) & ~has_cluster.any(axis=1)
+    strongest = np.argmax(np.where(valid, weights, -np.inf), axis=1)
+    mask[no_cluster] = False
+    mask[no_cluster, strongest[no_cluster]] = True
+    return mask & valid
+
+
+# ==========================================
+# BENCHMARK (python -m lora.cluster)
+# ==========================================
+
+def _scenario(rng, n_groups, spread_km, n_gateways, reflections, reflection_km):
+    """Grupos sintéticos: gateways em volta do dispositivo + reflexões distantes."""
+    center = (-23.55, -46.63)
+    groups, truth = [], []
+    for g in range(n_groups):
+        dev = (center[0] + rng.uniform(-0.2, 0.2), center[1] + rng.uniform(-0.2, 0.2))
+        k_lon = KM_PER_DEG * math.cos(math.radians(dev[0]))
+        gateways = []
+        for j in range(n_gateways + reflections):
+            if j < n_gateways:
+                dist_km = rng.uniform(0.05, spread_km)
+            else:
+                dist_km = rng.uniform(*reflection_km)
+            angle = rng.uniform(0, 2 * math.pi)
+            lat = dev[0] + dist_km * math.sin(angle) / KM_PER_DEG
+            lon = dev[1] + dist_km * math.cos(angle) / k_lon
+            if j < n_gateways:
+                # Mesmo modelo do GatewaySimulator
+                rssi = -40 - 20 * math.log10(dist_km * 1000) + rng.gauss(0, 3)
+            else:
+                # Duto atmosférico: chega forte apesar da distância
+                rssi = -95 + rng.gauss(0, 5)
+            gateways.append({
+                "serial": f"D{g}",
+                "data": {
+                    "sequenceNumber": 1,
+                    "deviceDateTime": g,
+                    "gatewayPosition": [{"latitude": int(round(lat * 1e7)), "longitude": int(round(lon * 1e7))}],
+                    "gatewayGps": {"fixState": "FS_FIX_3D"},
+                    "loraRadio": {"RSSI": int(rssi)},
+                },
+            })
+        groups.append((f"D{g}", 1, gateways))
+        truth.append(dev)
+    return groups, np.array(truth)
+
+
+def _scaling(rng):
+    """Um grupo com n gateways espalhados numa área que cresce com n (densidade fixa)."""
+    import time
+
+    for n in (100, 1000, 4000, 16000):
+        side_km = math.sqrt(n) * 0.5
+        lats = [-23.55 + rng.uniform(0, side_km) / KM_PER_DEG for _ in range(n)]
+        lons = [-46.63 + rng.uniform(0, side_km) / KM_PER_DEG for _ in range(n)]
+        weights = [10 ** rng.uniform(-12, -8) for _ in range(n)]
+        begin = time.perf_counter()
+        nearest_neighbor_km(lats, lons)
+        nn_s = time.perf_counter() - begin
+        begin = time.perf_counter()
+        dominant_cluster(lats, lons, weights)
+        total_s = time.perf_counter() - begin
+        print(f"n={n:6d}: vizinho mais próximo {nn_s * 1000:8.1f} ms | dominant_cluster {total_s * 1000:8.1f} ms "
+              f"| {total_s / n * 1e6:.1f} µs/gateway")
+
+
+def main():
+    import argparse
+    import random
+    import time
+
+    from lora.batch import centroid_batch, pack_groups
+
+    parser = argparse.ArgumentParser(description="Filtro líder vs. densidade (dados sintéticos)")
+    parser.add_argument("--groups", type=int, default=5000)
+    parser.add_argument("--scaling", action="store_true",
+                        help="Tempo de dominant_cluster num grupo só, com n crescente")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    if args.scaling:
+        _scaling(rng)
+        return
+    scenarios = {
+        # Área urbana densa: 8 gateways a até 0,6 km, 2 reflexões a 0,8-2 km
+        # (perto demais para o corte fixo de 1,5 km pegar sempre)
+        "urbano denso": (8, _scenario(rng, args.groups, 0.6, 8, 2, (0.8, 2.0))),
+        # Área rural: 4 gateways a até 4 km, sem reflexões
+        "rural": (4, _scenario(rng, args.groups, 4.0, 4, 0, (0, 0))),
+    }
+    for name, (n_real, (groups, truth)) in scenarios.items():
+        batch = pack_groups(groups)
+        for mode in CLUSTER_MODES:
+            begin = time.perf_counter()
+            res = centroid_batch(batch, cluster_mode=mode)
+            elapsed = time.perf_counter() - begin
+            d_lat = (res["lat"] - truth[:, 0]) * KM_PER_DEG * 1000
+            d_lon = (res["lon"] - truth[:, 1]) * KM_PER_DEG * 1000 * np.cos(np.radians(truth[:, 0]))
+            err = np.hypot(d_lat, d_lon)[res["ok"]]
+            real = res["used"][:, :n_real].sum(axis=1).mean()
+            reflected = res["used"][:, n_real:].sum(axis=1).mean()
+            print(f"{name:13s} {mode:8s}: mediana {np.median(err):7.1f} m | p90 {np.percentile(err, 90):7.1f} m | "
+                  f"mantidos {real:.2f} reais + {reflected:.2f} reflexões | {len(groups) / elapsed:,.0f} grupos/s")
+
+
+if __name__ == "__main__":
+    main()
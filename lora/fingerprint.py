@@ -0,0 +1,382 @@
+import math
+import time
+
+import numpy as np
+
+from lora.grid import latlon_to_tile
+from lora.triangulation import (GATEWAY_COORDINATE_DIVISOR, geometry_dop, parse_device_timestamp,
+                                parse_gateway_report)
+
+# ==========================================
+# MAPA DE RÁDIO (FINGERPRINT DE RSSI)
+# ==========================================
+# Os mesmos locais são revisitados o tempo todo, então o histórico vira um
+# mapa: para cada célula da grade (tile no nível FINGERPRINT_ZOOM, ~75 m)
+# guarda-se o RSSI médio com que cada gateway ouve quem está ali, além da
+# posição média das estimativas que caíram na célula. Um pacote novo é
+# localizado pelos k vizinhos mais próximos no espaço de RSSI: uma dimensão
+# por gateway, distância euclidiana em dB, gateway não ouvido = FLOOR_DBM.
+#
+# Os pacotes não trazem identificador de gateway; o gateway é identificado
+# pela própria posição, quantizada em GATEWAY_KEY_QUANTUM unidades cruas
+# (1e-7 grau), o que absorve a oscilação do GPS do gateway.
+#
+# Busca exata sem árvore: cada célula ouve poucos gateways, então a
+# distância se decompõe em
+#
+#     d²(q, c) = |c - piso|² + |q - piso|²
+#                + Σ_{j ouvido por q e c} [(q_j - c_j)² - (c_j - piso)² - (q_j - piso)²]
+#
+# e só as listas invertidas (gateway -> células que o ouvem) dos gateways
+# do pacote são percorridas, mais uma soma vetorizada sobre as normas
+# |c - piso|² mantidas por célula. Uma KD-tree sobre esse espaço (dimensão =
+# número de gateways) visitava um quarto das folhas por consulta e ficava
+# mais lenta que a força bruta. A inserção é O(gateways do pacote), sem
+# reconstrução de índice.
+
+FINGERPRINT_MAP_PATH = "fingerprint.npz"
+FINGERPRINT_ZOOM = 19
+GATEWAY_KEY_QUANTUM = 1000
+FLOOR_DBM = -130.0
+K_NEIGHBORS = 4
+MIN_ERROR_M = 3.0
+INITIAL_CAPACITY = 1024
+
+METERS_PER_DEG = 111320.0
+
+
+def gateway_key(lat_raw, lon_raw, quantum=GATEWAY_KEY_QUANTUM):
+    return (int(lat_raw) // quantum, int(lon_raw) // quantum)
+
+
+def _grow(array, size):
+    grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class _Postings:
+    """Lista invertida de um gateway: células que o ouviram, com soma e contagem de RSSI."""
+
+    def __init__(self, capacity=16):
+        self.slots = {}
+        self.rows = np.zeros(capacity, dtype=np.int64)
+        self.sums = np.zeros(capacity)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, row, total, count):
+        """Acumula na célula; retorna (média anterior ou None, média nova)."""
+        i = self.slots.get(row)
+        old = None
+        if i is None:
+            i = self.slots[row] = len(self.slots)
+            if i >= len(self.rows):
+                self.rows = _grow(self.rows, 2 * len(self.rows))
+                self.sums = _grow(self.sums, 2 * len(self.sums))
+                self.counts = _grow(self.counts, 2 * len(self.counts))
+            self.rows[i] = row
+        else:
+            old = self.sums[i] / self.counts[i]
+        self.sums[i] += total
+        self.counts[i] += count
+        return old, self.sums[i] / self.counts[i]
+
+    def means(self):
+        n = len(self.slots)
+        return self.rows[:n], self.sums[:n] / self.counts[:n]
+
+
+class FingerprintMap:
+
+    def __init__(self, zoom=FINGERPRINT_ZOOM, quantum=GATEWAY_KEY_QUANTUM, capacity=INITIAL_CAPACITY):
+        self.zoom = zoom
+        self.quantum = quantum
+        self.cells = {}       # tile (x, y) -> linha
+        self.gateways = {}    # chave do gateway -> _Postings
+        self.position = np.zeros((capacity, 3))   # soma lat, soma lon, contagem
+        self.norm = np.zeros(capacity)            # |c - piso|² por célula
+
+    def __len__(self):
+        return len(self.cells)
+
+    # ---------- Construção ----------
+
+    def _row(self, lat, lon):
+        key = latlon_to_tile(lat, lon, self.zoom)
+        row = self.cells.get(key)
+        if row is None:
+            row = self.cells[key] = len(self.cells)
+            if row >= len(self.position):
+                self.position = _grow(self.position, 2 * len(self.position))
+                self.norm = _grow(self.norm, 2 * len(self.norm))
+        return row
+
+    def _accumulate(self, row, key, total, count):
+        postings = self.gateways.get(key)
+        if postings is None:
+            postings = self.gateways[key] = _Postings()
+        old, new = postings.add(row, total, count)
+        if old is not None:
+            self.norm[row] -= (old - FLOOR_DBM) ** 2
+        self.norm[row] += (new - FLOOR_DBM) ** 2
+
+    def add(self, lat, lon, gateways):
+        """
+        Acrescenta uma medição: posição estimada (graus) e os gateways que
+        ouviram o pacote, como (lat_raw, lon_raw, rssi).
+        """
+        gateways = list(gateways)
+        if not gateways:
+            return
+        row = self._row(lat, lon)
+        for lat_raw, lon_raw, rssi in gateways:
+            self._accumulate(row, gateway_key(lat_raw, lon_raw, self.quantum), rssi, 1)
+        self.position[row] += (lat, lon, 1)
+
+    def add_packets(self, packets, lat, lon):
+        """Acrescenta um grupo de relatórios de gateway com a posição calculada para ele."""
+        self.add(lat, lon, _valid_gateways(packets))
+
+    def add_batch(self, batch, lat, lon, ok, mask=None):
+        """
+        Acrescenta um GroupBatch inteiro com as posições calculadas em lote
+        (`centroid_batch`/`multilaterate_batch`). Por padrão usa todos os
+        gateways válidos do grupo; `mask` (G, M) restringe, por exemplo, aos
+        que sobraram no corte por distância.
+        """
+        use = batch.valid if mask is None else batch.valid & mask
+        lat_raw = np.rint(batch.lat * GATEWAY_COORDINATE_DIVISOR).astype(np.int64)
+        lon_raw = np.rint(batch.lon * GATEWAY_COORDINATE_DIVISOR).astype(np.int64)
+        for g in np.flatnonzero(ok & use.any(axis=1)).tolist():
+            cols = np.flatnonzero(use[g])
+            self.add(float(lat[g]), float(lon[g]),
+                     zip(lat_raw[g, cols].tolist(), lon_raw[g, cols].tolist(), batch.rssi[g, cols].tolist()))
+
+    # ---------- Consulta ----------
+
+    def nearest(self, gateways, k=K_NEIGHBORS):
+        """
+        (distâncias em dB, linhas) das k células mais parecidas com o pacote,
+        dado como (lat_raw, lon_raw, rssi). Gateways fora do mapa são
+        ignorados; None se nenhum é conhecido.
+        """
+        heard = {}
+        for lat_raw, lon_raw, rssi in gateways:
+            key = gateway_key(lat_raw, lon_raw, self.quantum)
+            if key in self.gateways:
+                s = heard.setdefault(key, [0.0, 0])
+                s[0] += rssi
+                s[1] += 1
+        if not heard:
+            return None
+
+        n = len(self.cells)
+        d2 = self.norm[:n].copy()
+        for key, (total, count) in heard.items():
+            q = total / count
+            rows, c = self.gateways[key].means()
+            d2 += (q - FLOOR_DBM) ** 2
+            d2[rows] += (q - c) ** 2 - (c - FLOOR_DBM) ** 2 - (q - FLOOR_DBM) ** 2
+        k = min(k, n)
+        best = np.argpartition(d2, k - 1)[:k]
+        best = best[np.argsort(d2[best], kind="stable")]
+        return np.sqrt(np.maximum(d2[best], 0.0)), best
+
+    def locate(self, gateway_positions_raw, k=K_NEIGHBORS):
+        """
+        Localiza um grupo de relatórios pelo mapa. Mesmo formato de retorno
+        de `process_triangulation` (resultado, erro), com 'method': "fingerprint"
+        e 'fingerprint_distance_db' (distância RSSI do vizinho mais próximo).
+        """
+        gateways = _valid_gateways(gateway_positions_raw)
+        if not gateways:
+            return None, "Nenhum gateway válido (Fix 2D/3D + RSSI) encontrado."
+        found = self.nearest(gateways, k)
+        if found is None:
+            return None, "Nenhum dos gateways do pacote está no mapa de rádio."
+
+        dist, rows = found
+        weight = 1.0 / (dist + 1e-6)
+        cell_lat = self.position[rows, 0] / self.position[rows, 2]
+        cell_lon = self.position[rows, 1] / self.position[rows, 2]
+        lat = float((cell_lat * weight).sum() / weight.sum())
+        lon = float((cell_lon * weight).sum() / weight.sum())
+        # Raio de erro: espalhamento ponderado dos vizinhos ao redor da resposta
+        spread2 = (((cell_lat - lat) * METERS_PER_DEG) ** 2
+                   + ((cell_lon - lon) * METERS_PER_DEG * math.cos(math.radians(lat))) ** 2)
+        error = max(MIN_ERROR_M, math.sqrt(float((spread2 * weight).sum() / weight.sum())))
+
+        serial = device_ts = None
+        for packet in gateway_positions_raw:
+            if isinstance(packet, dict):
+                serial = packet.get('serial')
+                device_ts = parse_device_timestamp(packet.get('data', {}).get('deviceDateTime'))
+                break
+        used = [{"lat": la / GATEWAY_COORDINATE_DIVISOR, "lon": lo / GATEWAY_COORDINATE_DIVISOR, "rssi": rssi}
+                for la, lo, rssi in gateways]
+        return {
+            "lat": lat,
+            "lon": lon,
+            "error": error,
+            "gateways_used": used,
+            "max_rssi": max(rssi for _, _, rssi in gateways),
+            "gdop": geometry_dop(used, lat, lon),
+            "total_raw_gateways": len(gateways),
+            "serial": serial or "Desconhecido",
+            "timestamp": device_ts if device_ts is not None else time.time(),
+            "method": "fingerprint",
+            "fingerprint_distance_db": float(dist[0]),
+        }, None
+
+    # ---------- Persistência ----------
+
+    def save(self, path):
+        """Salva em .npz: as listas invertidas vão concatenadas (formato CSR)."""
+        n = len(self.cells)
+        keys = list(self.gateways)
+        postings = [self.gateways[key] for key in keys]
+        offsets = np.cumsum([0] + [len(p) for p in postings])
+        np.savez_compressed(
+            path,
+            meta=np.array([self.zoom, self.quantum]),
+            cell_keys=np.array(list(self.cells), dtype=np.int64).reshape(n, 2),
+            position=self.position[:n],
+            gateway_keys=np.array(keys, dtype=np.int64).reshape(len(keys), 2),
+            offsets=offsets,
+            rows=np.concatenate([p.rows[:len(p)] for p in postings] or [np.zeros(0, dtype=np.int64)]),
+            sums=np.concatenate([p.sums[:len(p)] for p in postings] or [np.zeros(0)]),
+            counts=np.concatenate([p.counts[:len(p)] for p in postings] or [np.zeros(0, dtype=np.int64)]),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            zoom, quantum = (int(v) for v in f["meta"])
+            cell_keys = f["cell_keys"].tolist()
+            fmap = cls(zoom, quantum, capacity=max(len(cell_keys), INITIAL_CAPACITY))
+            fmap.cells = {tuple(key): i for i, key in enumerate(cell_keys)}
+            fmap.position[:len(cell_keys)] = f["position"]
+            offsets = f["offsets"].tolist()
+            rows, sums, counts = f["rows"], f["sums"], f["counts"]
+            for g, key in enumerate(f["gateway_keys"].tolist()):
+                a, b = offsets[g], offsets[g + 1]
+                postings = fmap.gateways[tuple(key)] = _Postings(max(16, b - a))
+                postings.slots = {row: i for i, row in enumerate(rows[a:b].tolist())}
+                postings.rows[:b - a] = rows[a:b]
+                postings.sums[:b - a] = sums[a:b]
+                postings.counts[:b - a] = counts[a:b]
+                np.add.at(fmap.norm, rows[a:b], (sums[a:b] / counts[a:b] - FLOOR_DBM) ** 2)
+        return fmap
+
+
+def _valid_gateways(packets):
+    """(lat_raw, lon_raw, rssi) dos relatórios com fix 2D/3D e RSSI."""
+    gateways = []
+    for packet in packets:
+        try:
+            report = parse_gateway_report(packet)
+        except (KeyError, IndexError, ValueError, TypeError):
+            continue
+        if report is None or report['rssi'] is None or report['fix_state'] < 2:
+            continue
+        gateways.append((report['lat_raw'], report['lon_raw'], report['rssi']))
+    return gateways
+
+
+# ==========================================
+# LINHA DE COMANDO (python -m lora.fingerprint)
+# ==========================================
+
+def build_from_archive(fmap, path, solver="multilateration"):
+    """Acrescenta ao mapa os grupos de um arquivo .lpa, resolvidos em lote. Retorna o nº de grupos usados."""
+    from lora.archive import ArchiveReader
+    from lora.batch import centroid_batch, pack_columns
+    from lora.multilateration import multilaterate_batch
+
+    used = 0
+    with ArchiveReader(path) as reader:
+        for cols in reader.iter_columns():
+            batch = pack_columns(cols, reader.serials)
+            res = multilaterate_batch(batch) if solver == "multilateration" else centroid_batch(batch)
+            fmap.add_batch(batch, res["lat"], res["lon"], res["ok"])
+            used += int(res["ok"].sum())
+    return used
+
+
+def main():
+    import argparse
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description="Mapa de rádio (fingerprint de RSSI)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build", help="Cria ou atualiza o mapa a partir de arquivos .lpa")
+    p_build.add_argument("arquivos", nargs="+")
+    p_build.add_argument("--mapa", default=FINGERPRINT_MAP_PATH, help="Arquivo .npz do mapa (acrescentado se já existir)")
+    p_build.add_argument("--solver", choices=["multilateration", "centroid"], default="multilateration")
+    p_bench = sub.add_parser("bench", help="Precisão e latência com dados simulados")
+    p_bench.add_argument("--train", type=int, default=50000)
+    p_bench.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        fmap = FingerprintMap.load(args.mapa) if os.path.exists(args.mapa) else FingerprintMap()
+        start = time.perf_counter()
+        groups = sum(build_from_archive(fmap, path, args.solver) for path in args.arquivos)
+        fmap.save(args.mapa)
+        print(f"{groups} grupos em {time.perf_counter() - start:.2f} s | mapa: {len(fmap)} células, "
+              f"{len(fmap.gateways)} gateways")
+        return
+
+    from lora.batch import pack_groups
+    from lora.multilateration import multilaterate_batch
+    from lora.simulator import GatewaySimulator, random_gateways
+    from lora.triangulation import process_triangulation
+
+    gateways = random_gateways(60, seed=7)
+    train = GatewaySimulator(n_devices=args.train, gateways=gateways, seed=1)
+    groups = [(s, 0, train.uplink(s, now=0)) for s in train.devices]
+    start = time.perf_counter()
+    batch = pack_groups(groups)
+    res = multilaterate_batch(batch)
+    fmap = FingerprintMap()
+    fmap.add_batch(batch, res["lat"], res["lon"], res["ok"])
+    build_s = time.perf_counter() - start
+
+    test = GatewaySimulator(n_devices=args.queries, gateways=gateways, seed=2)
+    err = {"fingerprint": [], "centroid": []}
+    # Consultas sem resultado (sem célula próxima, gateways insuficientes) não entram no erro
+    failed = {"fingerprint": 0, "centroid": 0}
+    fp_s = tri_s = 0.0
+    for serial, (lat, lon) in test.devices.items():
+        packets = test.uplink(serial, now=0)
+        t0 = time.perf_counter()
+        fp, _ = fmap.locate(packets)
+        t1 = time.perf_counter()
+        tri, _ = process_triangulation(packets)
+        tri_s += time.perf_counter() - t1
+        fp_s += t1 - t0
+        for name, r in (("fingerprint", fp), ("centroid", tri)):
+            if r is None:
+                failed[name] += 1
+                continue
+            err[name].append(math.hypot((r["lat"] - lat) * METERS_PER_DEG,
+                                        (r["lon"] - lon) * METERS_PER_DEG * math.cos(math.radians(lat))))
+
+    n = len(test.devices)
+    print(f"Mapa: {len(fmap)} células, {len(fmap.gateways)} gateways, {args.train} pacotes em {build_s:.2f} s")
+    print(f"locate(): {fp_s / n * 1e3:.3f} ms/pacote | process_triangulation: {tri_s / n * 1e3:.3f} ms/pacote")
+    for name, e in err.items():
+        if not e:
+            print(f"Erro {name}: nenhuma das {n} consultas teve resultado")
+            continue
+        e = np.sort(e)
+        print(f"Erro {name}: mediana {np.median(e):.1f} m | p90 {e[int(len(e) * 0.9)]:.1f} m "
+              f"| {failed[name]} de {n} consultas sem resultado")
+
+
+if __name__ == "__main__":
+    main()
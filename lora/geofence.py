@@ -0,0 +1,322 @@
+import json
+import math
+
+# ==========================================
+# GEOCERCAS (CÍRCULOS E POLÍGONOS EM GRADE)
+# ==========================================
+# Milhares de cercas indexadas numa grade regular de GRID_CELL_DEG graus:
+# cada cerca entra nas células que o seu retângulo envolvente toca, e uma
+# estimativa só é comparada com as cercas das células que o círculo de
+# erro toca. Cerca que não divide célula nenhuma com o círculo está
+# certamente fora. Cercas enormes (mais de MAX_FENCE_CELLS células) ficam
+# numa lista à parte, sempre testada.
+#
+# O raio de erro entra na decisão: a estimativa está DENTRO só se o
+# círculo de erro inteiro cabe na cerca, FORA só se o círculo inteiro está
+# fora, e INCERTA no resto. Por serial guardamos em quais cercas o
+# dispositivo está; "enter" e "exit" só acontecem com DENTRO/FORA, então
+# uma estimativa imprecisa em cima da borda não gera eventos alternados.
+#
+# As contas são feitas num plano local em metros (equiretangular em volta
+# da cerca): bom para cercas de até dezenas de km.
+
+GEOFENCE_PATH = "geofences.geojson"
+GRID_CELL_DEG = 0.01
+MAX_FENCE_CELLS = 4096
+
+EARTH_RADIUS_KM = 6371.0
+METERS_PER_DEG = EARTH_RADIUS_KM * 1000.0 * math.pi / 180.0
+
+INSIDE = "inside"
+OUTSIDE = "outside"
+UNCERTAIN = "uncertain"
+
+
+class Fence:
+    """Cerca circular (centro + raio) ou poligonal (anel externo, sem buracos)."""
+
+    __slots__ = ("fence_id", "name", "kind", "bbox", "lat", "lon", "k_lon", "radius_m", "xs", "ys")
+
+    def __init__(self, fence_id, name, kind, lat, lon, radius_m=0.0, points=()):
+        self.fence_id = fence_id
+        self.name = name if name is not None else str(fence_id)
+        self.kind = kind
+        self.lat = lat
+        self.lon = lon
+        self.k_lon = METERS_PER_DEG * math.cos(math.radians(lat))
+        self.radius_m = radius_m
+        # Vértices em metros relativos a (lat, lon)
+        self.xs = [(p_lon - lon) * self.k_lon for _, p_lon in points]
+        self.ys = [(p_lat - lat) * METERS_PER_DEG for p_lat, _ in points]
+        if kind == "circle":
+            d_lat = radius_m / METERS_PER_DEG
+            d_lon = radius_m / self.k_lon
+            self.bbox = (lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon)
+        else:
+            lats = [p[0] for p in points]
+            lons = [p[1] for p in points]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    def classify(self, lat, lon, error_m):
+        x = (lon - self.lon) * self.k_lon
+        y = (lat - self.lat) * METERS_PER_DEG
+        if self.kind == "circle":
+            d = math.hypot(x, y)
+            if d + error_m <= self.radius_m:
+                return INSIDE
+            return OUTSIDE if d - error_m >= self.radius_m else UNCERTAIN
+
+        # Ponto no polígono (raio horizontal) + distância até a borda mais próxima
+        xs, ys = self.xs, self.ys
+        inside = False
+        best = math.inf
+        j = len(xs) - 1
+        for i in range(len(xs)):
+            xi, yi, xj, yj = xs[i], ys[i], xs[j], ys[j]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            dx, dy = xj - xi, yj - yi
+            seg2 = dx * dx + dy * dy
+            t = 0.0 if seg2 == 0 else max(0.0, min(1.0, ((x - xi) * dx + (y - yi) * dy) / seg2))
+            d2 = (x - xi - t * dx) ** 2 + (y - yi - t * dy) ** 2
+            if d2 < best: best = d2
+            j = i
+        if math.sqrt(best) < error_m:
+            return UNCERTAIN
+        return INSIDE if inside else OUTSIDE
+
+
+class GeofenceIndex:
+
+    def __init__(self, cell_deg=GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.fences = {}
+        self.cells = {}
+        self.large = []
+
+    def __len__(self):
+        return len(self.fences)
+
+    def add_circle(self, fence_id, lat, lon, radius_m, name=None):
+        self._add(Fence(fence_id, name, "circle", lat, lon, radius_m=radius_m))
+
+    def add_polygon(self, fence_id, points, name=None):
+        """`points`: [(lat, lon), ...] do anel externo (fechado ou não)."""
+        points = list(points)
+        if len(points) > 1 and points[0] == points[-1]:
+            points.pop()
+        if len(points) < 3:
+            raise ValueError(f"Polígono {fence_id!r} com menos de 3 vértices.")
+        lat = sum(p[0] for p in points) / len(points)
+        lon = sum(p[1] for p in points) / len(points)
+        self._add(Fence(fence_id, name, "polygon", lat, lon, points=points))
+
+    def _add(self, fence):
+        if fence.fence_id in self.fences:
+            raise ValueError(f"Cerca {fence.fence_id!r} repetida.")
+        self.fences[fence.fence_id] = fence
+        i0, j0, i1, j1 = self._cell_range(*fence.bbox)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > MAX_FENCE_CELLS:
+            self.large.append(fence)
+            return
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                self.cells.setdefault((i, j), []).append(fence)
+
+    def _cell_range(self, min_lat, min_lon, max_lat, max_lon):
+        c = self.cell_deg
+        return math.floor(min_lat / c), math.floor(min_lon / c), math.floor(max_lat / c), math.floor(max_lon / c)
+
+    def candidates(self, lat, lon, error_m):
+        """Cercas cujo retângulo pode tocar o círculo de erro (sem repetição)."""
+        d_lat = error_m / METERS_PER_DEG
+        d_lon = error_m / (METERS_PER_DEG * max(math.cos(math.radians(lat)), 1e-6))
+        i0, j0, i1, j1 = self._cell_range(lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon)
+        if i0 == i1 and j0 == j1:
+            return self.cells.get((i0, j0), []) + self.large
+        seen = {}
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                for fence in self.cells.get((i, j), ()):
+                    seen[fence.fence_id] = fence
+        for fence in self.large:
+            seen[fence.fence_id] = fence
+        return list(seen.values())
+
+    def classify(self, lat, lon, error_m):
+        """{fence_id: INSIDE ou UNCERTAIN} das cercas que não estão certamente fora."""
+        d_lat = error_m / METERS_PER_DEG
+        d_lon = error_m / (METERS_PER_DEG * max(math.cos(math.radians(lat)), 1e-6))
+        states = {}
+        for fence in self.candidates(lat, lon, error_m):
+            # Retângulo da cerca longe do quadrado do círculo de erro: fora
+            min_lat, min_lon, max_lat, max_lon = fence.bbox
+            if lat + d_lat < min_lat or lat - d_lat > max_lat or lon + d_lon < min_lon or lon - d_lon > max_lon:
+                continue
+            state = fence.classify(lat, lon, error_m)
+            if state != OUTSIDE:
+                states[fence.fence_id] = state
+        return states
+
+
+def _position(result):
+    """(lat, lon, erro) de uma triangulação ou de uma super posição."""
+    if 'final_latitude' in result:
+        return result['final_latitude'], result['final_longitude'], result['final_error_radius_m']
+    return result['lat'], result['lon'], result['error']
+
+
+class GeofenceMonitor:
+    """
+    Estado dentro/fora por (serial, cerca). `evaluate` devolve os eventos
+    gerados pela estimativa: dicts com event ("enter"/"exit"), serial,
+    fence, name, timestamp, lat, lon e error.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.inside = {}
+        self.stats = {"evaluations": 0, "enter": 0, "exit": 0}
+
+    def evaluate(self, result, serial=None):
+        serial = serial if serial is not None else result.get('serial')
+        lat, lon, error = _position(result)
+        states = self.index.classify(lat, lon, error)
+        self.stats["evaluations"] += 1
+
+        current = self.inside.get(serial)
+        events = []
+        for fence_id, state in states.items():
+            if state == INSIDE and (current is None or fence_id not in current):
+                if current is None:
+                    current = self.inside[serial] = set()
+                current.add(fence_id)
+                events.append(self._event("enter", serial, fence_id, result, lat, lon, error))
+        if current:
+            # Fora de verdade só quando nem a incerteza toca a cerca
+            for fence_id in [f for f in current if f not in states]:
+                current.discard(fence_id)
+                events.append(self._event("exit", serial, fence_id, result, lat, lon, error))
+        return events
+
+    def _event(self, kind, serial, fence_id, result, lat, lon, error):
+        self.stats[kind] += 1
+        return {
+            "event": kind, "serial": serial, "fence": fence_id, "name": self.index.fences[fence_id].name,
+            "timestamp": result.get('timestamp'), "lat": lat, "lon": lon, "error": error,
+        }
+
+
+def load_geojson(path, cell_deg=GRID_CELL_DEG):
+    """
+    Cercas de um GeoJSON (FeatureCollection): Polygon/MultiPolygon (só o
+    anel externo) e Point com properties.radius_m. O id é o 'id' da feature,
+    properties.id ou a posição no arquivo; o nome vem de properties.name.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    index = GeofenceIndex(cell_deg)
+    for n, feature in enumerate(data.get('features', [])):
+        props = feature.get('properties') or {}
+        fence_id = feature.get('id', props.get('id', n))
+        name = props.get('name')
+        geometry = feature['geometry']
+        kind = geometry['type']
+        if kind == "Point":
+            lon, lat = geometry['coordinates'][:2]
+            index.add_circle(fence_id, lat, lon, float(props['radius_m']), name)
+        elif kind == "Polygon":
+            index.add_polygon(fence_id, [(lat, lon) for lon, lat, *_ in geometry['coordinates'][0]], name)
+        elif kind == "MultiPolygon":
+            for k, polygon in enumerate(geometry['coordinates']):
+                index.add_polygon(f"{fence_id}#{k}", [(lat, lon) for lon, lat, *_ in polygon[0]], name)
+        else:
+            raise ValueError(f"Geometria {kind} não suportada (cerca {fence_id!r}).")
+    return index
+
+
+# ==========================================
+# BENCHMARK (python -m lora.geofence)
+# ==========================================
+
+def random_fences(n, center=(-8.0135, -48.4653), spread_deg=0.25, seed=0, cell_deg=GRID_CELL_DEG):
+    """Metade círculos, metade polígonos (6-20 vértices), 50-800 m de raio."""
+    import random
+
+    rnd = random.Random(seed)
+    index = GeofenceIndex(cell_deg)
+    for i in range(n):
+        lat = center[0] + rnd.uniform(-spread_deg, spread_deg)
+        lon = center[1] + rnd.uniform(-spread_deg, spread_deg)
+        radius = rnd.uniform(50, 800)
+        if i % 2 == 0:
+            index.add_circle(i, lat, lon, radius)
+            continue
+        k_lon = METERS_PER_DEG * math.cos(math.radians(lat))
+        vertices = rnd.randint(6, 20)
+        points = []
+        for v in range(vertices):
+            angle = 2 * math.pi * v / vertices
+            r = radius * rnd.uniform(0.5, 1.0)
+            points.append((lat + r * math.sin(angle) / METERS_PER_DEG, lon + r * math.cos(angle) / k_lon))
+        index.add_polygon(i, points)
+    return index
+
+
+def main():
+    import argparse
+    import random
+    import time
+
+    parser = argparse.ArgumentParser(description="Avaliação de geocercas (dados sintéticos)")
+    parser.add_argument("--fences", type=int, default=5000)
+    parser.add_argument("--estimates", type=int, default=100000)
+    args = parser.parse_args()
+
+    begin = time.perf_counter()
+    index = random_fences(args.fences)
+    build_s = time.perf_counter() - begin
+
+    rnd = random.Random(1)
+    serials = [f"SIM{i:05d}" for i in range(1000)]
+    # Dispositivos andando devagar pela área (entram e saem de cercas)
+    where = {s: [-8.0135 + rnd.uniform(-0.25, 0.25), -48.4653 + rnd.uniform(-0.25, 0.25)] for s in serials}
+    estimates = []
+    for i in range(args.estimates):
+        serial = serials[i % len(serials)]
+        pos = where[serial]
+        pos[0] += rnd.gauss(0, 0.001)
+        pos[1] += rnd.gauss(0, 0.001)
+        estimates.append({"serial": serial, "lat": pos[0], "lon": pos[1], "error": rnd.uniform(3, 120),
+                          "timestamp": i})
+
+    monitor = GeofenceMonitor(index)
+    begin = time.perf_counter()
+    events = 0
+    for res in estimates:
+        events += len(monitor.evaluate(res))
+    index_s = time.perf_counter() - begin
+
+    # Conferência contra a força bruta (todas as cercas) numa amostra
+    sample = estimates[:200]
+    fences = list(index.fences.values())
+    begin = time.perf_counter()
+    mismatches = 0
+    for res in sample:
+        brute = {}
+        for fence in fences:
+            state = fence.classify(res['lat'], res['lon'], res['error'])
+            if state != OUTSIDE:
+                brute[fence.fence_id] = state
+        mismatches += brute != index.classify(res['lat'], res['lon'], res['error'])
+    brute_s = (time.perf_counter() - begin) / len(sample) * len(estimates)
+
+    print(f"{len(index)} cercas indexadas em {build_s * 1000:.0f} ms ({len(index.cells)} células, "
+          f"{len(index.large)} grandes)")
+    print(f"{len(estimates)} estimativas: {len(estimates) / index_s:,.0f}/s com a grade "
+          f"(força bruta: {len(estimates) / brute_s:,.0f}/s) | eventos: {monitor.stats['enter']} entradas, "
+          f"{monitor.stats['exit']} saídas | divergências na amostra: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import math
+
+# ==========================================
+# GRADE DE DENSIDADE MULTI-RESOLUÇÃO (QUADKEY)
+# ==========================================
+# As estimativas são agregadas em tiles Web Mercator (mesmo esquema de
+# tiles do Leaflet/OSM). Cada nível de zoom guarda, por tile, a contagem
+# e a soma dos erros, então a média é sempre O(1) e a inserção é
+# incremental (um update por nível, sem rever o histórico).
+
+MIN_GRID_ZOOM = 8
+MAX_GRID_ZOOM = 20
+
+# Quantos níveis abaixo do zoom do mapa fica a grade desenhada.
+# Com 3, cada célula ocupa ~32 px na tela (tile de 256 px / 2^3).
+CELL_ZOOM_OFFSET = 3
+
+MAX_LATITUDE = 85.05112878
+
+
+def latlon_to_tile(lat, lon, zoom):
+    """Converte lat/lon para o tile (x, y) no nível de zoom dado."""
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, zoom):
+    """Retorna ((lat_sul, lon_oeste), (lat_norte, lon_leste)) do tile."""
+    n = 1 << zoom
+
+    def tile_lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    return (tile_lat(y + 1), west), (tile_lat(y), east)
+
+
+def tile_to_quadkey(x, y, zoom):
+    """Quadkey (Bing Maps) do tile: um dígito 0-3 por nível."""
+    digits = []
+    for level in range(zoom, 0, -1):
+        mask = 1 << (level - 1)
+        digit = 0
+        if x & mask: digit += 1
+        if y & mask: digit += 2
+        digits.append(str(digit))
+    return "".join(digits)
+
+
+def grid_zoom_for_map(map_zoom):
+    """Nível da grade usado para desenhar o mapa no zoom informado."""
+    return max(MIN_GRID_ZOOM, min(MAX_GRID_ZOOM, int(map_zoom) + CELL_ZOOM_OFFSET))
+
+
+class DensityGrid:
+    """
+    Agregador incremental de estimativas (triangulação e super posição).
+    Estado: um dicionário por nível {(x, y): [contagem, soma_erro]}.
+    """
+
+    def __init__(self, min_zoom=MIN_GRID_ZOOM, max_zoom=MAX_GRID_ZOOM):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.levels = {z: {} for z in range(min_zoom, max_zoom + 1)}
+        self.total = 0
+
+    def add(self, lat, lon, error):
+        # Calcula o tile no nível mais fino e sobe por deslocamento de bits
+        x, y = latlon_to_tile(lat, lon, self.max_zoom)
+        for z in range(self.max_zoom, self.min_zoom - 1, -1):
+            shift = self.max_zoom - z
+            key = (x >> shift, y >> shift)
+            cell = self.levels[z].get(key)
+            if cell is None:
+                self.levels[z][key] = [1, error]
+            else:
+                cell[0] += 1
+                cell[1] += error
+        self.total += 1
+
+    def add_result(self, res):
+        """Aceita tanto o resultado da triangulação quanto o da super posição."""
+        if 'final_latitude' in res:
+            self.add(res['final_latitude'], res['final_longitude'], res['final_error_radius_m'])
+        else:
+            self.add(res['lat'], res['lon'], res['error'])
+
+    def merge(self, other):
+        """Soma outra grade (mesma faixa de níveis) a esta."""
+        for z, level in other.levels.items():
+            mine = self.levels[z]
+            for key, (count, error_sum) in level.items():
+                cell = mine.get(key)
+                if cell is None:
+                    mine[key] = [count, error_sum]
+                else:
+                    cell[0] += count
+                    cell[1] += error_sum
+        self.total += other.total
+
+    def cells(self, zoom, bounds=None):
+        """
+        Células do nível `zoom` (limitado à faixa da grade), opcionalmente
+        recortadas por bounds = ((lat_sul, lon_oeste), (lat_norte, lon_leste)).
+        """
+        zoom = max(self.min_zoom, min(self.max_zoom, zoom))
+        level = self.levels[zoom]
+
+        if bounds is None:
+            items = level.items()
+        else:
+            (south, west), (north, east) = bounds
+            x_min, y_min = latlon_to_tile(north, west, zoom)
+            x_max, y_max = latlon_to_tile(south, east, zoom)
+            if (x_max - x_min + 1) * (y_max - y_min + 1) < len(level):
+                # Janela menor que o nível (caso comum nos zooms altos): consulta
+                # só os tiles visíveis, sem percorrer o histórico inteiro
+                items = ((key, level[key]) for key in
+                         ((x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1))
+                         if key in level)
+            else:
+                items = (((x, y), cell) for (x, y), cell in level.items()
+                         if x_min <= x <= x_max and y_min <= y <= y_max)
+
+        result = []
+        for (x, y), (count, error_sum) in items:
+            result.append({
+                "quadkey": tile_to_quadkey(x, y, zoom),
+                "bounds": tile_bounds(x, y, zoom),
+                "count": count,
+                "mean_error": error_sum / count,
+            })
+        return result
@@ -0,0 +1,77 @@
+import io
+import uuid
+
+import streamlit as st
+
+from lora.jobs import JobRunner
+
+# ==========================================
+# PAINEL DE TAREFAS (STREAMLIT, COMUM ÀS PÁGINAS)
+# ==========================================
+# Um só JobRunner por processo para todas as páginas (o cache_resource é
+# desta função, não de cópias em cada página). Cada página passa o tipo das
+# suas tarefas: o painel só mostra e entrega ao `on_finished` as tarefas
+# desse tipo, então uma página nunca consome o resultado da outra.
+#
+# Arquivo enviado vai para a tarefa por `private_upload`: o UploadedFile é
+# um buffer só, e duas tarefas do mesmo upload (o limite por usuário
+# permite) intercalariam seek/read nele.
+
+# Intervalo de consulta do painel de tarefas (s)
+JOB_POLL_INTERVAL_S = 1.0
+
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+
+def job_owner():
+    """Identifica a sessão no pool de tarefas (e nas listas do servidor)."""
+    if 'job_owner' not in st.session_state:
+        st.session_state['job_owner'] = uuid.uuid4().hex
+    return st.session_state['job_owner']
+
+
+def submit_job(kind, label, fn, *args, **kwargs):
+    """Agenda a tarefa da sessão atual (JobLimitError acima do limite por usuário)."""
+    return get_job_runner().submit(job_owner(), kind, label, fn, *args, **kwargs)
+
+
+def private_upload(uploaded):
+    """Cópia do UploadedFile só da tarefa, com os mesmos `name` e `size`."""
+    copy = io.BytesIO(uploaded.getvalue())
+    copy.name = uploaded.name
+    copy.size = uploaded.size
+    return copy
+
+
+@st.fragment(key="tarefas", run_every=JOB_POLL_INTERVAL_S)
+def _job_panel(kind, on_finished, show_partial):
+    # Consulta periódica: só este fragmento é reexecutado enquanto há tarefas
+    runner = get_job_runner()
+    finished = False
+    for job in runner.jobs_for(job_owner(), kind):
+        if job.active:
+            c1, c2 = st.columns([5, 1])
+            c1.progress(job.progress, text=f"⏳ {job.label}: {job.message or 'na fila'}")
+            c2.button("Cancelar", key=f"cancel_job_{job.id}", on_click=job.cancel)
+            if show_partial is not None and job.partial is not None:
+                show_partial(job.partial)
+        else:
+            on_finished(job)
+            runner.forget(job.id)
+            finished = True
+    if finished:
+        # Resultado aplicado: redesenha a página toda
+        st.rerun()
+
+
+def show_jobs(kind, on_finished, show_partial=None):
+    """
+    Painel das tarefas `kind` da sessão (só aparece se há alguma).
+    `on_finished(job)` aplica no estado da sessão o resultado de cada tarefa
+    encerrada; `show_partial(partial)` desenha o resultado parcial.
+    """
+    if get_job_runner().jobs_for(job_owner(), kind):
+        _job_panel(kind, on_finished, show_partial)
@@ -0,0 +1,150 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ==========================================
+# EXECUÇÃO DE TAREFAS EM SEGUNDO PLANO
+# ==========================================
+# Tarefas longas (importação de log, análise da frota) rodam num pool de
+# threads compartilhado entre as sessões, e a página só consulta o estado.
+# A função da tarefa recebe o Job como primeiro argumento e usa
+# `job.report(fração, mensagem)` para o progresso; `report` levanta
+# JobCancelled quando o cancelamento foi pedido, então a tarefa para no
+# próximo ponto de progresso.
+#
+# Threads (e não processos): argumentos (ex.: o arquivo enviado) e
+# resultados passam sem serialização e as tarefas usam o mesmo SQLite da
+# página. O limite por usuário evita que uma sessão ocupe o pool inteiro.
+#
+# Cada tarefa tem um `kind` (ex.: "log_import", "fleet"): o pool é um só
+# para todas as páginas, mas cada página só consulta e aplica as tarefas do
+# seu tipo, e o limite por usuário vale por tipo.
+
+JOB_WORKERS = 4
+JOBS_PER_USER = 2
+# Tarefas encerradas ficam disponíveis para consulta por este tempo
+FINISHED_JOB_TTL_S = 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLimitError(Exception):
+    """O usuário já tem o máximo de tarefas ativas."""
+
+
+class Job:
+
+    def __init__(self, job_id, owner, kind, label):
+        self.id = job_id
+        self.owner = owner
+        self.kind = kind
+        self.label = label
+        self.state = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        # Resultado parcial opcional publicado pela tarefa (substituído por inteiro a cada report)
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._future = None
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def report(self, progress=None, message=None, partial=None):
+        """Atualiza o progresso (0..1). Levanta JobCancelled se foi pedido cancelamento."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        if progress is not None:
+            self.progress = max(0.0, min(1.0, progress))
+        if message is not None:
+            self.message = message
+        if partial is not None:
+            self.partial = partial
+
+    def cancel(self):
+        self._cancel.set()
+        # Ainda na fila: sai sem chegar a rodar
+        if self._future is not None and self._future.cancel():
+            self._finish(CANCELLED)
+
+    def _finish(self, state):
+        self.state = state
+        self.finished_at = time.time()
+
+
+class JobRunner:
+
+    def __init__(self, max_workers=JOB_WORKERS, per_user=JOBS_PER_USER):
+        self.per_user = per_user
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, owner, kind, label, fn, *args, **kwargs):
+        """Agenda `fn(job, *args, **kwargs)`. Levanta JobLimitError acima do limite do usuário para o tipo."""
+        with self._lock:
+            self._prune()
+            active = sum(1 for j in self.jobs.values() if j.owner == owner and j.kind == kind and j.active)
+            if active >= self.per_user:
+                raise JobLimitError(f"Limite de {self.per_user} tarefa(s) simultânea(s) por usuário.")
+            job = Job(next(self._ids), owner, kind, label)
+            self.jobs[job.id] = job
+            job._future = self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        if job._cancel.is_set():
+            job._finish(CANCELLED)
+            return
+        job.state = RUNNING
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.progress = 1.0
+            job._finish(DONE)
+        except JobCancelled:
+            job._finish(CANCELLED)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job._finish(FAILED)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def jobs_for(self, owner, kind=None):
+        """Tarefas do usuário (só do tipo `kind`, se dado), mais recentes primeiro."""
+        with self._lock:
+            return sorted((j for j in self.jobs.values() if j.owner == owner and kind in (None, j.kind)),
+                          key=lambda j: -j.id)
+
+    def forget(self, job_id):
+        """Descarta uma tarefa encerrada (o resultado já foi usado)."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None and not job.active:
+                del self.jobs[job_id]
+
+    def _prune(self):
+        cutoff = time.time() - FINISHED_JOB_TTL_S
+        for job_id in [i for i, j in self.jobs.items() if not j.active and j.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.executor.shutdown(wait=True)
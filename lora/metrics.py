@@ -0,0 +1,295 @@
+import bisect
+import itertools
+import math
+import threading
+import weakref
+
+# ==========================================
+# MÉTRICAS NO FORMATO DO PROMETHEUS
+# ==========================================
+# Contadores e histogramas sem lock no caminho quente: cada thread escreve
+# só na sua própria célula (criada na primeira vez que a thread usa a
+# métrica) e a leitura soma as células. O lock só é usado para criar
+# células e séries com labels novos, o que acontece poucas vezes.
+#
+# Threads vêm e vão (execuções do Streamlit, tarefas, executores): quando a
+# thread termina, o seu threading.local é liberado e a célula entra numa
+# lista de mortas; na próxima criação de célula ou leitura ela é somada a
+# uma base fixa e sai da lista. O número de células acompanha as threads
+# vivas, não todas as que já existiram.
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class _CellOwner:
+    """Guardado no threading.local: é coletado quando a thread termina."""
+    __slots__ = ("__weakref__",)
+
+
+class _Sharded:
+    """Base: uma célula (lista) por thread viva, registrada na primeira escrita."""
+
+    def __init__(self, size):
+        self._size = size
+        self._base = [0] * size
+        self._cells = {}
+        self._dead = []
+        self._keys = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = [0] * self._size
+            owner = _CellOwner()
+            with self._lock:
+                self._reap()
+                key = next(self._keys)
+                self._cells[key] = cell
+            # Sem lock no finalizador (pode rodar em qualquer thread): só marca a célula
+            weakref.finalize(owner, self._dead.append, key)
+            self._local.owner = owner
+            self._local.cell = cell
+            return cell
+
+    def _reap(self):
+        # Com o lock: células de threads encerradas vão para a base
+        while self._dead:
+            cell = self._cells.pop(self._dead.pop(), None)
+            if cell is not None:
+                for i, v in enumerate(cell):
+                    self._base[i] += v
+
+    def _totals(self):
+        with self._lock:
+            self._reap()
+            totals = list(self._base)
+            cells = list(self._cells.values())
+        for cell in cells:
+            for i, v in enumerate(cell):
+                totals[i] += v
+        return totals
+
+
+class Counter(_Sharded):
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._cell()[0] += amount
+
+    @property
+    def value(self):
+        return self._totals()[0]
+
+
+class Gauge:
+    """Valor instantâneo: definido por `set` ou lido de uma função na coleta."""
+
+    def __init__(self):
+        self._value = 0.0
+        self._fn = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, fn):
+        self._fn = fn
+
+    @property
+    def value(self):
+        return self._fn() if self._fn is not None else self._value
+
+
+class Histogram(_Sharded):
+    """Células: uma contagem por bucket (+Inf no fim), depois soma e total."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(len(self.buckets) + 3)
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def snapshot(self):
+        """(contagens acumuladas por bucket, soma, total)."""
+        totals = self._totals()
+        cumulative = []
+        running = 0
+        for c in totals[:len(self.buckets) + 1]:
+            running += c
+            cumulative.append(running)
+        return cumulative, totals[-2], totals[-1]
+
+
+class Family:
+    """Métrica com nome, ajuda e labels; cada combinação de labels é uma série."""
+
+    def __init__(self, kind, name, documentation, labelnames=(), factory=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._series = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._series[()] = factory()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, self._factory())
+        return series
+
+    # Atalhos para métricas sem labels
+    def inc(self, amount=1):
+        self._series[()].inc(amount)
+
+    def set(self, value):
+        self._series[()].set(value)
+
+    def set_function(self, fn):
+        self._series[()].set_function(fn)
+
+    def observe(self, value):
+        self._series[()].observe(value)
+
+    @property
+    def value(self):
+        return self._series[()].value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in sorted(self._series.items()):
+            labels = dict(zip(self.labelnames, key))
+            if self.kind == "histogram":
+                cumulative, total_sum, count = series.snapshot()
+                bounds = [_format_value(b) for b in series.buckets] + ["+Inf"]
+                for bound, c in zip(bounds, cumulative):
+                    lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=bound))} {c}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total_sum)}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+            else:
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(series.value)}")
+        return "\n".join(lines)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(v):
+    if isinstance(v, float):
+        if math.isinf(v):
+            return "+Inf" if v > 0 else "-Inf"
+        return repr(v)
+    return str(v)
+
+
+class Registry:
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, kind, name, documentation, labelnames, factory):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = Family(kind, name, documentation, labelnames, factory)
+            return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register("counter", name, documentation, labelnames, Counter)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register("gauge", name, documentation, labelnames, Gauge)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register("histogram", name, documentation, labelnames, lambda: Histogram(buckets))
+
+    def render(self):
+        """Texto de exposição do Prometheus (versão 0.0.4)."""
+        return "\n".join(f.render() for _, f in sorted(self._families.items())) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ==========================================
+# MÉTRICAS DO PIPELINE
+# ==========================================
+
+PACKETS_RECEIVED = REGISTRY.counter(
+    "lora_packets_received_total", "Pacotes recebidos pela ingestão", ("transport",))
+PACKETS_DROPPED = REGISTRY.counter(
+    "lora_packets_dropped_total", "Pacotes descartados por fila cheia", ("transport",))
+PACKETS_PROCESSED = REGISTRY.counter(
+    "lora_packets_processed_total", "Pacotes que passaram pelo pipeline")
+PACKETS_INVALID = REGISTRY.counter(
+    "lora_packets_invalid_total", "Pacotes com JSON ou estrutura inválida")
+GROUPS_EMITTED = REGISTRY.counter(
+    "lora_groups_emitted_total", "Grupos (serial, sequência) fechados e triangulados")
+ESTIMATES = REGISTRY.counter(
+    "lora_estimates_total", "Estimativas de posição produzidas")
+BATTERY_REPORTS = REGISTRY.counter(
+    "lora_battery_reports_total", "Pacotes de bateria analisados")
+GATEWAY_REJECTIONS = REGISTRY.counter(
+    "lora_gateway_rejections_total", "Relatórios de gateway descartados na triangulação", ("reason",))
+GROUP_REJECTIONS = REGISTRY.counter(
+    "lora_group_rejections_total", "Grupos sem estimativa", ("reason",))
+PROCESSING_ERRORS = REGISTRY.counter(
+    "lora_processing_errors_total", "Exceções inesperadas no processamento (lote ou flush descartado)",
+    ("stage",))
+STATIONARY_GROUPS = REGISTRY.counter(
+    "lora_stationary_groups_total", "Grupos de dispositivos parados por desfecho", ("result",))
+CACHE_LOOKUPS = REGISTRY.counter(
+    "lora_cache_lookups_total", "Consultas a caches", ("cache", "result"))
+QUEUE_DEPTH = REGISTRY.gauge(
+    "lora_ingest_queue_depth", "Itens aguardando na fila de ingestão")
+SESSIONS_ACTIVE = REGISTRY.gauge(
+    "lora_sessions_active", "Sessões com lista de clustering no servidor")
+SESSION_BYTES = REGISTRY.gauge(
+    "lora_session_bytes", "Memória das listas de clustering de todas as sessões")
+STAGE_LATENCY = REGISTRY.histogram(
+    "lora_stage_latency_seconds", "Latência por estágio do pipeline", ("stage",))
+
+
+# ==========================================
+# ACERTOS DE CACHE
+# ==========================================
+# Para caches que não expõem acertos (ex.: st.cache_data): a função cacheada
+# chama `mark_cache_miss()` no corpo, que só executa em falta, e quem consulta
+# passa pela `count_cache_lookup`. A marca é por thread, como a execução.
+
+_cache_state = threading.local()
+
+
+def mark_cache_miss():
+    _cache_state.miss = True
+
+
+def count_cache_lookup(cache, fn, *args, **kwargs):
+    _cache_state.miss = False
+    result = fn(*args, **kwargs)
+    CACHE_LOOKUPS.labels(cache=cache, result="miss" if _cache_state.miss else "hit").inc()
+    return result
@@ -0,0 +1,222 @@
+import math
+
+import numpy as np
+
+from lora.batch import BATCH_GROUPS, EARTH_RADIUS_KM, MIN_ERROR_M, centroid_batch, gdop_batch, pack_groups
+from lora.cluster import CLUSTER_LEADER
+from lora.propagation import PATH_LOSS_EXPONENT, RSSI_AT_1M_DBM, distance_m
+from lora.triangulation import MAX_DISTANCE_KM, process_triangulation
+
+# ==========================================
+# MULTILATERAÇÃO POR PERDA DE PERCURSO (RSSI -> DISTÂNCIA)
+# ==========================================
+# O centróide ponderado nunca sai do polígono formado pelos gateways. Aqui
+# o RSSI vira distância pelo modelo log-distância
+#
+#     RSSI = P0 - 10 n log10(d)   ->   d = 10^((P0 - RSSI) / (10 n))
+#
+# e a posição é o mínimo de Σ w (|p - g| - d)² (mínimos quadrados
+# ponderados), resolvido por Gauss-Newton num plano local em metros.
+# Peso w = 1/d²: o sombreamento é log-normal, então o erro da distância
+# cresce com ela.
+#
+# Vetorizado em lote: todos os grupos andam juntos por um número fixo de
+# iterações (sem teste de convergência por grupo) e o sistema normal 2x2
+# de cada grupo é resolvido por fórmula fechada. Parte do centróide (que
+# também fornece o corte por distância do líder); grupos com menos de
+# MIN_GATEWAYS gateways, ou cuja solução não converge para perto do
+# centróide, ficam com o próprio centróide.
+
+# P0 e n vêm de lora.propagation: os padrões (espaço livre) precisam de
+# calibração em campo (`python -m lora.propagation`), e o benchmark mede
+# também com o simulador num modelo diferente do usado pelo solver.
+
+# Desvio padrão do sombreamento (dB): piso da incerteza da distância
+SHADOWING_STD_DB = 3.0
+
+MIN_GATEWAYS = 3
+GN_ITERATIONS = 10
+# Amortecimento (Levenberg) relativo ao traço do sistema normal
+DAMPING = 1e-3
+# Passo máximo por iteração (m)
+MAX_STEP_M = 500.0
+
+METERS_PER_DEG = EARTH_RADIUS_KM * 1000.0 * math.pi / 180.0
+
+
+def _solve_slice(b, start, p0, n, iterations):
+    used = start["used"]
+    m = used.sum(axis=1)
+    lat0 = start["lat"][:, None]
+    lon0 = start["lon"][:, None]
+    k_lon = METERS_PER_DEG * np.cos(np.radians(lat0))
+
+    # Gateways no plano local (origem no centróide)
+    gx = np.where(used, (b.lon - lon0) * k_lon, 0.0)
+    gy = np.where(used, (b.lat - lat0) * METERS_PER_DEG, 0.0)
+    dist = distance_m(np.where(used, b.rssi, p0), p0, n)
+    w = np.where(used, 1.0 / dist ** 2, 0.0)
+
+    x = np.zeros(len(b))
+    y = np.zeros(len(b))
+    for _ in range(iterations):
+        dx = x[:, None] - gx
+        dy = y[:, None] - gy
+        rho = np.maximum(np.hypot(dx, dy), 1e-3)
+        ux, uy = dx / rho, dy / rho
+        res = rho - dist
+        a00 = (w * ux * ux).sum(axis=1)
+        a01 = (w * ux * uy).sum(axis=1)
+        a11 = (w * uy * uy).sum(axis=1)
+        b0 = (w * ux * res).sum(axis=1)
+        b1 = (w * uy * res).sum(axis=1)
+        lam = DAMPING * (a00 + a11)
+        d00, d11 = a00 + lam, a11 + lam
+        det = d00 * d11 - a01 * a01
+        det = np.where(det > 0, det, np.inf)
+        sx = -(d11 * b0 - a01 * b1) / det
+        sy = -(d00 * b1 - a01 * b0) / det
+        step = np.hypot(sx, sy)
+        scale = np.minimum(1.0, MAX_STEP_M / np.maximum(step, 1e-12))
+        x += sx * scale
+        y += sy * scale
+
+    # Incerteza: s² A⁻¹, com s² (erro relativo da distância) nunca abaixo do sombreamento
+    dx = x[:, None] - gx
+    dy = y[:, None] - gy
+    rho = np.maximum(np.hypot(dx, dy), 1e-3)
+    ux, uy = dx / rho, dy / rho
+    a00 = (w * ux * ux).sum(axis=1)
+    a01 = (w * ux * uy).sum(axis=1)
+    a11 = (w * uy * uy).sum(axis=1)
+    det = a00 * a11 - a01 * a01
+    dof = np.maximum(m - 2, 1)
+    s2 = (w * (rho - dist) ** 2).sum(axis=1) / dof
+    s2 = np.maximum(s2, (SHADOWING_STD_DB * math.log(10) / (10.0 * n)) ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error = np.sqrt(s2 * (a00 + a11) / det)
+
+    solved = (start["ok"] & (m >= MIN_GATEWAYS) & np.isfinite(x) & np.isfinite(y)
+              & np.isfinite(error) & (det > 0)
+              & (np.hypot(x, y) < MAX_DISTANCE_KM * 1000.0))
+    lat = np.where(solved, lat0[:, 0] + y / METERS_PER_DEG, start["lat"])
+    lon = np.where(solved, lon0[:, 0] + x / k_lon[:, 0], start["lon"])
+    error = np.where(solved, np.maximum(error, MIN_ERROR_M), start["error"])
+    gdop = np.where(solved, gdop_batch(b.lat, b.lon, used, lat, lon), start["gdop"])
+    return {"lat": lat, "lon": lon, "error": error, "gdop": gdop, "ok": start["ok"], "solved": solved}
+
+
+def multilaterate_batch(batch, p0=RSSI_AT_1M_DBM, n=PATH_LOSS_EXPONENT, iterations=GN_ITERATIONS,
+                        batch_groups=BATCH_GROUPS, cluster_mode=CLUSTER_LEADER):
+    """
+    Multilateração de todos os grupos de um GroupBatch. Retorna dict de
+    arrays: lat, lon, error, gdop (na posição final), ok (grupo aceito pelo
+    centróide) e solved (posição veio do Gauss-Newton; False = ficou o centróide).
+    """
+    parts = []
+    for i in range(0, len(batch), batch_groups):
+        b = batch.slice(i, i + batch_groups)
+        parts.append(_solve_slice(b, centroid_batch(b, batch_groups, cluster_mode), p0, n, iterations))
+    if not parts:
+        empty = np.zeros(0)
+        return {"lat": empty, "lon": empty, "error": empty, "gdop": empty,
+                "ok": np.zeros(0, dtype=bool), "solved": np.zeros(0, dtype=bool)}
+    return {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+
+def multilaterate(gateway_positions_raw, p0=RSSI_AT_1M_DBM, n=PATH_LOSS_EXPONENT, cluster_mode=CLUSTER_LEADER):
+    """
+    Um grupo só, no mesmo formato de retorno de `process_triangulation`
+    (mais 'method': "multilateration" ou "centroid" quando não deu para resolver).
+    """
+    result, error_msg = process_triangulation(gateway_positions_raw, cluster_mode)
+    if error_msg:
+        return None, error_msg
+    solution = multilaterate_batch(pack_groups([(None, None, gateway_positions_raw)]), p0, n,
+                                   cluster_mode=cluster_mode)
+    solved = bool(solution["solved"][0])
+    result.update({
+        "lat": float(solution["lat"][0]),
+        "lon": float(solution["lon"][0]),
+        "error": float(solution["error"][0]),
+        "gdop": float(solution["gdop"][0]),
+        "method": "multilateration" if solved else "centroid",
+    })
+    return result, None
+
+
+# ==========================================
+# BENCHMARK (python -m lora.multilateration)
+# ==========================================
+
+def main():
+    import argparse
+    import time
+
+    from lora.propagation import calibration_samples, fit_path_loss
+    from lora.simulator import GatewaySimulator
+
+    parser = argparse.ArgumentParser(description="Multilateração em lote vs. centróide (dados simulados)")
+    parser.add_argument("--groups", type=int, default=20000)
+    parser.add_argument("--gateways", type=int, default=5)
+    parser.add_argument("--p0", type=float, default=RSSI_AT_1M_DBM, help="P0 do solver (dBm a 1 m)")
+    parser.add_argument("--n", type=float, default=PATH_LOSS_EXPONENT, help="Expoente de perda do solver")
+    # O simulador usa por padrão um modelo diferente do solver, como uma instalação não calibrada
+    parser.add_argument("--sim-p0", type=float, default=-45.0, help="P0 verdadeiro (simulador)")
+    parser.add_argument("--sim-n", type=float, default=2.7, help="Expoente verdadeiro (simulador)")
+    args = parser.parse_args()
+
+    sim = GatewaySimulator(n_devices=1000, gateways_per_uplink=args.gateways, seed=1,
+                           p0=args.sim_p0, path_loss_exponent=args.sim_n)
+    serials = list(sim.devices)
+    groups, truth = [], []
+    for i in range(args.groups):
+        serial = serials[i % len(serials)]
+        packets = sim.uplink(serial, now=i)
+        groups.append((serial, packets[0]['data']['sequenceNumber'], packets))
+        truth.append(sim.devices[serial])
+    truth = np.array(truth)
+
+    begin = time.perf_counter()
+    for _, _, packets in groups:
+        process_triangulation(packets)
+    loop_s = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    batch = pack_groups(groups)
+    pack_s = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    cen = centroid_batch(batch)
+    cen_s = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    mlt = multilaterate_batch(batch, args.p0, args.n)
+    mlt_s = time.perf_counter() - begin
+
+    # Calibração como em campo: uplinks de alguns dispositivos em posição conhecida
+    reference = [p for (serial, _, packets) in groups[:200] for p in packets]
+    samples = []
+    for serial in {p['serial'] for p in reference}:
+        samples += calibration_samples([p for p in reference if p['serial'] == serial], *sim.devices[serial])
+    cal_p0, cal_n, _ = fit_path_loss(samples)
+    calibrated = multilaterate_batch(batch, cal_p0, cal_n)
+
+    def err_m(res):
+        d_lat = (res["lat"] - truth[:, 0]) * METERS_PER_DEG
+        d_lon = (res["lon"] - truth[:, 1]) * METERS_PER_DEG * np.cos(np.radians(truth[:, 0]))
+        return np.hypot(d_lat, d_lon)[res["ok"]]
+
+    g = len(groups)
+    print(f"{g} grupos x {args.gateways} gateways | modelo verdadeiro P0 {args.sim_p0:g}, n {args.sim_n:g} | "
+          f"solver P0 {args.p0:g}, n {args.n:g} | calibrado P0 {cal_p0:.1f}, n {cal_n:.2f}")
+    print(f"process_triangulation (laço): {g / loop_s:,.0f} grupos/s")
+    print(f"empacotamento: {g / pack_s:,.0f} grupos/s | centróide em lote: {g / cen_s:,.0f} grupos/s | "
+          f"multilateração em lote: {g / mlt_s:,.0f} grupos/s ({mlt['solved'].mean() * 100:.1f}% resolvidos)")
+    for name, res in (("centróide", cen), ("multilateração", mlt), ("multilateração calibrada", calibrated)):
+        e = err_m(res)
+        print(f"Erro {name}: mediana {np.median(e):.1f} m | p90 {np.percentile(e, 90):.1f} m")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import json
+import time
+
+from lora.battery import BatteryTrend, analyze_battery_packet, is_battery_packet
+from lora.cluster import CLUSTER_LEADER
+from lora.grid import DensityGrid
+from lora.kalman import KalmanTracker
+from lora.metrics import (BATTERY_REPORTS, ESTIMATES, GROUPS_EMITTED, PACKETS_INVALID, PACKETS_PROCESSED,
+                          STAGE_LATENCY)
+from lora.stationary import StationaryCache
+from lora.triangulation import PacketGrouper, process_triangulation
+
+# ==========================================
+# PIPELINE DE PROCESSAMENTO CONTÍNUO
+# ==========================================
+# Recebe pacotes um a um (ingestão, replay, watcher) e mantém o estado por
+# dispositivo: grupos de sequência em aberto, grade de densidade, filtro de
+# Kalman da trilha e tendência de bateria. Não é thread-safe: quem usa
+# garante que só uma thread chama os métodos (a ingestão usa um executor
+# de 1 thread).
+#
+# Com `stationary_tol_db`, grupos de dispositivos parados (mesmos gateways,
+# RSSI dentro da tolerância) reaproveitam a estimativa anterior em vez de
+# triangular de novo (ver lora.stationary); stats["reused"]/["updated"]
+# contam os atalhos. Com `reliability` (lora.reliability), a triangulação
+# mantém estatísticas por gateway e descarta ou reduz o peso dos ruins.
+# Com `geofences` (GeofenceMonitor, lora.geofence), cada estimativa é
+# avaliada contra as cercas e gera saídas ("geofence", evento).
+#
+# `export_devices`/`import_devices` transferem o estado por serial entre
+# instâncias (resharding em lora.sharding). A grade, as estatísticas e a
+# confiabilidade dos gateways são agregados da instância e não se movem.
+
+# Um grupo (serial, sequência) sem pacote novo por este tempo é fechado
+GROUP_TIMEOUT_S = 2.0
+
+_TRIANGULATION_LATENCY = STAGE_LATENCY.labels(stage="triangulation")
+_BATTERY_LATENCY = STAGE_LATENCY.labels(stage="battery")
+
+
+class Pipeline:
+
+    def __init__(self, store=None, group_timeout_s=GROUP_TIMEOUT_S, cluster_mode=CLUSTER_LEADER,
+                 stationary_tol_db=None, reliability=None, geofences=None):
+        self.store = store
+        self.group_timeout_s = group_timeout_s
+        self.cluster_mode = cluster_mode
+        self.reliability = reliability
+        self.geofences = geofences
+        self.stationary = None
+        if stationary_tol_db is not None:
+            self.stationary = StationaryCache(stationary_tol_db, cluster_mode, reliability)
+        self.grouper = PacketGrouper()
+        self.grid = DensityGrid()
+        self.tracker = KalmanTracker()
+        self.battery = {}
+        self.stats = {
+            "packets": 0, "invalid": 0, "groups": 0, "estimates": 0, "rejected": 0, "battery": 0,
+            "reused": 0, "updated": 0, "geofence_events": 0,
+        }
+
+    def feed(self, packet, now=None):
+        """
+        Processa um pacote (dict ou texto JSON). Retorna a lista de saídas
+        geradas: ("estimate", resultado), ("battery", resultado) ou
+        ("geofence", evento).
+        """
+        now = time.monotonic() if now is None else now
+        self.stats["packets"] += 1
+        PACKETS_PROCESSED.inc()
+        try:
+            if isinstance(packet, (str, bytes)): packet = json.loads(packet)
+            if is_battery_packet(packet):
+                return [self._battery(packet)]
+            return self._estimates(self.grouper.add(packet, now))
+        except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+            self.stats["invalid"] += 1
+            PACKETS_INVALID.inc()
+            return []
+
+    def flush_idle(self, now=None):
+        """Fecha grupos parados há mais de `group_timeout_s`."""
+        now = time.monotonic() if now is None else now
+        outputs = self._estimates(self.grouper.flush_idle(now - self.group_timeout_s))
+        if self.store is not None:
+            self.store.flush()
+        return outputs
+
+    def flush(self):
+        outputs = self._estimates(self.grouper.flush())
+        if self.store is not None:
+            self.store.flush()
+        return outputs
+
+    def export_devices(self, moving):
+        """
+        Retira e devolve o estado dos seriais com `moving(serial)` verdadeiro:
+        grupo em aberto, trilha do Kalman, tendência de bateria, âncora de
+        dispositivo parado e cercas ocupadas.
+        """
+        state = {"groups": {}, "tracks": {}, "battery": {}, "anchors": {}, "fences": {}}
+        for serial in [s for s in self.grouper.pending if moving(s)]:
+            state["groups"][serial] = self.grouper.pending.pop(serial)
+        state["tracks"] = self.tracker.export_rows([s for s in self.tracker.serials if moving(s)])
+        for serial in [s for s in self.battery if moving(s)]:
+            state["battery"][serial] = self.battery.pop(serial)
+        if self.stationary is not None:
+            for serial in [s for s in self.stationary.anchors if moving(s)]:
+                state["anchors"][serial] = self.stationary.anchors.pop(serial)
+        if self.geofences is not None:
+            for serial in [s for s in self.geofences.inside if moving(s)]:
+                state["fences"][serial] = self.geofences.inside.pop(serial)
+        return state
+
+    def import_devices(self, state):
+        """Recebe o estado de `export_devices` de outra instância."""
+        self.grouper.pending.update(state["groups"])
+        self.tracker.import_rows(state["tracks"])
+        self.battery.update(state["battery"])
+        if self.stationary is not None:
+            self.stationary.anchors.update(state["anchors"])
+        if self.geofences is not None:
+            self.geofences.inside.update(state["fences"])
+
+    def _battery(self, packet):
+        start = time.perf_counter()
+        result = analyze_battery_packet(packet)
+        trend = self.battery.get(result['serial'])
+        if trend is None:
+            trend = self.battery[result['serial']] = BatteryTrend()
+        trend.add(result)
+        self.stats["battery"] += 1
+        BATTERY_REPORTS.inc()
+        _BATTERY_LATENCY.observe(time.perf_counter() - start)
+        return ("battery", result)
+
+    def _estimates(self, groups):
+        outputs = []
+        for serial, sequence, packets in groups:
+            self.stats["groups"] += 1
+            GROUPS_EMITTED.inc()
+            start = time.perf_counter()
+            if self.stationary is not None:
+                result, error_msg = self.stationary.triangulate(serial, packets)
+            else:
+                result, error_msg = process_triangulation(packets, self.cluster_mode, self.reliability)
+            _TRIANGULATION_LATENCY.observe(time.perf_counter() - start)
+            if error_msg:
+                self.stats["rejected"] += 1
+                continue
+            if result.get('stationary') in ("reused", "updated"):
+                self.stats[result['stationary']] += 1
+            result['sequence'] = sequence
+            # Posição suavizada pela trilha do dispositivo (erro da triangulação como ruído)
+            result['filtered'] = self.tracker.update(
+                serial, result['lat'], result['lon'], result['error'], result['timestamp'])
+            self.grid.add_result(result)
+            if self.store is not None:
+                self.store.add(result)
+            self.stats["estimates"] += 1
+            ESTIMATES.inc()
+            outputs.append(("estimate", result))
+            if self.geofences is not None:
+                events = self.geofences.evaluate(result, serial)
+                self.stats["geofence_events"] += len(events)
+                outputs.extend(("geofence", event) for event in events)
+        return outputs
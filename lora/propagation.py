@@ -0,0 +1,116 @@
+import math
+
+import numpy as np
+
+# ==========================================
+# MODELO DE PROPAGAÇÃO (LOG-DISTÂNCIA)
+# ==========================================
+#
+#     RSSI = P0 - 10 n log10(d)        (d em metros, P0 = RSSI a 1 m)
+#
+# Definição única usada pela multilateração (RSSI -> distância), pela
+# confiabilidade dos gateways (resíduo do RSSI) e pelo simulador.
+#
+# Os padrões são de espaço livre (-40 dBm a 1 m, n = 2) e servem só de
+# ponto de partida: numa instalação real n fica tipicamente entre 2,7 e 4
+# (área urbana, vegetação) e P0 depende da potência e das antenas. Sem
+# calibração a multilateração erra as distâncias de forma sistemática.
+# Calibrar com pacotes de um dispositivo parado em posição conhecida:
+#
+#     python -m lora.propagation log.json --lat -8.01 --lon -48.46
+#
+# que ajusta P0 e n por mínimos quadrados (`fit_path_loss`). Os valores
+# entram na Aba 1 (multilateração), em `python -m lora.multilateration
+# --p0/--n` e nos construtores que recebem `p0`/`n`.
+
+RSSI_AT_1M_DBM = -40.0
+PATH_LOSS_EXPONENT = 2.0
+# Distância mínima do modelo (m): evita log de ~0
+MIN_DISTANCE_M = 1.0
+EARTH_RADIUS_M = 6371000.0
+
+
+def distance_m(rssi, p0=RSSI_AT_1M_DBM, n=PATH_LOSS_EXPONENT):
+    """Distância (m) correspondente ao RSSI (escalar, lista ou array; p0/n também podem ser arrays)."""
+    return 10.0 ** ((p0 - np.asarray(rssi, dtype=float)) / (10.0 * n))
+
+
+def expected_rssi(dist_m, p0=RSSI_AT_1M_DBM, n=PATH_LOSS_EXPONENT):
+    """RSSI esperado (dBm) a `dist_m` metros."""
+    return p0 - 10.0 * n * math.log10(max(dist_m, MIN_DISTANCE_M))
+
+
+def fit_path_loss(samples):
+    """
+    Ajuste por mínimos quadrados de P0 e n a partir de pares (distância em m,
+    RSSI). Retorna (p0, n, desvio dos resíduos em dB). Levanta ValueError
+    com menos de 3 amostras ou sem variação de distância.
+    """
+    xs = [-10.0 * math.log10(max(d, MIN_DISTANCE_M)) for d, _ in samples]
+    ys = [float(r) for _, r in samples]
+    count = len(xs)
+    if count < 3:
+        raise ValueError("São necessárias pelo menos 3 amostras para calibrar")
+    mean_x = sum(xs) / count
+    mean_y = sum(ys) / count
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if sxx <= 1e-9:
+        raise ValueError("As amostras precisam de gateways a distâncias diferentes")
+    n = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    p0 = mean_y - n * mean_x
+    residual = math.sqrt(sum((y - p0 - n * x) ** 2 for x, y in zip(xs, ys)) / max(count - 2, 1))
+    return p0, n, residual
+
+
+def calibration_samples(packets, lat, lon):
+    """(distância, RSSI) de cada relatório válido de um dispositivo parado em (lat, lon)."""
+    from lora.triangulation import GATEWAY_COORDINATE_DIVISOR, parse_gateway_report
+
+    samples = []
+    for packet in packets:
+        try:
+            report = parse_gateway_report(packet)
+        except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+            continue
+        if report is None or report['rssi'] is None or report['fix_state'] < 2:
+            continue
+        g_lat = math.radians(report['lat_raw'] / GATEWAY_COORDINATE_DIVISOR)
+        g_lon = math.radians(report['lon_raw'] / GATEWAY_COORDINATE_DIVISOR)
+        d_lat = g_lat - math.radians(lat)
+        d_lon = g_lon - math.radians(lon)
+        a = math.sin(d_lat / 2) ** 2 + math.cos(math.radians(lat)) * math.cos(g_lat) * math.sin(d_lon / 2) ** 2
+        samples.append((2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a))), float(report['rssi'])))
+    return samples
+
+
+# ==========================================
+# CALIBRAÇÃO (python -m lora.propagation)
+# ==========================================
+
+def main():
+    import argparse
+
+    from lora.reader import iter_packets
+
+    parser = argparse.ArgumentParser(
+        description="Calibra P0 e n com os relatórios de um dispositivo parado em posição conhecida")
+    parser.add_argument("log", help="Arquivo de log (JSON, NDJSON ou .gz)")
+    parser.add_argument("--lat", type=float, required=True, help="Latitude real do dispositivo")
+    parser.add_argument("--lon", type=float, required=True, help="Longitude real do dispositivo")
+    parser.add_argument("--serial", help="Usa só os pacotes deste serial")
+    args = parser.parse_args()
+
+    with open(args.log, "rb") as f:
+        packets = [p for p in iter_packets(f)
+                   if isinstance(p, dict) and (args.serial is None or p.get('serial') == args.serial)]
+    samples = calibration_samples(packets, args.lat, args.lon)
+    p0, n, residual = fit_path_loss(samples)
+    distances = sorted(d for d, _ in samples)
+    print(f"{len(samples)} relatórios, gateways de {distances[0]:.0f} a {distances[-1]:.0f} m")
+    print(f"P0 = {p0:.1f} dBm a 1 m | n = {n:.2f} | desvio dos resíduos {residual:.1f} dB "
+          f"(padrão: P0 = {RSSI_AT_1M_DBM:g}, n = {PATH_LOSS_EXPONENT:g})")
+    print(f"Use: python -m lora.multilateration --p0 {p0:.1f} --n {n:.2f} (ou os mesmos valores na Aba 1)")
+
+
+if __name__ == "__main__":
+    main()
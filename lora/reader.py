@@ -0,0 +1,72 @@
+import codecs
+import gzip
+import json
+import re
+
+# ==========================================
+# LEITURA EM STREAMING DE LOGS (JSON / NDJSON / GZIP)
+# ==========================================
+# Lê pacotes de um arquivo em blocos de CHUNK_BYTES, sem carregar o texto
+# inteiro nem montar a lista completa: a memória de pico fica limitada ao
+# bloco + o maior registro. Aceita os mesmos formatos de
+# `parse_packets_text` (lista JSON de objetos, NDJSON, objetos colados
+# '}{', objeto formatado em várias linhas), com ou sem gzip.
+
+CHUNK_BYTES = 1024 * 1024
+# Um registro (pacote) maior que isso é tratado como arquivo inválido
+MAX_RECORD_CHARS = 4 * 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+_decoder = json.JSONDecoder()
+# Espaços, vírgulas e colchetes entre os objetos de nível superior
+_SEPARATORS = re.compile(r"[\s,\[\]]*")
+
+
+def open_packet_stream(fileobj):
+    """Devolve um leitor binário, descomprimindo se o arquivo for gzip."""
+    head = fileobj.read(2)
+    fileobj.seek(0)
+    if head == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    return fileobj
+
+
+def iter_packet_batches(fileobj, chunk_bytes=CHUNK_BYTES):
+    """
+    Percorre o arquivo (binário, com seek) em blocos. Para cada bloco gera
+    (pacotes completos, bytes do arquivo original já lidos), o que serve
+    para barra de progresso também em arquivos gzip.
+    Levanta ValueError se encontrar JSON inválido.
+    """
+    stream = open_packet_stream(fileobj)
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    eof = False
+    while not eof:
+        chunk = stream.read(chunk_bytes)
+        eof = not chunk
+        buf += text.decode(chunk, final=eof)
+        packets = []
+        pos = 0
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            try:
+                obj, pos = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(f"JSON inválido: {e.msg} (perto de '{buf[pos:pos + 40]}')") from e
+                # Registro incompleto: espera o próximo bloco
+                break
+            packets.append(obj)
+        buf = buf[pos:]
+        if len(buf) > MAX_RECORD_CHARS:
+            raise ValueError(f"Registro com mais de {MAX_RECORD_CHARS} caracteres (JSON inválido?)")
+        yield packets, fileobj.tell()
+
+
+def iter_packets(fileobj, chunk_bytes=CHUNK_BYTES):
+    """Pacotes um a um, na ordem do arquivo."""
+    for packets, _ in iter_packet_batches(fileobj, chunk_bytes):
+        yield from packets
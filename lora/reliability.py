@@ -0,0 +1,274 @@
+import math
+
+from lora.fingerprint import GATEWAY_KEY_QUANTUM, gateway_key
+from lora.propagation import PATH_LOSS_EXPONENT, RSSI_AT_1M_DBM, distance_m, expected_rssi
+from lora.triangulation import MAX_DISTANCE_KM
+
+# ==========================================
+# CONFIABILIDADE POR GATEWAY (JANELAS MÓVEIS)
+# ==========================================
+# Alguns gateways mandam fixState ruim ou RSSI inflado o tempo todo e a
+# triangulação redescobre isso a cada pacote. Aqui cada gateway (chave =
+# posição quantizada, como no mapa de rádio) tem três médias móveis
+# exponenciais com janela efetiva de WINDOW relatórios, O(1) de memória:
+#
+#   - aceitação: fração dos relatórios com Fix 2D/3D e RSSI;
+#   - outlier: fração dos relatórios válidos a mais de MAX_DISTANCE_KM da
+#     posição final do grupo (reflexão, gateway com posição errada);
+#   - viés de RSSI (dB): resíduo do gateway no modelo de perda de percurso
+#     menos a média do resíduo dos outros gateways do grupo (a potência de
+#     transmissão do dispositivo se cancela). O resíduo é medido numa
+#     posição refinada por alguns passos de Gauss-Newton a partir do
+#     centróide, como na multilateração: o centróide puxa a posição para
+#     dentro da malha e faria os gateways da borda parecerem inflados.
+#
+# Antes do passo do líder (O(n²)), `trust(chave)` decide: 0 = descarta
+# (outlier acima de MAX_OUTLIER_RATE), peso reduzido (aceitação abaixo de
+# MIN_ACCEPT_RATE: multiplica pela aceitação; viés acima de BIAS_TOL_DB:
+# multiplica por 10^(-viés/10), que desfaz a inflação no peso em mW) ou 1.
+# Nada é decidido antes de MIN_SAMPLES relatórios. Gateways descartados
+# continuam sendo observados, então voltam quando melhoram.
+
+WINDOW = 200
+MIN_SAMPLES = 20
+MIN_ACCEPT_RATE = 0.5
+MAX_OUTLIER_RATE = 0.5
+BIAS_TOL_DB = 3.0
+
+REFINE_ITERATIONS = 5
+# O viés (a parte cara: Gauss-Newton + log) é amostrado em 1 a cada N grupos
+BIAS_SAMPLE_EVERY = 4
+METERS_PER_DEG = 111195.0
+
+
+class GatewayStats:
+    __slots__ = ("reports", "accept_rate", "valid", "outlier_rate", "bias_samples", "rssi_bias_db")
+
+    def __init__(self):
+        self.reports = 0
+        self.accept_rate = 0.0
+        self.valid = 0
+        self.outlier_rate = 0.0
+        self.bias_samples = 0
+        self.rssi_bias_db = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _ewma(mean, sample, count, window):
+    """Média exata nas primeiras `window` amostras, exponencial depois."""
+    return mean + (sample - mean) / min(count, window)
+
+
+class GatewayReliability:
+    """
+    Estatísticas por gateway alimentadas por `process_triangulation(...,
+    reliability=...)`. Com enforce=False só observa (trust sempre 1).
+    `p0`/`n`: modelo de propagação (lora.propagation) do resíduo de RSSI.
+    """
+
+    def __init__(self, window=WINDOW, enforce=True, quantum=GATEWAY_KEY_QUANTUM,
+                 p0=RSSI_AT_1M_DBM, n=PATH_LOSS_EXPONENT):
+        self.window = window
+        self.enforce = enforce
+        self.quantum = quantum
+        self.p0 = p0
+        self.n = n
+        self.gateways = {}
+        self.groups = 0
+
+    def key(self, lat_raw, lon_raw):
+        return gateway_key(lat_raw, lon_raw, self.quantum)
+
+    def _stats(self, key):
+        stats = self.gateways.get(key)
+        if stats is None:
+            stats = self.gateways[key] = GatewayStats()
+        return stats
+
+    def observe_report(self, key, accepted):
+        """Relatório com posição: aceito (Fix 2D/3D + RSSI) ou não."""
+        s = self._stats(key)
+        s.reports += 1
+        s.accept_rate = _ewma(s.accept_rate, 1.0 if accepted else 0.0, s.reports, self.window)
+
+    def trust(self, key):
+        """0 = descartar, (0, 1) = multiplicar o peso, 1 = normal."""
+        if not self.enforce:
+            return 1.0
+        s = self.gateways.get(key)
+        if s is None or s.reports < MIN_SAMPLES:
+            return 1.0
+        if s.valid >= MIN_SAMPLES and s.outlier_rate > MAX_OUTLIER_RATE:
+            return 0.0
+        trust = 1.0
+        if s.accept_rate < MIN_ACCEPT_RATE:
+            trust = s.accept_rate
+        if s.bias_samples >= MIN_SAMPLES and s.rssi_bias_db > BIAS_TOL_DB:
+            trust *= 10 ** (-s.rssi_bias_db / 10.0)
+        return trust
+
+    def observe_group(self, gateways, used, lat, lon):
+        """
+        Depois da estimativa: `gateways` são os válidos do grupo (dicts com
+        'key', 'lat', 'lon', 'rssi', inclusive os descartados por `trust`),
+        `used` os que entraram no centróide e (lat, lon) a posição final.
+        """
+        # Distâncias de poucos km: projeção equiretangular basta
+        k_lon = METERS_PER_DEG * math.cos(math.radians(lat))
+        for g in gateways:
+            s = self._stats(g['key'])
+            s.valid += 1
+            dist_m = math.hypot((g['lat'] - lat) * METERS_PER_DEG, (g['lon'] - lon) * k_lon)
+            outlier = dist_m > MAX_DISTANCE_KM * 1000.0
+            s.outlier_rate = _ewma(s.outlier_rate, 1.0 if outlier else 0.0, s.valid, self.window)
+        self.groups += 1
+        if len(used) < 3 or self.groups % BIAS_SAMPLE_EVERY:
+            return
+
+        # Viés relativo aos companheiros de cluster (usados no centróide)
+        lat, lon = _refine_position(used, lat, lon, self.p0, self.n)
+        residuals = []
+        for g in gateways:
+            dist_m = math.hypot((g['lat'] - lat) * METERS_PER_DEG, (g['lon'] - lon) * k_lon)
+            residuals.append(g['rssi'] - expected_rssi(dist_m, self.p0, self.n))
+        used_ids = {id(g) for g in used}
+        mates = [r for g, r in zip(gateways, residuals) if id(g) in used_ids]
+        total = sum(mates)
+        for g, r in zip(gateways, residuals):
+            is_mate = id(g) in used_ids
+            others = len(mates) - is_mate
+            if others < 2:
+                continue
+            reference = (total - r * is_mate) / others
+            s = self.gateways[g['key']]
+            s.bias_samples += 1
+            s.rssi_bias_db = _ewma(s.rssi_bias_db, r - reference, s.bias_samples, self.window)
+
+    def suspects(self):
+        """Gateways que hoje seriam descartados ou teriam o peso reduzido: {chave: (trust, stats)}."""
+        enforce, self.enforce = self.enforce, True
+        try:
+            return {key: (self.trust(key), s.as_dict()) for key, s in self.gateways.items() if self.trust(key) < 1.0}
+        finally:
+            self.enforce = enforce
+
+
+def _refine_position(gateways, lat, lon, p0=RSSI_AT_1M_DBM, n=PATH_LOSS_EXPONENT):
+    """Alguns passos de Gauss-Newton (versão escalar de lora.multilateration) a partir de (lat, lon)."""
+    k_lon = METERS_PER_DEG * math.cos(math.radians(lat))
+    points = []
+    for g in gateways:
+        dist = distance_m(g['rssi'], p0, n)
+        points.append(((g['lon'] - lon) * k_lon, (g['lat'] - lat) * METERS_PER_DEG, dist, 1.0 / (dist * dist)))
+    x = y = 0.0
+    for _ in range(REFINE_ITERATIONS):
+        a00 = a01 = a11 = b0 = b1 = 0.0
+        for gx, gy, dist, w in points:
+            dx, dy = x - gx, y - gy
+            rho = max(math.hypot(dx, dy), 1e-3)
+            ux, uy = dx / rho, dy / rho
+            a00 += w * ux * ux
+            a01 += w * ux * uy
+            a11 += w * uy * uy
+            b0 += w * ux * (rho - dist)
+            b1 += w * uy * (rho - dist)
+        lam = 1e-3 * (a00 + a11)
+        a00 += lam
+        a11 += lam
+        det = a00 * a11 - a01 * a01
+        if det <= 0:
+            break
+        sx = -(a11 * b0 - a01 * b1) / det
+        sy = -(a00 * b1 - a01 * b0) / det
+        scale = min(1.0, 500.0 / max(math.hypot(sx, sy), 1e-12))
+        x += sx * scale
+        y += sy * scale
+    if math.hypot(x, y) > MAX_DISTANCE_KM * 1000.0:
+        return lat, lon
+    return lat + y / METERS_PER_DEG, lon + x / k_lon
+
+
+# ==========================================
+# BENCHMARK (python -m lora.reliability)
+# ==========================================
+
+def main():
+    import argparse
+    import random
+    import time
+
+    from lora.simulator import GatewaySimulator, random_gateways
+    from lora.triangulation import GATEWAY_COORDINATE_DIVISOR, process_triangulation
+
+    parser = argparse.ArgumentParser(description="Confiabilidade por gateway (dados simulados com gateways ruins)")
+    parser.add_argument("--groups", type=int, default=20000)
+    parser.add_argument("--bad", type=int, default=6, help="Gateways ruins de cada tipo")
+    args = parser.parse_args()
+
+    gateways = random_gateways(80, spread_deg=0.03, seed=11)
+    sim = GatewaySimulator(n_devices=500, gateways_per_uplink=6, spread_deg=0.025, seed=4, gateways=gateways)
+    rnd = random.Random(5)
+    # Posição em 1e-5 graus (o simulador arredonda a posição do gateway no relatório)
+    def at(lat_raw, lon_raw):
+        return round(lat_raw / 100), round(lon_raw / 100)
+
+    raw = [(int(lat * GATEWAY_COORDINATE_DIVISOR), int(lon * GATEWAY_COORDINATE_DIVISOR)) for lat, lon in gateways]
+    picks = rnd.sample(range(len(raw)), 3 * args.bad)
+    inflated = {at(*raw[i]) for i in picks[:args.bad]}
+    flaky = {at(*raw[i]) for i in picks[args.bad:2 * args.bad]}
+    # Posição errada: o relatório diz estar a ~3 km do lugar real
+    misplaced = {at(*raw[i]): (raw[i][0] + 270000, raw[i][1]) for i in picks[2 * args.bad:]}
+
+    serials = list(sim.devices)
+    groups, truth = [], []
+    for i in range(args.groups):
+        serial = serials[i % len(serials)]
+        packets = sim.uplink(serial, now=i)
+        for p in packets:
+            pos = p['data']['gatewayPosition'][0]
+            where = at(pos['latitude'], pos['longitude'])
+            if where in inflated:
+                p['data']['loraRadio']['RSSI'] += 12
+            elif where in flaky and rnd.random() < 0.7:
+                p['data']['gatewayGps']['fixState'] = "FS_NO_FIX"
+            elif where in misplaced:
+                pos['latitude'], pos['longitude'] = misplaced[where]
+        groups.append(packets)
+        truth.append(sim.devices[serial])
+
+    def run(reliability):
+        errors = []
+        begin = time.perf_counter()
+        for packets, (t_lat, t_lon) in zip(groups, truth):
+            res, _ = process_triangulation(packets, reliability=reliability)
+            if res is not None:
+                errors.append(math.hypot(res['lat'] - t_lat, (res['lon'] - t_lon) * math.cos(math.radians(t_lat)))
+                              * 111195.0)
+        elapsed = time.perf_counter() - begin
+        # Metade final: estatísticas já aquecidas
+        tail = sorted(errors[len(errors) // 2:])
+        return elapsed, tail[len(tail) // 2], tail[int(0.9 * (len(tail) - 1))]
+
+    names = {"sem estatísticas": None, "só observando": GatewayReliability(enforce=False),
+             "descartando/reduzindo": GatewayReliability()}
+    for name, reliability in names.items():
+        elapsed, median, p90 = run(reliability)
+        print(f"{name:22s}: {len(groups) / elapsed:,.0f} grupos/s | erro (2ª metade) mediana {median:.1f} m | "
+              f"p90 {p90:.1f} m")
+
+    found = names["descartando/reduzindo"].suspects()
+    bad_keys = {gateway_key(*k): kind for kinds, kind in (
+        ([raw[i] for i in picks[:args.bad]], "RSSI inflado"),
+        ([raw[i] for i in picks[args.bad:2 * args.bad]], "fix ruim"),
+        (misplaced.values(), "posição errada")) for k in kinds}
+    hits = sum(1 for k in found if k in bad_keys)
+    print(f"Suspeitos: {len(found)} ({hits} de {len(bad_keys)} ruins, {len(found) - hits} falsos positivos)")
+    for kind in ("RSSI inflado", "fix ruim", "posição errada"):
+        keys = [k for k, v in bad_keys.items() if v == kind]
+        print(f"  {kind}: {sum(1 for k in keys if k in found)}/{len(keys)} detectados")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+
+import folium
+from folium import plugins
+
+# ==========================================
+# RENDERIZAÇÃO DOS MAPAS (FOLIUM)
+# ==========================================
+
+# Acima deste número de pontos desenhados, o mapa troca os objetos
+# individuais (Marker/CircleMarker) por uma única camada GeoJSON.
+FAST_RENDER_THRESHOLD = 300
+
+# Estilo de cada tipo de ponto na camada GeoJSON (lido pelo JS via 'k')
+POINT_STYLES = {
+    "gateway": {"color": "blue", "radius": 5, "fillOpacity": 0.8},
+    "sample": {"color": "gray", "radius": 3, "fillOpacity": 0.5},
+}
+
+# Desenha cada Feature como circleMarker no canvas, com estilo e tooltip
+# vindos das propriedades (evita um objeto JS por ponto no HTML).
+POINT_TO_LAYER_JS = """
+function(feature, latlng) {
+    var styles = %s;
+    var p = feature.properties;
+    var s = styles[p.k];
+    var tip = p.k === "gateway"
+        ? "Gateway (RSSI: " + p.r + "dBm)"
+        : "Amostra (Erro: " + p.e.toFixed(1) + "m)";
+    return L.circleMarker(latlng, {
+        radius: s.radius, color: s.color, fill: true, fillOpacity: s.fillOpacity, weight: 1
+    }).bindTooltip(tip);
+}
+""" % json.dumps(POINT_STYLES)
+
+
+def use_fast_render(point_count, fast=None):
+    """Decide o modo de renderização (None = automático pelo limite)."""
+    if fast is None:
+        return point_count > FAST_RENDER_THRESHOLD
+    return fast
+
+
+def points_to_geojson(gateways=(), samples=()):
+    """
+    Serializa gateways e amostras em um único FeatureCollection.
+    Coordenadas arredondadas em 8 casas (~1 mm) para enxugar o HTML.
+    """
+    features = []
+    for gw in gateways:
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(gw['lon'], 8), round(gw['lat'], 8)]},
+            "properties": {"k": "gateway", "r": gw['rssi']},
+        })
+    for p in samples:
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(float(p['lon']), 8), round(float(p['lat']), 8)]},
+            "properties": {"k": "sample", "e": round(float(p['error']), 2)},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def add_points_layer(m, gateways=(), samples=()):
+    """Adiciona todos os pontos ao mapa como uma camada GeoJSON só."""
+    folium.GeoJson(
+        points_to_geojson(gateways, samples),
+        name="Pontos",
+        point_to_layer=folium.JsCode(POINT_TO_LAYER_JS),
+    ).add_to(m)
+
+
+def build_triangulation_map(res, fast=None):
+    """Mapa da Aba 1: gateways usados, posição estimada e círculo de incerteza."""
+    gateways = res['gateways_used']
+    fast = use_fast_render(len(gateways), fast)
+
+    m = folium.Map(location=[res['lat'], res['lon']], zoom_start=16, prefer_canvas=fast)
+
+    # Círculo de incerteza
+    folium.Circle(
+        location=[res['lat'], res['lon']], radius=float(res['error']),
+        color="red", fill=True, fill_opacity=0.2
+    ).add_to(m)
+
+    # Gateways usados (Azul)
+    if fast:
+        add_points_layer(m, gateways=gateways)
+    else:
+        for gw in gateways:
+            folium.Marker(
+                [gw['lat'], gw['lon']],
+                tooltip=f"Gateway (RSSI: {gw['rssi']}dBm)",
+                icon=folium.Icon(color="blue", icon="wifi", prefix='fa')
+            ).add_to(m)
+
+    # Posição Estimada (Vermelho)
+    folium.Marker(
+        [res['lat'], res['lon']],
+        tooltip="Posição Estimada",
+        icon=folium.Icon(color="red", icon="star")
+    ).add_to(m)
+
+    return m
+
+
+def build_super_position_map(points, final_res, fast=None):
+    """Mapa da Aba 2: amostras acumuladas e área final da super posição."""
+    fast = use_fast_render(len(points), fast)
+    final_lat = float(final_res['final_latitude'])
+    final_lon = float(final_res['final_longitude'])
+
+    # Ajuste de zoom
+    lats = [p['lat'] for p in points] + [final_lat]
+    lons = [p['lon'] for p in points] + [final_lon]
+    sw = [min(lats), min(lons)]
+    ne = [max(lats), max(lons)]
+
+    m = folium.Map(location=[final_lat, final_lon], prefer_canvas=fast)
+    m.fit_bounds([sw, ne])
+
+    # Pontos individuais (Cinza)
+    if fast:
+        add_points_layer(m, samples=points)
+    else:
+        for p in points:
+            folium.CircleMarker(
+                location=[float(p['lat']), float(p['lon'])],
+                radius=3, color="gray", fill=True, fill_opacity=0.5,
+                tooltip=f"Amostra (Erro: {p['error']:.1f}m)"
+            ).add_to(m)
+
+    # Área Final (Verde)
+    folium.Circle(
+        location=[final_lat, final_lon],
+        radius=float(final_res['final_error_radius_m']),
+        color="green", weight=3, fill=True, fill_color="green", fill_opacity=0.3,
+        tooltip="Área de Confiança Final"
+    ).add_to(m)
+
+    folium.Marker(
+        [final_lat, final_lon],
+        tooltip="SUPER POSIÇÃO",
+        icon=folium.Icon(color="green", icon="flag")
+    ).add_to(m)
+
+    return m
+
+
+# Cor da célula da grade pela contagem relativa (amarelo -> vermelho)
+DENSITY_STYLE_JS = """
+function(feature) {
+    var t = feature.properties.t;
+    var g = Math.round(220 * (1 - t));
+    return {color: "rgb(200," + g + ",0)", weight: 1, fillColor: "rgb(255," + g + ",0)", fillOpacity: 0.25 + 0.45 * t};
+}
+"""
+
+
+def density_geojson(cells):
+    """Células da grade como polígonos, com contagem, erro médio e intensidade 't' (0-1)."""
+    max_count = max((c['count'] for c in cells), default=1)
+    features = []
+    for c in cells:
+        (south, west), (north, east) = c['bounds']
+        ring = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[round(v, 7) for v in pt] for pt in ring]]},
+            "properties": {
+                "quadkey": c['quadkey'],
+                "count": c['count'],
+                "mean_error": round(c['mean_error'], 1),
+                "t": round(c['count'] / max_count, 3),
+            },
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def build_density_layer(cells):
+    """FeatureGroup com as células agregadas (trocada sem recriar o mapa base)."""
+    fg = folium.FeatureGroup(name="Densidade")
+    folium.GeoJson(
+        density_geojson(cells),
+        style=folium.JsCode(DENSITY_STYLE_JS),
+        tooltip=folium.GeoJsonTooltip(fields=["count", "mean_error"], aliases=["Estimativas", "Erro médio (m)"]),
+    ).add_to(fg)
+    return fg
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def build_track_map(track, frames):
+    """
+    Mapa da trilha de um dispositivo: linha simplificada estática e
+    reprodução no navegador (slider de tempo) a partir dos quadros.
+    """
+    coords = [[p['lat'], p['lon']] for p in track]
+    m = folium.Map(location=coords[-1], prefer_canvas=True)
+    m.fit_bounds([[min(c[0] for c in coords), min(c[1] for c in coords)],
+                  [max(c[0] for c in coords), max(c[1] for c in coords)]])
+
+    folium.PolyLine(coords, color="gray", weight=2, opacity=0.5, tooltip="Trilha (simplificada)").add_to(m)
+    folium.CircleMarker(coords[0], radius=5, color="green", fill=True, tooltip="Início").add_to(m)
+    folium.CircleMarker(coords[-1], radius=5, color="red", fill=True, tooltip="Fim").add_to(m)
+
+    # Reprodução: a linha cresce pelos vértices e o marcador segue os quadros
+    features = [{
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": [[p['lon'], p['lat']] for p in track]},
+        "properties": {"times": [_iso(p['timestamp']) for p in track], "style": {"color": "blue", "weight": 3}},
+    }]
+    for f in frames:
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [f['lon'], f['lat']]},
+            "properties": {"times": [_iso(f['timestamp'])], "icon": "circle",
+                           "iconstyle": {"color": "red", "fillColor": "red", "fillOpacity": 0.9, "radius": 6}},
+        })
+
+    if len(frames) > 1:
+        step_s = max(1, int(round(frames[1]['timestamp'] - frames[0]['timestamp'])))
+    else:
+        step_s = 1
+    plugins.TimestampedGeoJson(
+        {"type": "FeatureCollection", "features": features},
+        period=f"PT{step_s}S", duration=f"PT{step_s}S", add_last_point=False,
+        auto_play=False, loop=False, time_slider_drag_update=True,
+    ).add_to(m)
+    return m
+
+
+def result_hash(*parts):
+    """Hash estável (sha1) de resultados serializáveis em JSON, usado como chave de cache."""
+    payload = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def map_html(m):
+    """HTML completo e autônomo do mapa (pronto para um iframe)."""
+    return m.get_root().render()
+
+
+def measure_map(m):
+    """Renderiza o mapa para HTML e mede tamanho (bytes) e tempo (ms)."""
+    start = time.perf_counter()
+    html = map_html(m)
+    elapsed_ms = (time.perf_counter() - start) * 1000.0
+    return {"html_bytes": len(html.encode('utf-8')), "render_ms": elapsed_ms}
+
+
+# ==========================================
+# BENCHMARK (python -m lora.render)
+# ==========================================
+
+def main():
+    import random
+
+    print("Pontos | Modo       | HTML (KB) | Build+Render (ms)")
+    print("-" * 52)
+    for n in (100, 1000, 5000):
+        rnd = random.Random(n)
+        points = [
+            {"lat": -8.0135 + rnd.uniform(-0.01, 0.01), "lon": -48.4653 + rnd.uniform(-0.01, 0.01),
+             "error": rnd.uniform(10, 90)}
+            for _ in range(n)
+        ]
+        final_res = {"final_latitude": -8.0135, "final_longitude": -48.4653, "final_error_radius_m": 20.0}
+        for fast in (False, True):
+            start = time.perf_counter()
+            stats = measure_map(build_super_position_map(points, final_res, fast=fast))
+            total_ms = (time.perf_counter() - start) * 1000.0
+            mode = "GeoJSON" if fast else "Marcadores"
+            print(f"{n:6d} | {mode:10s} | {stats['html_bytes'] / 1024:9.1f} | {total_ms:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
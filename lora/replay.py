@@ -0,0 +1,224 @@
+import asyncio
+import json
+import math
+import socket
+import sys
+import threading
+import time
+
+from lora.archive import ArchiveReader
+from lora.grid import DensityGrid
+from lora.ingest import IngestService
+from lora.triangulation import PacketGrouper, process_triangulation
+
+# ==========================================
+# REPLAY DE PACOTES ARQUIVADOS
+# ==========================================
+# Lê um arquivo .lpa (mmap) e reenvia os pacotes a um consumidor qualquer
+# (função que recebe o pacote) respeitando o intervalo original entre eles,
+# dividido por `speed`. speed=None envia o mais rápido possível.
+#
+# Atraso (lag) = quanto o envio de cada pacote ficou atrás do horário
+# agendado. Lag crescente significa que o consumidor não acompanha a taxa.
+#
+# Consumidores prontos: PrintConsumer (NDJSON na saída), AggregateConsumer
+# (triangulação + grade) e IngestConsumer (serviço de ingestão, lora.ingest).
+# No IngestConsumer o envio não bloqueia, então o lag do replay fica perto
+# de zero; o atraso de quem consome é a latência da própria ingestão
+# (recebimento -> pipeline), devolvida por `close()`.
+
+
+class ReplayStats:
+    def __init__(self):
+        self.packets = 0
+        self.elapsed_s = 0.0
+        self.lags = []
+
+    @property
+    def throughput(self):
+        return self.packets / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    def lag_percentile(self, q):
+        if not self.lags:
+            return 0.0
+        ordered = sorted(self.lags)
+        return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+    def summary(self):
+        text = f"{self.packets} pacotes em {self.elapsed_s:.2f} s ({self.throughput:,.0f} pacotes/s)"
+        if not self.lags:
+            # Modo "o mais rápido possível": não há horário agendado para medir lag
+            return text
+        max_lag = max(self.lags)
+        return (
+            f"{text} | lag p50 {self.lag_percentile(50) * 1000:.1f} ms, p99 {self.lag_percentile(99) * 1000:.1f} ms, "
+            f"máx {max_lag * 1000:.1f} ms"
+        )
+
+
+def replay(path, consumer, speed=1.0, since=None, until=None, serial=None,
+           clock=time.monotonic, sleep=time.sleep):
+    """
+    Reenvia os pacotes do arquivo para `consumer(packet)`.
+    Retorna ReplayStats com vazão alcançada e lag do consumidor.
+    """
+    stats = ReplayStats()
+    paced = speed is not None and speed > 0
+    with ArchiveReader(path) as reader:
+        start = clock()
+        first_ts = None
+        for packet in reader.iter_packets(since, until, serial):
+            target = None
+            ts = packet['data'].get('deviceDateTime')
+            if paced and ts is not None and not math.isnan(ts):
+                if first_ts is None:
+                    first_ts = ts
+                target = start + (ts - first_ts) / speed
+                delay = target - clock()
+                if delay > 0:
+                    sleep(delay)
+
+            consumer(packet)
+            stats.packets += 1
+            if target is not None:
+                stats.lags.append(max(0.0, clock() - target))
+        stats.elapsed_s = clock() - start
+    return stats
+
+
+# ==========================================
+# CONSUMIDORES PRONTOS
+# ==========================================
+
+class PrintConsumer:
+    """Escreve cada pacote como uma linha NDJSON."""
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+
+    def __call__(self, packet):
+        self.out.write(json.dumps(packet) + "\n")
+
+
+class AggregateConsumer:
+    """Agrupa por (serial, sequência), triangula e alimenta uma DensityGrid."""
+
+    def __init__(self, grid=None):
+        self.grouper = PacketGrouper()
+        self.grid = grid if grid is not None else DensityGrid()
+        self.groups = 0
+        self.rejected = 0
+
+    def __call__(self, packet):
+        for group in self.grouper.add(packet):
+            self._process(group)
+
+    def flush(self):
+        for group in self.grouper.flush():
+            self._process(group)
+
+    def _process(self, group):
+        _, _, packets = group
+        self.groups += 1
+        result, error_msg = process_triangulation(packets)
+        if error_msg:
+            self.rejected += 1
+        else:
+            self.grid.add_result(result)
+
+
+class IngestConsumer:
+    """
+    Entrega os pacotes ao serviço de ingestão. Com `address` (host, porta),
+    envia um datagrama UDP por pacote a um `python -m lora.ingest` já
+    rodando; sem endereço, sobe um IngestService local numa thread com o
+    seu event loop e entrega pelo mesmo `offer` do UDP.
+    """
+
+    def __init__(self, address=None):
+        self.address = address
+        self.service = None
+        if address is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            return
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="replay-ingest", daemon=True)
+        self._thread.start()
+        self.service = IngestService()
+        asyncio.run_coroutine_threadsafe(self.service.start(), self.loop).result()
+
+    def __call__(self, packet):
+        raw = json.dumps(packet).encode("utf-8")
+        if self.service is None:
+            self.sock.sendto(raw, self.address)
+        else:
+            # A fila do asyncio não é thread-safe: o offer roda no loop do serviço
+            self.loop.call_soon_threadsafe(self.service.offer, raw, "replay")
+
+    def close(self):
+        """
+        Espera a ingestão local processar tudo e encerra. Retorna
+        IngestService.stats() (None no modo UDP, em que o serviço é outro).
+        """
+        if self.service is None:
+            self.sock.close()
+            return None
+        asyncio.run_coroutine_threadsafe(self.service.stop(), self.loop).result()
+        stats = self.service.stats()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        return stats
+
+
+# ==========================================
+# LINHA DE COMANDO (python -m lora.replay)
+# ==========================================
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay de pacotes arquivados (.lpa)")
+    parser.add_argument("arquivo")
+    parser.add_argument("--speed", type=float, default=1.0, help="Fator sobre o tempo real (padrão 1x)")
+    parser.add_argument("--max", action="store_true", help="O mais rápido possível (ignora --speed)")
+    parser.add_argument("--consumer", choices=["print", "aggregate", "ingest", "none"], default="print")
+    parser.add_argument("--ingest-addr", metavar="HOST:PORTA",
+                        help="Com --consumer ingest: envia por UDP a um lora.ingest já rodando "
+                             "(sem isso, usa um serviço de ingestão local)")
+    parser.add_argument("--serial")
+    parser.add_argument("--since", type=float, help="Timestamp inicial (epoch s)")
+    parser.add_argument("--until", type=float, help="Timestamp final (epoch s)")
+    args = parser.parse_args()
+
+    if args.consumer == "print":
+        consumer = PrintConsumer()
+    elif args.consumer == "aggregate":
+        consumer = AggregateConsumer()
+    elif args.consumer == "ingest":
+        address = None
+        if args.ingest_addr:
+            host, _, port = args.ingest_addr.rpartition(":")
+            address = (host or "127.0.0.1", int(port))
+        consumer = IngestConsumer(address)
+    else:
+        consumer = lambda packet: None
+
+    stats = replay(args.arquivo, consumer, speed=None if args.max else args.speed,
+                   since=args.since, until=args.until, serial=args.serial)
+
+    if isinstance(consumer, AggregateConsumer):
+        consumer.flush()
+        print(f"Grupos: {consumer.groups} | Rejeitados: {consumer.rejected} | "
+              f"Estimativas na grade: {consumer.grid.total}", file=sys.stderr)
+    elif isinstance(consumer, IngestConsumer):
+        ingest = consumer.close()
+        if ingest is not None:
+            print(f"Ingestão: processados {ingest['processed']} | descartados {ingest['dropped']} | "
+                  f"erros {ingest['errors']} | latência p50 {ingest['latency_p50_ms']:.2f} ms, "
+                  f"p99 {ingest['latency_p99_ms']:.2f} ms", file=sys.stderr)
+    print(stats.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
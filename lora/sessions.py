@@ -0,0 +1,247 @@
+import math
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from lora.metrics import SESSION_BYTES, SESSIONS_ACTIVE
+
+# ==========================================
+# LISTAS DE CLUSTERING POR SESSÃO (NO SERVIDOR, COM LIMITE)
+# ==========================================
+# A lista de pontos para a super posição ficava em st.session_state com o
+# resultado inteiro de cada triangulação (inclusive 'gateways_used') e nunca
+# era liberada: no servidor compartilhado a memória crescia até o restart.
+#
+# O SessionStore (um por processo, compartilhado entre as sessões) guarda
+# por sessão só o que a consolidação, os mapas e a tabela usam: lat, lon,
+# erro, timestamp e GDOP numa matriz float64 (40 bytes por ponto) e o
+# serial como índice numa tabela da sessão. Os detalhes dos gateways não
+# ficam na memória (o SQLite e a trilha guardam a estimativa).
+#
+# Limites:
+#  - max_points por sessão: ao passar, saem os pontos mais antigos;
+#  - ttl_s: sessão sem acesso por esse tempo é descartada;
+#  - max_sessions: ao passar, sai a sessão usada há mais tempo.
+# O pior caso de memória é max_sessions × max_points × ~44 bytes (~44 MB
+# com os padrões), contra ~1-3 kB por ponto antes.
+
+MAX_POINTS = 5000
+SESSION_TTL_S = 2 * 3600
+MAX_SESSIONS = 200
+
+COLUMNS = ("lat", "lon", "error", "timestamp", "gdop")
+_INITIAL_CAPACITY = 64
+
+
+def slim_result(res):
+    """Só os campos que a lista de clustering guarda (COLUMNS e 'serial')."""
+    return {c: res.get(c) for c in COLUMNS + ("serial",)}
+
+
+def _float(value):
+    # Campo ausente ou não numérico (ex.: timestamp em texto) vira NaN
+    try:
+        return math.nan if value is None else float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class PointList:
+    """
+    Pontos enxutos de uma sessão. `points()` devolve dicts com as chaves de
+    COLUMNS e 'serial' (None no lugar de NaN), no formato que
+    `consolidate_super_position` e os mapas esperam.
+    """
+
+    def __init__(self, max_points=MAX_POINTS):
+        self.max_points = max_points
+        self.values = np.empty((_INITIAL_CAPACITY, len(COLUMNS)))
+        self.serial_ids = np.empty(_INITIAL_CAPACITY, dtype=np.int32)
+        self.serials = []
+        self._serial_index = {}
+        self.n = 0
+        # Muda a cada alteração: quem guarda derivados da lista compara a versão
+        self.version = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self.n
+
+    def _serial_id(self, serial):
+        sid = self._serial_index.get(serial)
+        if sid is None:
+            sid = self._serial_index[serial] = len(self.serials)
+            self.serials.append(serial)
+        return sid
+
+    def extend(self, results):
+        """Acrescenta estimativas (dicts com lat/lon/error); mantém só as `max_points` mais recentes."""
+        rows = [[_float(r.get(c)) for c in COLUMNS] for r in results]
+        if not rows:
+            return
+        ids = [self._serial_id(r.get('serial')) for r in results]
+        if len(rows) > self.max_points:
+            rows, ids = rows[-self.max_points:], ids[-self.max_points:]
+        overflow = self.n + len(rows) - self.max_points
+        if overflow > 0:
+            # Descarta os mais antigos (cópia de no máximo max_points linhas)
+            keep = self.n - overflow
+            self.values[:keep] = self.values[overflow:self.n]
+            self.serial_ids[:keep] = self.serial_ids[overflow:self.n]
+            self.n = keep
+            self.evicted += overflow
+        needed = self.n + len(rows)
+        if needed > len(self.values):
+            capacity = min(max(needed, 2 * len(self.values)), self.max_points)
+            self.values = np.concatenate([self.values[:self.n], np.empty((capacity - self.n, len(COLUMNS)))])
+            self.serial_ids = np.concatenate([self.serial_ids[:self.n],
+                                              np.empty(capacity - self.n, dtype=np.int32)])
+        self.values[self.n:needed] = rows
+        self.serial_ids[self.n:needed] = ids
+        self.n = needed
+        if len(self.serials) > self.max_points:
+            self._compact_serials()
+        self.version += 1
+
+    def _compact_serials(self):
+        # Seriais que só tinham pontos já descartados saem da tabela
+        used, inverse = np.unique(self.serial_ids[:self.n], return_inverse=True)
+        self.serials = [self.serials[i] for i in used.tolist()]
+        self._serial_index = {serial: i for i, serial in enumerate(self.serials)}
+        self.serial_ids[:self.n] = inverse
+
+    def append(self, result):
+        self.extend([result])
+
+    def replace(self, results):
+        self.clear()
+        self.extend(results)
+
+    def clear(self):
+        self.n = 0
+        self.serials = []
+        self._serial_index = {}
+        self.values = np.empty((_INITIAL_CAPACITY, len(COLUMNS)))
+        self.serial_ids = np.empty(_INITIAL_CAPACITY, dtype=np.int32)
+        self.version += 1
+
+    def points(self):
+        serials = self.serials
+        out = []
+        for row, sid in zip(self.values[:self.n].tolist(), self.serial_ids[:self.n].tolist()):
+            p = {c: (None if v != v else v) for c, v in zip(COLUMNS, row)}
+            p['serial'] = serials[sid]
+            out.append(p)
+        return out
+
+    def last(self):
+        """Último ponto (lat, lon) ou None."""
+        if not self.n:
+            return None
+        return float(self.values[self.n - 1, 0]), float(self.values[self.n - 1, 1])
+
+    @property
+    def nbytes(self):
+        """Memória ocupada pela sessão (arrays + tabela de seriais)."""
+        return (self.values.nbytes + self.serial_ids.nbytes + sys.getsizeof(self.serials)
+                + sum(sys.getsizeof(s) for s in self.serials))
+
+
+class SessionStore:
+    """Listas de clustering de todas as sessões, com limite de pontos, TTL e número de sessões."""
+
+    def __init__(self, max_points=MAX_POINTS, ttl_s=SESSION_TTL_S, max_sessions=MAX_SESSIONS):
+        self.max_points = max_points
+        self.ttl_s = ttl_s
+        self.max_sessions = max_sessions
+        # session_id -> [PointList, último acesso]; ordem = uso mais recente no fim
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"expired": 0, "evicted": 0}
+        SESSIONS_ACTIVE.set_function(lambda: len(self._sessions))
+        SESSION_BYTES.set_function(self.nbytes)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id, now=None):
+        """Lista da sessão (criada vazia se não existe ou expirou)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = self._sessions[session_id] = [PointList(self.max_points), now]
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.stats["evicted"] += 1
+            else:
+                entry[1] = now
+                self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def drop(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _expire(self, now):
+        # Ordem de uso: as expiradas estão todas no começo
+        while self._sessions:
+            session_id, (_, last) = next(iter(self._sessions.items()))
+            if now - last < self.ttl_s:
+                break
+            del self._sessions[session_id]
+            self.stats["expired"] += 1
+
+    def nbytes(self):
+        with self._lock:
+            return sum(points.nbytes for points, _ in self._sessions.values())
+
+
+# ==========================================
+# BENCHMARK (python -m lora.sessions)
+# ==========================================
+
+def main():
+    import argparse
+    import tracemalloc
+
+    from lora.simulator import GatewaySimulator
+    from lora.triangulation import consolidate_super_position, process_triangulation
+
+    parser = argparse.ArgumentParser(description="Memória da lista de clustering por sessão")
+    parser.add_argument("--points", type=int, default=MAX_POINTS)
+    parser.add_argument("--gateways", type=int, default=8)
+    args = parser.parse_args()
+
+    sim = GatewaySimulator(n_devices=50, gateways_per_uplink=args.gateways, seed=9)
+    serials = list(sim.devices)
+    results = [process_triangulation(sim.uplink(serials[i % len(serials)], now=i))[0] for i in range(args.points)]
+
+    tracemalloc.start()
+    full = [dict(r) for r in results]
+    for r in full:
+        r['gateways_used'] = [dict(g) for g in r['gateways_used']]
+    full_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    points = PointList(args.points)
+    tracemalloc.start()
+    points.extend(results)
+    slim_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    begin = time.perf_counter()
+    slim = points.points()
+    points_ms = (time.perf_counter() - begin) * 1000
+    same = consolidate_super_position(slim) == consolidate_super_position(results)
+    print(f"{args.points} pontos com {args.gateways} gateways: resultado inteiro {full_bytes / 1e6:.2f} MB | "
+          f"enxuto {slim_bytes / 1e6:.2f} MB (nbytes {points.nbytes / 1e6:.2f} MB) | "
+          f"points() em {points_ms:.1f} ms | super posição igual: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from collections import defaultdict
+
+from lora import metrics
+from lora.grid import DensityGrid
+from lora.pipeline import Pipeline
+
+# ==========================================
+# PIPELINE PARTICIONADO POR SERIAL (VÁRIOS PROCESSOS)
+# ==========================================
+# Um processo só não dá conta do estado da frota inteira (grupos em aberto,
+# trilhas do Kalman, bateria) nem usa mais de um núcleo. O ShardedPipeline
+# tem a mesma interface do Pipeline (feed, flush_idle, flush, stats) e
+# distribui os pacotes entre N processos de trabalho pelo serial: cada
+# processo tem o seu Pipeline e é o único dono do estado dos seus seriais.
+#
+# Roteamento por hash consistente (ShardRing): cada shard ocupa VNODES
+# pontos num anel de 64 bits e o serial vai para o primeiro ponto depois
+# do seu hash. Mudar de N para N+1 shards move só ~1/(N+1) dos seriais.
+#
+# Comunicação por filas de multiprocessing (pipe + pickle): o roteador
+# junta os pacotes de cada shard em lotes de BATCH_PACKETS (o texto JSON
+# segue como chegou; o roteador só o decodifica para achar o serial) e
+# todos os shards respondem numa fila única de saída. A ordem das saídas é a de
+# chegada de cada shard (a ordem entre seriais de shards diferentes não é
+# garantida; a de um mesmo serial é). Cada shard aceita no máximo
+# MAX_INFLIGHT_BATCHES lotes sem resposta: o roteador espera em vez de
+# acumular memória. `flush_idle` e `flush` são barreiras: devolvem as
+# saídas de todos os pacotes entregues antes.
+#
+# `resize(n)` muda o número de shards sem perder estado: quem deixou de ser
+# dono de um serial exporta o estado dele (Pipeline.export_devices) e o novo
+# dono importa, com grupos em aberto e trilhas continuando de onde pararam.
+# Shards removidos entregam a grade e as estatísticas, somadas às dos
+# ativos em `grid()` e `stats`. A confiabilidade dos gateways
+# (lora.reliability) é aprendida em cada shard e não migra. As métricas
+# (lora.metrics) de cada processo ficam nele.
+#
+# Uma exceção num pacote ou comando não derruba o shard: o pacote é
+# descartado (ou o comando responde vazio), o erro vai para o log e é
+# contado em stats["errors"] e em lora_processing_errors_total{stage="shard"}.
+
+VNODES = 64
+BATCH_PACKETS = 256
+MAX_INFLIGHT_BATCHES = 8
+# Sem mensagem por este tempo, confere se algum shard morreu
+REPLY_POLL_S = 1.0
+
+# Resposta que o pai espera para cada comando
+_REPLIES = {
+    "feed": "done", "flush_idle": "flushed", "flush": "flushed", "stats": "stats",
+    "grid": "grid", "export": "state", "import": "ack", "stop": "stopped",
+}
+_SHARD_ERRORS = metrics.PROCESSING_ERRORS.labels(stage="shard")
+
+log = logging.getLogger(__name__)
+
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+class ShardRing:
+    """Anel de hash consistente: serial -> shard em [0, n_shards)."""
+
+    def __init__(self, n_shards, vnodes=VNODES):
+        if n_shards < 1:
+            raise ValueError("n_shards deve ser >= 1")
+        self.n_shards = n_shards
+        self.vnodes = vnodes
+        points = sorted((_hash64(f"shard-{shard}-{v}"), shard) for shard in range(n_shards) for v in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, serial):
+        i = bisect.bisect(self._hashes, _hash64(str(serial)))
+        return self._shards[i % len(self._shards)]
+
+
+def _worker(shard, inbox, outbox, db_path, pipeline_kwargs):
+    """Laço de um shard: executa os comandos da fila de entrada na ordem."""
+    # Ctrl+C chega a todo o grupo de processos; quem encerra os shards é o pai (flush + stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    store = None
+    if db_path:
+        from lora.storage import EstimateStore
+        store = EstimateStore(db_path)
+    pipeline = Pipeline(store=store, **pipeline_kwargs)
+    pipeline.stats["errors"] = 0
+
+    def failed(message, *args):
+        pipeline.stats["errors"] += 1
+        _SHARD_ERRORS.inc()
+        log.exception("Shard %d: " + message, shard, *args)
+
+    while True:
+        command, arg = inbox.get()
+        reply = _REPLIES[command]
+        # Com exceção, o shard responde o mesmo tipo com um resultado vazio
+        # (o pai conta lotes em voo e espera as barreiras) e continua vivo
+        if command == "feed":
+            payload = []
+            for packet, now in arg:
+                try:
+                    payload.extend(pipeline.feed(packet, now))
+                except Exception:
+                    failed("pacote descartado")
+        else:
+            try:
+                payload = _execute(pipeline, shard, command, arg, store)
+            except Exception:
+                failed("comando %r falhou", command)
+                payload = _empty_reply(pipeline, command)
+        outbox.put((reply, shard, payload))
+        if command == "stop":
+            return
+
+
+def _execute(pipeline, shard, command, arg, store):
+    if command == "flush_idle":
+        return pipeline.flush_idle(arg)
+    if command == "flush":
+        return pipeline.flush()
+    if command == "stats":
+        return dict(pipeline.stats)
+    if command == "grid":
+        return pipeline.grid
+    if command == "export":
+        ring = ShardRing(*arg)
+        return pipeline.export_devices(lambda serial: ring.shard_for(serial) != shard)
+    if command == "import":
+        pipeline.import_devices(arg)
+        return None
+    if command == "stop":
+        if store is not None:
+            store.close()
+        return {"stats": dict(pipeline.stats), "grid": pipeline.grid}
+    raise ValueError(f"Comando desconhecido: {command}")
+
+
+def _empty_reply(pipeline, command):
+    if command == "stats":
+        return dict(pipeline.stats)
+    if command == "grid":
+        return DensityGrid()
+    if command == "export":
+        return {}
+    if command == "stop":
+        return {"stats": dict(pipeline.stats), "grid": pipeline.grid}
+    return [] if command in ("flush_idle", "flush") else None
+
+
+class ShardedPipeline:
+    """
+    Pipeline com o estado particionado por serial em `n_shards` processos
+    (padrão: um por núcleo). `pipeline_kwargs` vão para o Pipeline de cada
+    shard (cada um recebe uma cópia de reliability/geofences); com `db_path`
+    cada shard grava no mesmo SQLite. Use `close()` (ou `with`) no fim.
+    """
+
+    def __init__(self, n_shards=None, db_path=None, batch_packets=BATCH_PACKETS, vnodes=VNODES,
+                 **pipeline_kwargs):
+        self.db_path = db_path
+        self.batch_packets = batch_packets
+        self.pipeline_kwargs = pipeline_kwargs
+        self.ring = ShardRing(n_shards or os.cpu_count() or 1, vnodes)
+        # spawn: seguro mesmo quando o processo pai tem threads (ingestão, Streamlit)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._outbox = self._ctx.Queue()
+        self._workers = {}
+        self._buffers = {}
+        self._inflight = {}
+        self._replies = {}
+        self._outputs = []
+        # Estado entregue por shards removidos e pacotes que nem chegaram a um shard
+        self._retired_stats = defaultdict(int)
+        self._retired_grid = DensityGrid()
+        for shard in range(self.ring.n_shards):
+            self._start(shard)
+
+    @property
+    def n_shards(self):
+        return self.ring.n_shards
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- Processos ---
+
+    def _start(self, shard):
+        inbox = self._ctx.Queue()
+        process = self._ctx.Process(target=_worker, name=f"lora-shard-{shard}", daemon=True,
+                                    args=(shard, inbox, self._outbox, self.db_path, self.pipeline_kwargs))
+        process.start()
+        self._workers[shard] = (process, inbox)
+        self._buffers[shard] = []
+        self._inflight[shard] = 0
+
+    def _handle(self, message):
+        kind, shard, payload = message
+        if kind == "done":
+            self._inflight[shard] -= 1
+            self._outputs.extend(payload)
+            return
+        if kind == "flushed":
+            self._outputs.extend(payload)
+        self._replies[(kind, shard)] = payload
+
+    def _receive(self):
+        """Espera uma mensagem da fila de saída; falha se algum shard morreu."""
+        while True:
+            try:
+                message = self._outbox.get(timeout=REPLY_POLL_S)
+                break
+            except queue.Empty:
+                dead = [s for s, (process, _) in self._workers.items() if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"shard(s) {dead} terminaram inesperadamente")
+        self._handle(message)
+
+    def _drain(self):
+        """Processa as mensagens que já chegaram, sem esperar."""
+        while True:
+            try:
+                message = self._outbox.get_nowait()
+            except queue.Empty:
+                return
+            self._handle(message)
+
+    def _request(self, command, arg=None, shards=None, reply=None):
+        """Manda o comando aos shards e espera a resposta `reply` de cada um."""
+        shards = list(self._workers) if shards is None else list(shards)
+        self._send_buffers()
+        for shard in shards:
+            self._workers[shard][1].put((command, arg))
+        wanted = [(reply or command, shard) for shard in shards]
+        while any(key not in self._replies for key in wanted):
+            self._receive()
+        return {shard: self._replies.pop((kind, shard)) for kind, shard in wanted}
+
+    def _send(self, shard):
+        batch = self._buffers[shard]
+        if not batch:
+            return
+        while self._inflight[shard] >= MAX_INFLIGHT_BATCHES:
+            self._receive()
+        self._buffers[shard] = []
+        self._inflight[shard] += 1
+        self._workers[shard][1].put(("feed", batch))
+
+    def _send_buffers(self):
+        for shard in self._workers:
+            self._send(shard)
+
+    def _take_outputs(self):
+        outputs, self._outputs = self._outputs, []
+        return outputs
+
+    # --- Interface do Pipeline ---
+
+    def feed(self, packet, now=None):
+        """
+        Encaminha um pacote (dict ou texto JSON) ao shard do serial. Retorna
+        as saídas que já voltaram dos shards (de pacotes anteriores também).
+        """
+        now = time.monotonic() if now is None else now
+        try:
+            # O texto original segue para o shard: serializar a string custa ~10x menos que o dict
+            parsed = json.loads(packet) if isinstance(packet, (str, bytes)) else packet
+            serial = parsed.get('serial')
+        except (ValueError, AttributeError):
+            self._retired_stats["packets"] += 1
+            self._retired_stats["invalid"] += 1
+            return self._take_outputs()
+        shard = self.ring.shard_for(serial)
+        buffer = self._buffers[shard]
+        buffer.append((packet, now))
+        if len(buffer) >= self.batch_packets:
+            self._send(shard)
+        self._drain()
+        return self._take_outputs()
+
+    def flush_idle(self, now=None):
+        """Fecha grupos parados em todos os shards (barreira)."""
+        now = time.monotonic() if now is None else now
+        self._request("flush_idle", now, reply="flushed")
+        return self._take_outputs()
+
+    def flush(self):
+        """Fecha todos os grupos em aberto (barreira)."""
+        self._request("flush", reply="flushed")
+        return self._take_outputs()
+
+    @property
+    def stats(self):
+        """Contadores somados de todos os shards (inclusive os já removidos)."""
+        total = defaultdict(int, self._retired_stats)
+        if self._workers:
+            for part in self._request("stats").values():
+                for key, value in part.items():
+                    total[key] += value
+        return dict(total)
+
+    def grid(self):
+        """Grade de densidade da frota: soma das grades de todos os shards."""
+        merged = DensityGrid(self._retired_grid.min_zoom, self._retired_grid.max_zoom)
+        merged.merge(self._retired_grid)
+        if self._workers:
+            for part in self._request("grid").values():
+                merged.merge(part)
+        return merged
+
+    def resize(self, n_shards):
+        """
+        Muda o número de shards. Pacotes já entregues são processados antes
+        da troca e o estado de cada serial migra para o novo dono.
+        Retorna quantos seriais mudaram de shard.
+        """
+        old = self.ring
+        ring = ShardRing(n_shards, old.vnodes)
+        for shard in range(old.n_shards, n_shards):
+            self._start(shard)
+        exported = self._request("export", (n_shards, old.vnodes), shards=range(old.n_shards), reply="state")
+
+        incoming = defaultdict(lambda: {"groups": {}, "tracks": {}, "battery": {}, "anchors": {}, "fences": {}})
+        moved = set()
+        for state in exported.values():
+            for part, devices in state.items():
+                for serial, value in devices.items():
+                    incoming[ring.shard_for(serial)][part][serial] = value
+                    moved.add(serial)
+        for shard, state in incoming.items():
+            self._workers[shard][1].put(("import", state))
+        for shard in incoming:
+            while ("ack", shard) not in self._replies:
+                self._receive()
+            del self._replies[("ack", shard)]
+
+        self._stop(range(n_shards, old.n_shards))
+        self.ring = ring
+        return len(moved)
+
+    def _stop(self, shards):
+        shards = list(shards)
+        if not shards:
+            return
+        for shard, final in self._request("stop", shards=shards, reply="stopped").items():
+            for key, value in final["stats"].items():
+                self._retired_stats[key] += value
+            self._retired_grid.merge(final["grid"])
+            process, _ = self._workers.pop(shard)
+            process.join()
+            del self._buffers[shard], self._inflight[shard]
+
+    def close(self):
+        """Encerra todos os shards (grupos em aberto se perdem: chame `flush` antes)."""
+        self._stop(list(self._workers))
+
+
+# ==========================================
+# BENCHMARK (python -m lora.sharding)
+# ==========================================
+
+def main():
+    import argparse
+
+    from lora.simulator import GatewaySimulator
+
+    parser = argparse.ArgumentParser(description="Pipeline particionado por serial (dados simulados)")
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--uplinks", type=int, default=10, help="Uplinks por dispositivo")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    sim = GatewaySimulator(n_devices=args.devices, gateways_per_uplink=5, seed=11)
+    packets = [json.dumps(p) for t in range(args.uplinks) for serial in sim.devices
+               for p in sim.uplink(serial, now=t)]
+    print(f"{len(packets)} pacotes, {args.devices} dispositivos, {os.cpu_count()} núcleo(s)")
+
+    pipeline = Pipeline()
+    begin = time.perf_counter()
+    for i, line in enumerate(packets):
+        pipeline.feed(line, now=i * 1e-3)
+    pipeline.flush()
+    single_s = time.perf_counter() - begin
+    print(f"Pipeline (1 processo): {len(packets) / single_s:,.0f} pacotes/s")
+
+    for n in args.shards:
+        with ShardedPipeline(n) as sharded:
+            begin = time.perf_counter()
+            cpu = time.process_time()
+            for i, line in enumerate(packets):
+                sharded.feed(line, now=i * 1e-3)
+            sharded.flush()
+            elapsed = time.perf_counter() - begin
+            # CPU do roteador (este processo): limita a vazão quando há um núcleo por shard
+            router_us = (time.process_time() - cpu) / len(packets) * 1e6
+            stats = sharded.stats
+        print(f"{n} shard(s): {len(packets) / elapsed:,.0f} pacotes/s | {stats['estimates']} estimativas | "
+              f"roteador {router_us:.1f} µs/pacote (teto {1e6 / router_us:,.0f} pacotes/s)")
+
+    serials = list(sim.devices)
+    for n in args.shards:
+        before, after = ShardRing(n), ShardRing(n + 1)
+        load = [0] * n
+        for serial in serials:
+            load[before.shard_for(serial)] += 1
+        moved = sum(before.shard_for(s) != after.shard_for(s) for s in serials)
+        print(f"anel {n} -> {n + 1}: {moved / len(serials) * 100:.1f}% dos seriais mudam de shard "
+              f"(ideal {100 / (n + 1):.1f}%) | carga máx/média com {n}: {max(load) / (len(serials) / n):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import math
+import random
+import time
+
+from lora.propagation import PATH_LOSS_EXPONENT, RSSI_AT_1M_DBM
+
+# ==========================================
+# SIMULADOR DE GATEWAYS (TESTES E BENCHMARK)
+# ==========================================
+# Gera relatórios no mesmo formato do hardware (data.gatewayPosition,
+# gatewayGps, loraRadio) para N dispositivos. Cada uplink de um dispositivo
+# é ouvido por `gateways_per_uplink` gateways próximos, todos com o mesmo
+# (serial, sequenceNumber).
+#
+# Por padrão cada uplink sorteia gateways novos ao redor do dispositivo.
+# Com `gateways` (lista fixa de posições, ver `random_gateways`), o uplink
+# é ouvido pelos gateways fixos mais próximos, como numa instalação real.
+# `rssi_noise_db` é o desvio do ruído do RSSI sorteado a cada uplink e
+# `p0`/`path_loss_exponent` o modelo de propagação (lora.propagation) que
+# gera o RSSI; mudar o modelo mede o efeito de parâmetros não calibrados.
+
+GATEWAY_COORDINATE_DIVISOR = 10000000.0
+
+
+def random_gateways(n, center=(-8.0135, -48.4653), spread_deg=0.05, seed=0):
+    """Posições fixas (lat, lon) de `n` gateways espalhados pela área."""
+    rnd = random.Random(seed)
+    return [(center[0] + rnd.uniform(-spread_deg, spread_deg),
+             center[1] + rnd.uniform(-spread_deg, spread_deg)) for _ in range(n)]
+
+
+class GatewaySimulator:
+
+    def __init__(self, n_devices=100, gateways_per_uplink=5, center=(-8.0135, -48.4653),
+                 spread_deg=0.05, seed=0, gateways=None, rssi_noise_db=3.0,
+                 p0=RSSI_AT_1M_DBM, path_loss_exponent=PATH_LOSS_EXPONENT):
+        self.rnd = random.Random(seed)
+        self.gateways_per_uplink = gateways_per_uplink
+        self.rssi_noise_db = rssi_noise_db
+        self.p0 = p0
+        self.path_loss_exponent = path_loss_exponent
+        self.gateways = gateways
+        self.devices = {
+            f"SIM{i:05d}": (center[0] + self.rnd.uniform(-spread_deg, spread_deg),
+                            center[1] + self.rnd.uniform(-spread_deg, spread_deg))
+            for i in range(n_devices)
+        }
+        self.sequences = {serial: 0 for serial in self.devices}
+
+    def uplink(self, serial, now=None):
+        """Relatórios de todos os gateways que ouviram um uplink do dispositivo."""
+        lat, lon = self.devices[serial]
+        seq = self.sequences[serial]
+        self.sequences[serial] = seq + 1
+        ts = int(time.time() if now is None else now)
+        nearest = None
+        if self.gateways:
+            nearest = sorted(self.gateways, key=lambda g: (g[0] - lat) ** 2 + (g[1] - lon) ** 2)
+        packets = []
+        for i in range(self.gateways_per_uplink):
+            if nearest is not None:
+                d_lat, d_lon = nearest[i][0] - lat, nearest[i][1] - lon
+            else:
+                d_lat = self.rnd.gauss(0, 0.002)
+                d_lon = self.rnd.gauss(0, 0.002)
+            # RSSI cai com a distância (10 n dB por década de metros)
+            dist_m = max(1.0, ((d_lat ** 2 + d_lon ** 2) ** 0.5) * 111320.0)
+            rssi = int(self.p0 - 10 * self.path_loss_exponent * math.log10(dist_m)
+                       + self.rnd.gauss(0, self.rssi_noise_db))
+            packets.append({
+                "serial": serial,
+                "data": {
+                    "sequenceNumber": seq,
+                    "deviceDateTime": ts,
+                    "gatewayPosition": [{
+                        "latitude": int((lat + d_lat) * GATEWAY_COORDINATE_DIVISOR),
+                        "longitude": int((lon + d_lon) * GATEWAY_COORDINATE_DIVISOR),
+                    }],
+                    "gatewayGps": {"fixState": "FS_FIX_3D"},
+                    "loraRadio": {"RSSI": rssi},
+                },
+            })
+        return packets
+
+    def packets(self):
+        """Fluxo infinito de relatórios, com os dispositivos em rodízio."""
+        while True:
+            for serial in self.devices:
+                yield from self.uplink(serial)
+
+
+# ==========================================
+# ENVIO PARA O SERVIÇO DE INGESTÃO
+# ==========================================
+
+async def _paced(packets, rate, count):
+    """Entrega (índice, pacote) no ritmo `rate` pacotes/s, em rajadas de 10 ms."""
+    start = time.monotonic()
+    for i in range(count):
+        if rate:
+            ahead = i / rate - (time.monotonic() - start)
+            if ahead > 0.01:
+                await asyncio.sleep(ahead)
+        yield i, next(packets)
+
+
+async def send_udp(host, port, rate, count, sim=None):
+    """Envia `count` relatórios por UDP (um por datagrama). Retorna quantos foram enviados."""
+    sim = sim or GatewaySimulator()
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    sent = 0
+    try:
+        async for _, packet in _paced(sim.packets(), rate, count):
+            transport.sendto(json.dumps(packet).encode("utf-8"))
+            sent += 1
+    finally:
+        transport.close()
+    return sent
+
+
+async def send_http(host, port, rate, count, sim=None, path="/uplink"):
+    """Envia `count` relatórios por HTTP POST (conexão keep-alive). Retorna respostas por status."""
+    sim = sim or GatewaySimulator()
+    reader, writer = await asyncio.open_connection(host, port)
+    statuses = {}
+    try:
+        async for _, packet in _paced(sim.packets(), rate, count):
+            body = json.dumps(packet).encode("utf-8")
+            writer.write(
+                f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body
+            )
+            status_line = await reader.readline()
+            status = int(status_line.split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            if length:
+                await reader.readexactly(length)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+    return statuses
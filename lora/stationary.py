@@ -0,0 +1,239 @@
+import json
+import math
+import time
+from collections import Counter
+
+from lora.cluster import CLUSTER_LEADER
+from lora.metrics import STATIONARY_GROUPS
+from lora.triangulation import (GATEWAY_COORDINATE_DIVISOR, calculate_haversine_distance, geometry_dop,
+                                parse_device_timestamp, parse_gateway_report, process_triangulation,
+                                weighted_position)
+
+# ==========================================
+# ATALHO PARA DISPOSITIVOS PARADOS
+# ==========================================
+# A maioria dos rastreadores fica parada por dias e cada uplink é ouvido
+# pelos mesmos gateways com quase o mesmo RSSI. Para cada serial guardamos
+# a última estimativa calculada de fato (âncora): o conjunto de gateways
+# válidos, o vetor de RSSI e quais gateways sobraram no filtro de cluster.
+#
+# Um grupo novo com o mesmo conjunto de gateways (posições idênticas):
+#   - RSSI a até `tol_db` da âncora em todos os gateways -> reaproveita a
+#     estimativa da âncora ("reused"), sem triangular;
+#   - RSSI mais diferente -> recalcula só o centróide ponderado sobre os
+#     gateways que a âncora usou ("updated"), pulando o filtro de cluster,
+#     que depende só das posições. O resultado é exato e vira a âncora.
+# Qualquer outro caso é triangulado do zero ("computed").
+#
+# A comparação é sempre com a âncora (não com o grupo anterior), então o
+# erro não acumula com o tempo. Limite do erro ao reaproveitar: cada peso
+# 10^(RSSI/10) muda por um fator em [1/a, a], a = 10^(tol/10); o pior caso
+# é toda a massa em dois extremos do conjunto usado, e o centróide anda no
+# máximo (a - 1)/(a + 1) × D, D = maior distância entre os gateways usados
+# (tol 1 dB: 0,115 D; 3 dB: 0,33 D). O raio de erro (0,85 × |max RSSI|)
+# muda no máximo 0,85 × tol m.
+#
+# No modo por densidade o cluster escolhido depende dos pesos, então o
+# atalho só vale quando a âncora usou todos os gateways válidos (um único
+# cluster, que não tem para onde mudar).
+
+STATIONARY_TOL_DB = 1.0
+
+_COMPUTED = STATIONARY_GROUPS.labels(result="computed")
+_UPDATED = STATIONARY_GROUPS.labels(result="updated")
+_REUSED = STATIONARY_GROUPS.labels(result="reused")
+
+
+def reuse_error_bound_m(diameter_m, tol_db):
+    """Deslocamento máximo (m) do centróide ao reaproveitar com tolerância `tol_db`."""
+    a = 10 ** (tol_db / 10.0)
+    return diameter_m * (a - 1) / (a + 1)
+
+
+def _gateway_diameter_m(gateways):
+    return max((calculate_haversine_distance(g1['lat'], g1['lon'], g2['lat'], g2['lon']) * 1000.0
+                for i, g1 in enumerate(gateways) for g2 in gateways[i + 1:]), default=0.0)
+
+
+class _Anchor:
+    __slots__ = ("positions", "rssi", "used", "result", "diameter_m")
+
+    def __init__(self, positions, rssi, used, result, diameter_m=None):
+        self.positions = positions
+        self.rssi = rssi
+        self.used = used
+        # Cópia: quem recebe o resultado acrescenta campos (sequence, filtered)
+        self.result = dict(result)
+        self.diameter_m = _gateway_diameter_m(result['gateways_used']) if diameter_m is None else diameter_m
+
+
+class StationaryCache:
+    """
+    Substituto de `process_triangulation` com memória por serial. O
+    resultado ganha 'stationary' ("computed", "updated" ou "reused") e, ao
+    reaproveitar, 'stationary_bound_m' (limite do deslocamento, ver acima).
+    """
+
+    def __init__(self, tol_db=STATIONARY_TOL_DB, cluster_mode=CLUSTER_LEADER, reliability=None):
+        self.tol_db = tol_db
+        self.cluster_mode = cluster_mode
+        self.reliability = reliability
+        self.anchors = {}
+        self.stats = {"computed": 0, "updated": 0, "reused": 0}
+
+    @property
+    def skip_rate(self):
+        """Fração dos grupos que não passaram pela triangulação completa."""
+        total = sum(self.stats.values())
+        return (self.stats["updated"] + self.stats["reused"]) / total if total else 0.0
+
+    def dump_anchors(self):
+        """Âncoras em listas serializáveis em JSON (snapshot, lora.snapshot)."""
+        return [[serial, a.positions, a.rssi, a.used, a.result, a.diameter_m] for serial, a in self.anchors.items()]
+
+    def load_anchors(self, rows):
+        """Substitui as âncoras pelas de `dump_anchors`."""
+        self.anchors = {serial: _Anchor(tuple(tuple(p) for p in positions), rssi, used, result, diameter_m)
+                        for serial, positions, rssi, used, result, diameter_m in rows}
+
+    def triangulate(self, serial, packets):
+        try:
+            serial_id, device_ts, reports = _parse(packets)
+        except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+            # Pacote corrompido: a triangulação completa sabe descartar
+            self.anchors.pop(serial, None)
+            return self._compute(serial, packets, None)
+
+        positions = tuple((r[0], r[1]) for r in reports)
+        rssi = [r[2] for r in reports]
+        anchor = self.anchors.get(serial)
+        if anchor is None or anchor.positions != positions:
+            return self._compute(serial, packets, reports)
+        if self.cluster_mode != CLUSTER_LEADER and not all(anchor.used):
+            return self._compute(serial, packets, reports)
+
+        timestamp = device_ts if device_ts is not None else time.time()
+        if max(abs(r - a) for r, a in zip(rssi, anchor.rssi)) <= self.tol_db:
+            result = dict(anchor.result, serial=serial_id or "Desconhecido", timestamp=timestamp,
+                          stationary="reused",
+                          stationary_bound_m=reuse_error_bound_m(anchor.diameter_m, self.tol_db))
+            self.stats["reused"] += 1
+            _REUSED.inc()
+            return result, None
+
+        gateways = [{'lat': lat_raw / GATEWAY_COORDINATE_DIVISOR, 'lon': lon_raw / GATEWAY_COORDINATE_DIVISOR,
+                     'rssi': r}
+                    for (lat_raw, lon_raw, r), used in zip(reports, anchor.used) if used]
+        if self.reliability is not None:
+            # Confiança atual dos gateways (trust 0 = peso zero)
+            for g, (lat_raw, lon_raw, _) in zip(gateways, [r for r, u in zip(reports, anchor.used) if u]):
+                trust = self.reliability.trust(self.reliability.key(lat_raw, lon_raw))
+                if trust < 1.0: g['trust'] = trust
+        position = weighted_position(gateways)
+        if position is None:
+            return self._compute(serial, packets, reports)
+        lat, lon, error, max_rssi = position
+        result = dict(anchor.result, lat=lat, lon=lon, error=error, max_rssi=max_rssi, gateways_used=gateways,
+                      gdop=geometry_dop(gateways, lat, lon), serial=serial_id or "Desconhecido",
+                      timestamp=timestamp, stationary="updated")
+        self.anchors[serial] = _Anchor(positions, rssi, anchor.used, result)
+        self.stats["updated"] += 1
+        _UPDATED.inc()
+        return result, None
+
+    def _compute(self, serial, packets, reports):
+        result, error_msg = process_triangulation(packets, self.cluster_mode, self.reliability)
+        self.stats["computed"] += 1
+        _COMPUTED.inc()
+        if error_msg:
+            self.anchors.pop(serial, None)
+            return None, error_msg
+        result['stationary'] = "computed"
+        if reports is not None:
+            # Quais gateways (na ordem da âncora) sobraram no filtro de cluster
+            remaining = Counter((g['lat'], g['lon'], g['rssi']) for g in result['gateways_used'])
+            used = []
+            for lat_raw, lon_raw, rssi in reports:
+                key = (lat_raw / GATEWAY_COORDINATE_DIVISOR, lon_raw / GATEWAY_COORDINATE_DIVISOR, rssi)
+                used.append(remaining[key] > 0)
+                remaining[key] -= 1
+            self.anchors[serial] = _Anchor(tuple((r[0], r[1]) for r in reports), [r[2] for r in reports],
+                                           used, result)
+        return result, None
+
+
+def _parse(packets):
+    """(serial, deviceDateTime do 1º pacote, [(lat_raw, lon_raw, rssi)] válidos em ordem de posição)."""
+    serial = device_ts = None
+    reports = []
+    for i, packet in enumerate(packets):
+        if isinstance(packet, str): packet = json.loads(packet)
+        if i == 0:
+            serial = packet.get('serial')
+            device_ts = parse_device_timestamp(packet.get('data', {}).get('deviceDateTime'))
+        report = parse_gateway_report(packet)
+        if report is None or report['fix_state'] < 2 or report['rssi'] is None:
+            continue
+        reports.append((report['lat_raw'], report['lon_raw'], report['rssi']))
+    reports.sort()
+    return serial, device_ts, reports
+
+
+# ==========================================
+# BENCHMARK (python -m lora.stationary)
+# ==========================================
+
+def _distance_m(res, lat, lon):
+    k_lon = math.cos(math.radians(lat))
+    return math.hypot(res['lat'] - lat, (res['lon'] - lon) * k_lon) * 111195.0
+
+
+def main():
+    import argparse
+
+    from lora.simulator import GatewaySimulator, random_gateways
+
+    parser = argparse.ArgumentParser(description="Atalho de dispositivos parados (dados simulados)")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--uplinks", type=int, default=50, help="Uplinks por dispositivo")
+    parser.add_argument("--noise", type=float, nargs="+", default=[1.0, 3.0], help="Ruído do RSSI (dB)")
+    parser.add_argument("--tol", type=float, nargs="+", default=[1.0, 2.0, 3.0], help="Tolerâncias (dB)")
+    args = parser.parse_args()
+
+    gateways = random_gateways(60, seed=7)
+    for noise in args.noise:
+        sim = GatewaySimulator(n_devices=args.devices, gateways_per_uplink=5, seed=3, gateways=gateways,
+                               rssi_noise_db=noise)
+        groups = [(serial, sim.uplink(serial, now=t)) for t in range(args.uplinks) for serial in sim.devices]
+
+        begin = time.perf_counter()
+        exact = [process_triangulation(packets)[0] for _, packets in groups]
+        full_s = time.perf_counter() - begin
+
+        for tol in args.tol:
+            cache = StationaryCache(tol)
+            begin = time.perf_counter()
+            results = [cache.triangulate(serial, packets)[0] for serial, packets in groups]
+            elapsed = time.perf_counter() - begin
+
+            shifts, ratios = [], []
+            for res, ref in zip(results, exact):
+                if res['stationary'] != "reused":
+                    continue
+                d = _distance_m(res, ref['lat'], ref['lon'])
+                shifts.append(d)
+                ratios.append(d / res['stationary_bound_m'] if res['stationary_bound_m'] > 0 else 0.0)
+            shifts.sort()
+            p99 = shifts[int(0.99 * (len(shifts) - 1))] if shifts else 0.0
+            truth_exact = sorted(_distance_m(r, *sim.devices[serial]) for r, (serial, _) in zip(exact, groups))
+            truth_cached = sorted(_distance_m(r, *sim.devices[serial]) for r, (serial, _) in zip(results, groups))
+            half = len(groups) // 2
+            print(f"ruído {noise:.0f} dB, tol {tol:.0f} dB: {cache.stats['reused'] / len(groups) * 100:5.1f}% "
+                  f"reaproveitados + {cache.stats['updated'] / len(groups) * 100:5.1f}% incrementais | "
+                  f"{elapsed / full_s * 100:5.1f}% do tempo | desvio p99 {p99:6.1f} m "
+                  f"(máx {max(ratios, default=0.0) * 100:.1f}% do limite) | erro real mediano "
+                  f"{truth_exact[half]:.1f} -> {truth_cached[half]:.1f} m")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+# ==========================================
+# PERSISTÊNCIA DAS ESTIMATIVAS (SQLITE + R*TREE)
+# ==========================================
+# Tabela 'estimates' com os resultados da triangulação e da super posição,
+# índice (serial, ts) para histórico por dispositivo e um R*Tree 3D
+# (lat, lon, tempo) sobre o círculo de erro de cada estimativa para
+# consultas espaciais com janela de tempo.
+#
+# O R*Tree guarda float32 arredondado para fora, então ele serve de
+# pré-filtro; o filtro exato de tempo é feito na tabela principal.
+#
+# Falha ao gravar um lote: as linhas só saem do buffer depois do commit.
+# Erro passageiro (banco travado por outro processo, disco cheio) deixa o
+# lote no buffer para o próximo flush; erro definitivo (linha inválida)
+# descarta o lote. Os dois casos são registrados no log e contados em
+# `stats`; acima de MAX_PENDING_ROWS as linhas mais antigas são descartadas.
+# Depois de uma falha passageira, `add` só tenta de novo após FLUSH_RETRY_S
+# (cada tentativa pode esperar o timeout do SQLite); `flush` sempre tenta.
+
+DB_PATH = "estimates.db"
+INSERT_BATCH_SIZE = 1000
+MAX_PENDING_ROWS = 100_000
+FLUSH_RETRY_S = 5.0
+
+METERS_PER_DEGREE = 111320.0
+
+KIND_TRIANGULATION = "triangulation"
+KIND_SUPER_POSITION = "super_position"
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS estimates (
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    error REAL NOT NULL,
+    max_rssi REAL,
+    gateways INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_estimates_serial_ts ON estimates(serial, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS estimates_rtree USING rtree(
+    id, min_lat, max_lat, min_lon, max_lon, min_ts, max_ts
+);
+"""
+
+
+def error_bbox(lat, lon, error_m):
+    """Caixa (min_lat, max_lat, min_lon, max_lon) que contém o círculo de erro."""
+    dlat = error_m / METERS_PER_DEGREE
+    dlon = error_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def estimate_row(res, kind=None):
+    """
+    Normaliza um resultado (triangulação ou super posição) para a linha da tabela:
+    (serial, ts, kind, lat, lon, error, max_rssi, gateways).
+    """
+    if 'final_latitude' in res:
+        return (
+            res.get('serial') or "Desconhecido", float(res.get('timestamp') or time.time()),
+            kind or KIND_SUPER_POSITION,
+            res['final_latitude'], res['final_longitude'], res['final_error_radius_m'],
+            None, res.get('total_positions_used'),
+        )
+    gateways = res.get('gateways_used')
+    return (
+        res.get('serial') or "Desconhecido", float(res.get('timestamp') or time.time()),
+        kind or KIND_TRIANGULATION,
+        res['lat'], res['lon'], res['error'],
+        res.get('max_rssi'), len(gateways) if gateways is not None else None,
+    )
+
+
+class EstimateStore:
+    """
+    Armazena estimativas em SQLite (modo WAL). As inserções ficam em um
+    buffer e são gravadas em lote (uma transação por `flush`).
+    Seguro para uso entre threads (uma conexão protegida por lock).
+    """
+
+    def __init__(self, path=DB_PATH, batch_size=INSERT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self.stats = {"flush_errors": 0, "dropped_rows": 0}
+        self._retry_at = 0.0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    # --- Escrita ---
+
+    def add(self, res, kind=None):
+        """Enfileira uma estimativa; grava automaticamente ao completar o lote."""
+        with self._lock:
+            self._pending.append(estimate_row(res, kind))
+            self._auto_flush_locked()
+
+    def add_many(self, results, kind=None):
+        with self._lock:
+            self._pending.extend(estimate_row(r, kind) for r in results)
+            self._auto_flush_locked()
+
+    def flush(self):
+        """Grava o buffer. Retorna False se alguma linha ficou sem gravar (ver `stats`)."""
+        with self._lock:
+            self._flush_locked()
+            return not self._pending
+
+    def _auto_flush_locked(self):
+        if len(self._pending) >= self.batch_size and time.monotonic() >= self._retry_at:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        rows = self._pending
+        try:
+            self._insert(rows)
+        except sqlite3.OperationalError:
+            self.stats["flush_errors"] += 1
+            self._retry_at = time.monotonic() + FLUSH_RETRY_S
+            overflow = len(rows) - MAX_PENDING_ROWS
+            if overflow > 0:
+                del rows[:overflow]
+                self.stats["dropped_rows"] += overflow
+            log.exception("Falha ao gravar %d estimativa(s); ficam no buffer para o próximo flush", len(rows))
+            return
+        except (sqlite3.Error, TypeError, ValueError):
+            self.stats["flush_errors"] += 1
+            self.stats["dropped_rows"] += len(rows)
+            log.exception("Lote de %d estimativa(s) descartado", len(rows))
+        self._pending = []
+
+    def _insert(self, rows):
+        with self.conn:
+            # Trava de escrita antes de ler MAX(id): vários processos podem gravar no mesmo banco (lora.sharding)
+            self.conn.execute("BEGIN IMMEDIATE")
+            cur = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM estimates")
+            first_id = cur.fetchone()[0] + 1
+            ids = range(first_id, first_id + len(rows))
+            self.conn.executemany(
+                "INSERT INTO estimates (id, serial, ts, kind, lat, lon, error, max_rssi, gateways) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(i,) + row for i, row in zip(ids, rows)],
+            )
+            self.conn.executemany(
+                "INSERT INTO estimates_rtree VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(i,) + error_bbox(row[3], row[4], row[5]) + (row[1], row[1]) for i, row in zip(ids, rows)],
+            )
+
+    # --- Consultas ---
+
+    def query_bbox(self, south, west, north, east, since=None, until=None, kind=None, limit=None):
+        """Estimativas cujo círculo de erro intersecta a caixa, na janela de tempo."""
+        self.flush()
+        since = -math.inf if since is None else since
+        until = math.inf if until is None else until
+        sql = (
+            "SELECT e.id, e.serial, e.ts, e.kind, e.lat, e.lon, e.error, e.max_rssi, e.gateways "
+            "FROM estimates_rtree r JOIN estimates e ON e.id = r.id "
+            "WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? "
+            "AND r.max_ts >= ? AND r.min_ts <= ? AND e.ts >= ? AND e.ts <= ?"
+        )
+        params = [south, north, west, east, since, until, since, until]
+        if kind:
+            sql += " AND e.kind = ?"
+            params.append(kind)
+        sql += " ORDER BY e.ts"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._rows(sql, params)
+
+    def history(self, serial, since=None, until=None, kind=None, limit=None):
+        """Histórico de um serial em ordem cronológica (usa o índice serial+ts)."""
+        self.flush()
+        sql = (
+            "SELECT id, serial, ts, kind, lat, lon, error, max_rssi, gateways "
+            "FROM estimates WHERE serial = ? AND ts >= ? AND ts <= ?"
+        )
+        params = [serial, -math.inf if since is None else since, math.inf if until is None else until]
+        if kind:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " ORDER BY ts"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._rows(sql, params)
+
+    def count(self):
+        self.flush()
+        return self.conn.execute("SELECT COUNT(*) FROM estimates").fetchone()[0]
+
+    def _rows(self, sql, params):
+        with self._lock:
+            cur = self.conn.execute(sql, params)
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# ==========================================
+# BENCHMARK (python -m lora.storage N)
+# ==========================================
+
+def main():
+    import os
+    import random
+    import sys
+    import tempfile
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    store = EstimateStore(path, batch_size=50_000)
+    rnd = random.Random(0)
+    t0 = 1_700_000_000.0
+    serials = [f"SN{i:05d}" for i in range(5000)]
+
+    start = time.perf_counter()
+    for i in range(n):
+        store.add({
+            "serial": serials[i % len(serials)], "timestamp": t0 + i * 2.0,
+            "lat": -8.0 + rnd.uniform(-1, 1), "lon": -48.4 + rnd.uniform(-1, 1),
+            "error": rnd.uniform(10, 90), "max_rssi": -90,
+        })
+    store.flush()
+    print(f"Inserção: {n} linhas em {time.perf_counter() - start:.1f} s")
+
+    t_end = t0 + n * 2.0
+    for label, fn in [
+        ("bbox 1 km, últimas 24 h", lambda: store.query_bbox(-8.005, -48.405, -7.995, -48.395, since=t_end - 86400)),
+        ("bbox 1 km, tudo", lambda: store.query_bbox(-8.005, -48.405, -7.995, -48.395)),
+        ("histórico de 1 serial", lambda: store.history("SN00042")),
+    ]:
+        start = time.perf_counter()
+        rows = fn()
+        print(f"{label}: {len(rows)} linhas em {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
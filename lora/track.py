@@ -0,0 +1,150 @@
+import bisect
+import csv
+import heapq
+import math
+import os
+
+# ==========================================
+# TRILHA POR DISPOSITIVO
+# ==========================================
+# A trilha completa (resolução total) fica em disco, um CSV por serial,
+# gravado em modo append a cada estimativa. Para o navegador vai só uma
+# versão simplificada (Visvalingam-Whyatt) com orçamento fixo de vértices
+# e um número fixo de quadros pré-calculados para a reprodução.
+
+TRACKS_DIR = "tracks"
+TRACK_VERTEX_BUDGET = 500
+TRACK_FRAMES = 200
+
+TRACK_FIELDS = ["timestamp", "lat", "lon", "error"]
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def track_path(serial, directory=TRACKS_DIR):
+    # Serial vira nome de arquivo; qualquer caractere estranho é trocado por '_'
+    safe = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in str(serial))
+    return os.path.join(directory, f"{safe}.csv")
+
+
+def append_estimate(res, directory=TRACKS_DIR):
+    """Acrescenta uma estimativa (com 'serial' e 'timestamp') ao CSV do dispositivo."""
+    os.makedirs(directory, exist_ok=True)
+    path = track_path(res['serial'], directory)
+    is_new = not os.path.exists(path)
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(TRACK_FIELDS)
+        writer.writerow([res['timestamp'], res['lat'], res['lon'], res['error']])
+
+
+def load_track(serial, directory=TRACKS_DIR):
+    """Lê a trilha completa do disco, ordenada por timestamp."""
+    path = track_path(serial, directory)
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="", encoding="utf-8") as f:
+        track = [
+            {"timestamp": float(row['timestamp']), "lat": float(row['lat']),
+             "lon": float(row['lon']), "error": float(row['error'])}
+            for row in csv.DictReader(f)
+        ]
+    track.sort(key=lambda p: p['timestamp'])
+    return track
+
+
+def list_tracked_serials(directory=TRACKS_DIR):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-4] for name in os.listdir(directory) if name.endswith(".csv"))
+
+
+# ==========================================
+# SIMPLIFICAÇÃO (VISVALINGAM-WHYATT)
+# ==========================================
+
+def _to_local_xy(track):
+    """Projeção equiretangular local em metros (suficiente para áreas de triângulo)."""
+    lat0 = math.radians(track[0]['lat'])
+    k = math.cos(lat0)
+    return [
+        (math.radians(p['lon']) * k * EARTH_RADIUS_M, math.radians(p['lat']) * EARTH_RADIUS_M)
+        for p in track
+    ]
+
+
+def _triangle_area(a, b, c):
+    return abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])) / 2.0
+
+
+def simplify_track(track, max_vertices=TRACK_VERTEX_BUDGET):
+    """
+    Reduz a trilha a no máximo `max_vertices` vértices removendo, um a um,
+    o vértice de menor área efetiva (Visvalingam-Whyatt). O(n log n) com heap.
+    Primeiro e último pontos são sempre mantidos.
+    """
+    n = len(track)
+    if n <= max_vertices or n < 3:
+        return list(track)
+
+    xy = _to_local_xy(track)
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    area = [math.inf] * n
+    heap = []
+    for i in range(1, n - 1):
+        area[i] = _triangle_area(xy[i - 1], xy[i], xy[i + 1])
+        heap.append((area[i], i))
+    heapq.heapify(heap)
+
+    removed = [False] * n
+    remaining = n
+    while remaining > max_vertices and heap:
+        a, i = heapq.heappop(heap)
+        # Entrada desatualizada (área recalculada depois que foi empilhada)
+        if removed[i] or a != area[i]:
+            continue
+        removed[i] = True
+        remaining -= 1
+        p, q = prev[i], nxt[i]
+        nxt[p] = q
+        prev[q] = p
+        # Recalcula os vizinhos; a área nunca diminui (mantém a ordem de remoção)
+        for j in (p, q):
+            if 0 < j < n - 1:
+                area[j] = max(_triangle_area(xy[prev[j]], xy[j], xy[nxt[j]]), a)
+                heapq.heappush(heap, (area[j], j))
+
+    return [p for i, p in enumerate(track) if not removed[i]]
+
+
+# ==========================================
+# QUADROS PARA REPRODUÇÃO
+# ==========================================
+
+def build_frames(track, n_frames=TRACK_FRAMES):
+    """
+    Pré-calcula `n_frames` quadros igualmente espaçados no tempo.
+    Cada quadro tem o instante e a posição interpolada entre os vértices.
+    """
+    if not track:
+        return []
+    times = [p['timestamp'] for p in track]
+    t_start, t_end = times[0], times[-1]
+    if t_end <= t_start or n_frames < 2:
+        return [{"timestamp": t_start, "lat": track[0]['lat'], "lon": track[0]['lon'], "vertex": 0}]
+
+    frames = []
+    step = (t_end - t_start) / (n_frames - 1)
+    for k in range(n_frames):
+        t = t_start + k * step
+        i = min(max(bisect.bisect_right(times, t) - 1, 0), len(track) - 1)
+        if i + 1 < len(track) and times[i + 1] > times[i]:
+            f = (t - times[i]) / (times[i + 1] - times[i])
+            lat = track[i]['lat'] + f * (track[i + 1]['lat'] - track[i]['lat'])
+            lon = track[i]['lon'] + f * (track[i + 1]['lon'] - track[i]['lon'])
+        else:
+            lat, lon = track[i]['lat'], track[i]['lon']
+        frames.append({"timestamp": t, "lat": lat, "lon": lon, "vertex": i})
+    return frames
@@ -0,0 +1,477 @@
+import json
+import math
+import time
+
+from lora.cluster import CLUSTER_DENSITY, CLUSTER_LEADER, dominant_cluster
+from lora.metrics import GATEWAY_REJECTIONS, GROUP_REJECTIONS
+
+# ==========================================
+# 1. FUNÇÕES MATEMÁTICAS (CORE BLINDADO)
+# ==========================================
+
+MAX_DISTANCE_KM = 1.5
+GATEWAY_COORDINATE_DIVISOR = 10000000.0
+
+# Mapa para normalizar o Fix State (aceita int ou string)
+FIX_MAP = {
+    "FS_FIX_NOT_AVAILABLE": 0, "FS_FIX_TIME_ONLY": 1,
+    "FS_FIX_2D": 2, "FS_FIX_3D": 3,
+    "0": 0, "1": 1, "2": 2, "3": 3
+}
+
+# Qualidade da geometria (GDOP): acima disso conta como este valor no peso
+# da super posição; abaixo de 1 (geometria boa) o peso não muda
+GDOP_MAX = 20.0
+
+# Número de sequência do pacote (firmwares diferentes usam um ou outro nome)
+SEQUENCE_KEYS = ('sequenceNumber', 'sequence')
+
+# Séries de métricas resolvidas uma vez (o laço de gateways é caminho quente)
+_REJECT_NO_POSITION = GATEWAY_REJECTIONS.labels(reason="no_position")
+_REJECT_FIX = GATEWAY_REJECTIONS.labels(reason="fix_lt_2")
+_REJECT_NO_RSSI = GATEWAY_REJECTIONS.labels(reason="no_rssi")
+_REJECT_CORRUPT = GATEWAY_REJECTIONS.labels(reason="corrupt")
+_REJECT_DISTANCE = GATEWAY_REJECTIONS.labels(reason="distance")
+_REJECT_UNRELIABLE = GATEWAY_REJECTIONS.labels(reason="unreliable")
+_GROUP_NO_VALID = GROUP_REJECTIONS.labels(reason="no_valid_gateway")
+_GROUP_DISPERSION = GROUP_REJECTIONS.labels(reason="dispersion")
+_GROUP_ZERO_WEIGHT = GROUP_REJECTIONS.labels(reason="zero_weight")
+
+def parse_fix_state(raw_fix):
+    return raw_fix if isinstance(raw_fix, int) else FIX_MAP.get(str(raw_fix), 0)
+
+def parse_device_timestamp(raw_ts):
+    """deviceDateTime em segundos, ou None se ausente ou não numérico (ex.: texto ISO)."""
+    try:
+        ts = float(raw_ts)
+    except (TypeError, ValueError):
+        return None
+    return ts if math.isfinite(ts) else None
+
+def parse_gateway_report(data):
+    """
+    Extrai os campos de um relatório de gateway sem aplicar filtros.
+    Retorna dict (serial, sequence, timestamp, lat_raw, lon_raw, rssi, fix_state)
+    ou None se o pacote não tem posição. 'rssi' é None quando não há loraRadio.RSSI.
+    Lança KeyError/IndexError/ValueError/TypeError para pacotes corrompidos.
+    """
+    if isinstance(data, str): data = json.loads(data)
+    payload = data.get('data', {})
+
+    pos_list = payload.get('gatewayPosition')
+    if not pos_list: return None
+    gw_pos = pos_list[0]
+
+    sequence = None
+    for key in SEQUENCE_KEYS:
+        if key in payload:
+            sequence = int(payload[key])
+            break
+
+    return {
+        "serial": data.get('serial'),
+        "sequence": sequence,
+        "timestamp": parse_device_timestamp(payload.get('deviceDateTime')),
+        "lat_raw": int(gw_pos['latitude']),
+        "lon_raw": int(gw_pos['longitude']),
+        "rssi": payload.get('loraRadio', {}).get('RSSI'),
+        "fix_state": parse_fix_state(payload.get('gatewayGps', {}).get('fixState', 0)),
+    }
+
+def parse_packets_text(raw_data):
+    """
+    Converte texto em lista de pacotes: lista JSON, NDJSON ou objetos
+    colados (ex: logs de terminal, '}{' sem separador).
+    """
+    raw_data = raw_data.strip()
+    if not raw_data: return []
+    if raw_data.startswith("["):
+        return json.loads(raw_data)
+    try:
+        # Um único objeto (inclusive formatado em várias linhas)
+        return [json.loads(raw_data)]
+    except ValueError:
+        pass
+    raw_lines = raw_data.replace('}{', '}\n{').split('\n')
+    return [json.loads(line) for line in raw_lines if line.strip()]
+
+def calculate_haversine_distance(lat1, lon1, lat2, lon2):
+    R = 6371.0
+    lat1_rad = math.radians(lat1)
+    lon1_rad = math.radians(lon1)
+    lat2_rad = math.radians(lat2)
+    lon2_rad = math.radians(lon2)
+    dlon = lon2_rad - lon1_rad
+    dlat = lat2_rad - lat1_rad
+    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+def geometry_dop(gateways, lat, lon):
+    """
+    Diluição geométrica da precisão (GDOP) dos gateways vistos da posição
+    (lat, lon): sqrt(traço((HᵀH)⁻¹)), H = vetores unitários posição -> gateway.
+    Só depende das direções: gateways colineares com a posição (ou um
+    gateway só) dão infinito; cercando a posição, GDOP ≈ 2/sqrt(n).
+    """
+    cos_lat = math.cos(math.radians(lat))
+    a00 = a01 = a11 = 0.0
+    for g in gateways:
+        dx = (g['lon'] - lon) * cos_lat
+        dy = g['lat'] - lat
+        rho2 = dx * dx + dy * dy
+        if rho2 < 1e-18:
+            continue
+        a00 += dx * dx / rho2
+        a01 += dx * dy / rho2
+        a11 += dy * dy / rho2
+    det = a00 * a11 - a01 * a01
+    if det < 1e-9:
+        return math.inf
+    return math.sqrt((a00 + a11) / det)
+
+def gdop_weight(pos):
+    """Fator de peso pela geometria: 1/GDOP², com GDOP limitado a [1, GDOP_MAX]. Sem GDOP = 1."""
+    gdop = pos.get('gdop')
+    if gdop is None:
+        return 1.0
+    gdop = min(max(gdop, 1.0), GDOP_MAX)
+    return 1.0 / (gdop * gdop)
+
+def _leader_cluster(valid_gateways):
+    """Gateways a menos de MAX_DISTANCE_KM do líder (o mais central do grupo)."""
+    # Identifica o "Líder" (quem está mais no centro da massa de gateways)
+    ref_lat, ref_lon = valid_gateways[0]['lat'], valid_gateways[0]['lon']
+    
+    if len(valid_gateways) > 1:
+        min_total_dist = float('inf')
+        best_gw = None
+        
+        for g1 in valid_gateways:
+            # Soma a distância deste gateway para todos os outros
+            dist_sum = sum(calculate_haversine_distance(g1['lat'], g1['lon'], g2['lat'], g2['lon']) for g2 in valid_gateways)
+            if dist_sum < min_total_dist:
+                min_total_dist = dist_sum
+                best_gw = g1
+        
+        if best_gw:
+            ref_lat, ref_lon = best_gw['lat'], best_gw['lon']
+
+    # Filtra gateways que estão muito longe do "Líder" (> 1.5km - possível reflexão atmosférica)
+    filtered_gateways = [
+        g for g in valid_gateways 
+        if calculate_haversine_distance(g['lat'], g['lon'], ref_lat, ref_lon) < MAX_DISTANCE_KM
+    ]
+    return filtered_gateways
+
+def process_triangulation(gateway_positions_raw, cluster_mode=CLUSTER_LEADER, reliability=None):
+    """
+    Processa a lista de gateways, filtra outliers por distância (Cluster)
+    e calcula a posição ponderada pelo RSSI (mW).
+    Assume hardware GPS de alta precisão (erro ~3m).
+    cluster_mode: CLUSTER_LEADER (corte fixo em volta do líder) ou
+    CLUSTER_DENSITY (cluster dominante por densidade, ver lora.cluster).
+    reliability: GatewayReliability (lora.reliability) opcional; descarta ou
+    reduz o peso de gateways ruins antes do líder e aprende com o grupo.
+    """
+    valid_gateways = []
+    unreliable = []
+    serial = None
+    device_ts = None
+
+    # --- 1. Extração e Validação ---
+    for data in gateway_positions_raw:
+        try:
+            # Flexibilidade: aceita string JSON ou dict direto
+            if isinstance(data, str): data = json.loads(data)
+            
+            # Acesso direto assumindo estrutura garantida do hardware
+            payload = data.get('data', {})
+
+            # Identificação do dispositivo (serial + horário do pacote) para a trilha
+            if serial is None:
+                serial = data.get('serial')
+                device_ts = parse_device_timestamp(payload.get('deviceDateTime'))
+            
+            # Verifica se existe posição
+            pos_list = payload.get('gatewayPosition')
+            if not pos_list:
+                _REJECT_NO_POSITION.inc()
+                continue
+            gw_pos = pos_list[0]
+            
+            gw_gps = payload.get('gatewayGps', {})
+            key = reliability.key(gw_pos['latitude'], gw_pos['longitude']) if reliability is not None else None
+            
+            # Tratamento do Fix State
+            fix_state = parse_fix_state(gw_gps.get('fixState', 0))
+            
+            # Filtro Básico: Só aceita 2D ou 3D fix
+            if fix_state < 2:
+                _REJECT_FIX.inc()
+                if key is not None: reliability.observe_report(key, False)
+                continue
+
+            # RSSI é obrigatório para o cálculo de peso
+            lora_radio = payload.get('loraRadio', {})
+            if 'RSSI' not in lora_radio:
+                _REJECT_NO_RSSI.inc()
+                if key is not None: reliability.observe_report(key, False)
+                continue
+            rssi = lora_radio['RSSI']
+
+            lat = gw_pos['latitude'] / GATEWAY_COORDINATE_DIVISOR
+            lon = gw_pos['longitude'] / GATEWAY_COORDINATE_DIVISOR
+
+            if key is None:
+                valid_gateways.append({'lat': lat, 'lon': lon, 'rssi': rssi})
+                continue
+            # Histórico do gateway: descarta ou reduz o peso antes do líder
+            reliability.observe_report(key, True)
+            gw = {'lat': lat, 'lon': lon, 'rssi': rssi, 'key': key}
+            trust = reliability.trust(key)
+            if trust <= 0.0:
+                _REJECT_UNRELIABLE.inc()
+                unreliable.append(gw)
+                continue
+            if trust < 1.0: gw['trust'] = trust
+            valid_gateways.append(gw)
+
+        except (KeyError, IndexError, ValueError, TypeError):
+            # Ignora pacotes corrompidos sem quebrar o loop
+            _REJECT_CORRUPT.inc()
+            continue
+
+    if not valid_gateways and unreliable:
+        # Só sobraram gateways com histórico ruim: melhor usá-los que perder o grupo
+        valid_gateways, unreliable = unreliable, []
+    if not valid_gateways: 
+        _GROUP_NO_VALID.inc()
+        return None, "Nenhum gateway válido (Fix 2D/3D + RSSI) encontrado."
+
+    # --- 2. Filtragem de Cluster ---
+    if cluster_mode == CLUSTER_DENSITY:
+        keep = dominant_cluster([g['lat'] for g in valid_gateways], [g['lon'] for g in valid_gateways],
+                                [10**(g['rssi'] / 10.0) * g.get('trust', 1.0) for g in valid_gateways])
+        filtered_gateways = [valid_gateways[i] for i in keep]
+    else:
+        filtered_gateways = _leader_cluster(valid_gateways)
+    if len(filtered_gateways) < len(valid_gateways):
+        _REJECT_DISTANCE.inc(len(valid_gateways) - len(filtered_gateways))
+
+    if not filtered_gateways: 
+        _GROUP_DISPERSION.inc()
+        return None, "Erro de dispersão: Gateways muito distantes entre si."
+
+    position = weighted_position(filtered_gateways)
+    if position is None:
+        _GROUP_ZERO_WEIGHT.inc()
+        return None, "Erro matemático: Peso zero."
+    final_lat, final_lon, estimated_error, max_rssi = position
+    if reliability is not None:
+        reliability.observe_group(valid_gateways + unreliable, filtered_gateways, final_lat, final_lon)
+
+    return {
+        "lat": final_lat,
+        "lon": final_lon,
+        "error": estimated_error,
+        "gateways_used": filtered_gateways,
+        "max_rssi": max_rssi,
+        "gdop": geometry_dop(filtered_gateways, final_lat, final_lon),
+        "total_raw_gateways": len(valid_gateways) + len(unreliable),
+        "serial": serial or "Desconhecido",
+        "timestamp": device_ts if device_ts is not None else time.time()
+    }, None
+
+def weighted_position(filtered_gateways):
+    """
+    Passos 3 e 4 da triangulação sobre os gateways já filtrados:
+    (lat, lon, raio de erro, max_rssi), ou None se o peso total é zero.
+    """
+    # --- 3. Cálculo Ponderado (RSSI em mW) ---
+    lat_w = 0.0
+    lon_w = 0.0
+    total_w = 0.0
+    max_rssi = -999
+
+    for gw in filtered_gateways:
+        # Transforma dBm (log) em mW (linear) para usar como peso real
+        # Ex: -100dBm = 1e-10 mW / -80dBm = 1e-8 mW (peso 100x maior)
+        weight = 10**(gw['rssi'] / 10.0) * gw.get('trust', 1.0)
+        
+        lat_w += gw['lat'] * weight
+        lon_w += gw['lon'] * weight
+        total_w += weight
+        
+        if gw['rssi'] > max_rssi: max_rssi = gw['rssi']
+
+    if total_w == 0:
+        return None
+
+    final_lat = lat_w / total_w
+    final_lon = lon_w / total_w
+    
+    # --- 4. Cálculo da Incerteza (Raio de Erro) ---
+    # RSSI mais forte = Menor erro. 
+    # Fórmula baseada na física de propagação, não na imprecisão do GPS.
+    rssi_abs = abs(max_rssi)
+    estimated_error = rssi_abs - (rssi_abs * 0.15)
+    
+    # Trava de segurança: Erro nunca menor que 3m (precisão do hardware GPS)
+    if estimated_error < 3.0: estimated_error = 3.0
+
+    return final_lat, final_lon, estimated_error, max_rssi
+
+def consolidate_super_position(position_series, use_gdop=False):
+    latitude_weighted = 0.0
+    longitude_weighted = 0.0
+    error_weighted = 0.0
+    total_weight = 0.0
+    
+    for pos in position_series:
+        lat = pos.get('lat')
+        lon = pos.get('lon')
+        error_radius = pos.get('error')
+        
+        if error_radius is None or error_radius <= 0 or lat is None or lon is None:
+            continue 
+
+        # O peso é o inverso do quadrado do erro (Estatística Bayesiana simples)
+        weight = 1.0 / (error_radius ** 2)
+        if use_gdop:
+            weight *= gdop_weight(pos)
+        
+        latitude_weighted += (lat * weight)
+        longitude_weighted += (lon * weight)
+        error_weighted += (error_radius * weight)
+        total_weight += weight
+        
+    if total_weight == 0: return None
+        
+    final_lat = latitude_weighted / total_weight
+    final_lon = longitude_weighted / total_weight
+    final_error = error_weighted / total_weight
+
+    return {
+        "final_latitude": final_lat,
+        "final_longitude": final_lon,
+        "final_error_radius_m": final_error,
+        "total_positions_used": len(position_series)
+    }
+
+class DecayedSuperPosition:
+    """
+    Super posição com esquecimento exponencial: além de 1/erro², cada
+    estimativa pesa 2^(-idade / meia-vida), então depois de uma mudança de
+    lugar as posições antigas perdem força sozinhas.
+
+    Estado O(1): as somas ponderadas ficam relativas ao instante mais recente
+    (t_ref). Quando chega uma estimativa mais nova, as somas são multiplicadas
+    pelo decaimento do intervalo; uma mais antiga entra já decaída.
+    Estimativas sem 'timestamp' contam como do instante mais recente.
+    Com use_gdop, o peso também é multiplicado por `gdop_weight`.
+    """
+
+    def __init__(self, half_life_s, use_gdop=False):
+        if half_life_s <= 0:
+            raise ValueError("A meia-vida deve ser positiva.")
+        self.half_life_s = half_life_s
+        self.use_gdop = use_gdop
+        self.t_ref = None
+        self.lat_w = self.lon_w = self.error_w = self.total_w = 0.0
+        self.count = 0
+
+    def _decay(self, dt):
+        return 0.5 ** (dt / self.half_life_s)
+
+    def add(self, pos):
+        lat = pos.get('lat')
+        lon = pos.get('lon')
+        error_radius = pos.get('error')
+        self.count += 1
+        if error_radius is None or error_radius <= 0 or lat is None or lon is None:
+            return
+
+        t = pos.get('timestamp')
+        age_factor = 1.0
+        if t is not None:
+            if self.t_ref is None:
+                self.t_ref = t
+            elif t > self.t_ref:
+                factor = self._decay(t - self.t_ref)
+                self.lat_w *= factor
+                self.lon_w *= factor
+                self.error_w *= factor
+                self.total_w *= factor
+                self.t_ref = t
+            else:
+                age_factor = self._decay(self.t_ref - t)
+
+        weight = age_factor / (error_radius ** 2)
+        if self.use_gdop:
+            weight *= gdop_weight(pos)
+        self.lat_w += lat * weight
+        self.lon_w += lon * weight
+        self.error_w += error_radius * weight
+        self.total_w += weight
+
+    def result(self):
+        """Mesmo formato de `consolidate_super_position` (None se não há peso)."""
+        if self.total_w == 0: return None
+        return {
+            "final_latitude": self.lat_w / self.total_w,
+            "final_longitude": self.lon_w / self.total_w,
+            "final_error_radius_m": self.error_w / self.total_w,
+            "total_positions_used": self.count,
+            "half_life_s": self.half_life_s,
+        }
+
+def consolidate_super_position_decayed(position_series, half_life_s, use_gdop=False):
+    acc = DecayedSuperPosition(half_life_s, use_gdop)
+    for pos in position_series:
+        acc.add(pos)
+    return acc.result()
+
+# ==========================================
+# 2. AGRUPAMENTO DE PACOTES POR SEQUÊNCIA
+# ==========================================
+
+class PacketGrouper:
+    """
+    Junta os relatórios de gateway de um mesmo (serial, sequência).
+    Quando chega uma sequência nova de um serial, a anterior é considerada
+    completa e devolvida para triangulação. Em fluxo contínuo, grupos sem
+    pacote novo há algum tempo são liberados por `flush_idle`.
+    """
+
+    def __init__(self):
+        # serial -> [sequência, pacotes, instante do último pacote]
+        self.pending = {}
+
+    def add(self, packet, now=0.0):
+        """Acrescenta um pacote; retorna a lista de grupos completados (pode ser vazia)."""
+        if isinstance(packet, str): packet = json.loads(packet)
+        serial = packet.get('serial')
+        payload = packet.get('data', {})
+        sequence = next((payload[k] for k in SEQUENCE_KEYS if k in payload), None)
+
+        current = self.pending.get(serial)
+        if current is not None and current[0] == sequence:
+            current[1].append(packet)
+            current[2] = now
+            return []
+        self.pending[serial] = [sequence, [packet], now]
+        if current is None:
+            return []
+        return [(serial, current[0], current[1])]
+
+    def flush_idle(self, cutoff):
+        """Libera os grupos cujo último pacote chegou antes de `cutoff`."""
+        idle = [serial for serial, (_, _, last) in self.pending.items() if last < cutoff]
+        return [(serial,) + tuple(self.pending.pop(serial)[:2]) for serial in idle]
+
+    def flush(self):
+        """Devolve todos os grupos pendentes (fim do arquivo/stream)."""
+        groups = [(serial, seq, packets) for serial, (seq, packets, _) in self.pending.items()]
+        self.pending = {}
+        return groups
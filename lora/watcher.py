@@ -0,0 +1,306 @@
+import fnmatch
+import json
+import os
+import sys
+import time
+import zlib
+
+from lora.cluster import CLUSTER_LEADER, CLUSTER_MODES
+from lora.pipeline import Pipeline
+from lora.snapshot import SNAPSHOT_INTERVAL_S, load_snapshot, save_snapshot
+
+# ==========================================
+# OBSERVADOR DE DIRETÓRIO (LOGS NDJSON INCREMENTAIS)
+# ==========================================
+# Acompanha uma pasta onde as equipes de campo deixam logs de gateway
+# (um JSON por linha). Cada arquivo tem um cursor com o offset em bytes já
+# processado; o checkpoint guarda os cursores em JSON e, após um restart,
+# só as linhas novas são lidas.
+#
+# Identidade do arquivo = (dispositivo, inode), não o nome:
+#  - rotação por renomeação (app.log -> app.log.1): o inode é o mesmo, o
+#    cursor continua de onde parou e o app.log novo começa do zero;
+#  - truncamento (copytruncate): tamanho < offset, o cursor volta a zero;
+#  - inode reaproveitado por outro arquivo: detectado pela impressão digital
+#    (CRC dos primeiros bytes), o cursor volta a zero.
+#
+# Linhas incompletas no fim do arquivo ficam para a próxima leitura: o
+# offset só avança até o último '\n'.
+#
+# Garantia: pelo menos uma vez. O checkpoint é gravado depois do
+# processamento; uma queda entre os dois reprocessa só as linhas desde o
+# último checkpoint. Grupos (serial, sequência) ainda abertos na queda se
+# perdem (no máximo GROUP_TIMEOUT_S de dados por dispositivo).
+#
+# Com `snapshot_path`, o estado do pipeline (trilhas, bateria, grade,
+# grupos em aberto...) é gravado a cada `snapshot_interval_s` junto com os
+# cursores daquele instante (lora.snapshot). No restart o snapshot é
+# carregado e a leitura continua dos cursores dele: só as linhas desde o
+# último snapshot são reprocessadas, sem perder o estado acumulado.
+
+CHECKPOINT_NAME = ".lora-watcher.json"
+POLL_INTERVAL_S = 1.0
+CHECKPOINT_INTERVAL_S = 5.0
+READ_CHUNK_BYTES = 1024 * 1024
+# Limite por arquivo em cada varredura: um arquivo enorme não atrasa os demais
+MAX_BYTES_PER_POLL = 8 * 1024 * 1024
+FINGERPRINT_BYTES = 256
+
+
+def fingerprint(f, length):
+    """CRC dos primeiros `length` bytes do arquivo aberto."""
+    f.seek(0)
+    return zlib.crc32(f.read(length))
+
+
+class DirectoryWatcher:
+
+    def __init__(self, directory, pipeline=None, pattern="*", checkpoint_path=None, on_output=None,
+                 snapshot_path=None, snapshot_interval_s=SNAPSHOT_INTERVAL_S):
+        self.directory = directory
+        self.pipeline = pipeline if pipeline is not None else Pipeline()
+        self.pattern = pattern
+        self.checkpoint_path = checkpoint_path or os.path.join(directory, CHECKPOINT_NAME)
+        self.on_output = on_output
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval_s = snapshot_interval_s
+        self.cursors = {}
+        self.stats = {"polls": 0, "lines": 0, "bytes": 0, "rotations": 0, "truncations": 0, "snapshots": 0}
+        self._dirty = False
+        self._last_checkpoint = self._last_snapshot = time.monotonic()
+        self._load_checkpoint()
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            # Os cursores do snapshot correspondem ao estado restaurado (os do checkpoint podem estar à frente)
+            self.cursors = load_snapshot(snapshot_path, self.pipeline)
+
+    # --- Checkpoint ---
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                self.cursors = json.load(f)["files"]
+        except FileNotFoundError:
+            self.cursors = {}
+
+    def save_checkpoint(self):
+        """Grava os cursores de forma atômica (arquivo temporário + rename)."""
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "files": self.cursors}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+        self._dirty = False
+        self._last_checkpoint = time.monotonic()
+
+    def save_snapshot(self):
+        """Grava o estado do pipeline com os cursores atuais (lora.snapshot)."""
+        save_snapshot(self.snapshot_path, self.pipeline, offsets=self.cursors)
+        self.stats["snapshots"] += 1
+        self._last_snapshot = time.monotonic()
+
+    # --- Varredura ---
+
+    def scan(self):
+        """Arquivos regulares que casam com o padrão: lista de (chave, caminho, tamanho)."""
+        found = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not fnmatch.fnmatch(entry.name, self.pattern):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                found.append((f"{st.st_dev}:{st.st_ino}", entry.path, st.st_size))
+        return found
+
+    def poll(self):
+        """Uma varredura: lê o que cresceu em cada arquivo. Retorna as saídas do pipeline."""
+        self.stats["polls"] += 1
+        outputs = []
+        seen = set()
+        for key, path, size in self.scan():
+            seen.add(key)
+            cursor = self.cursors.get(key)
+            if cursor is None:
+                cursor = self.cursors[key] = {"path": path, "offset": 0, "fp_len": 0, "fp": 0}
+                self._dirty = True
+            elif cursor["path"] != path:
+                # Renomeado (rotação): o conteúdo já lido continua lido
+                self.stats["rotations"] += 1
+                cursor["path"] = path
+                self._dirty = True
+            if size < cursor["offset"]:
+                self.stats["truncations"] += 1
+                self._reset(cursor)
+            if size > cursor["offset"]:
+                outputs.extend(self._read_new(cursor, path))
+
+        # Arquivos que saíram da pasta (apagados ou movidos): esquece o cursor
+        for key in [k for k in self.cursors if k not in seen]:
+            del self.cursors[key]
+            self._dirty = True
+
+        outputs.extend(self.pipeline.flush_idle())
+        self._emit(outputs)
+        if self._dirty and time.monotonic() - self._last_checkpoint >= CHECKPOINT_INTERVAL_S:
+            self.save_checkpoint()
+        if self.snapshot_path is not None and time.monotonic() - self._last_snapshot >= self.snapshot_interval_s:
+            self.save_snapshot()
+        return outputs
+
+    def _reset(self, cursor):
+        cursor.update(offset=0, fp_len=0, fp=0)
+        self._dirty = True
+
+    def _read_new(self, cursor, path):
+        outputs = []
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return outputs
+        with f:
+            if cursor["fp_len"] and fingerprint(f, cursor["fp_len"]) != cursor["fp"]:
+                # Mesmo inode, outro conteúdo: arquivo novo
+                self.stats["rotations"] += 1
+                self._reset(cursor)
+
+            f.seek(cursor["offset"])
+            budget = MAX_BYTES_PER_POLL
+            pending = b""
+            while budget > 0:
+                chunk = f.read(min(READ_CHUNK_BYTES, budget))
+                if not chunk:
+                    break
+                budget -= len(chunk)
+                data = pending + chunk
+                end = data.rfind(b"\n")
+                if end < 0:
+                    pending = data
+                    continue
+                pending = data[end + 1:]
+                for line in data[:end].split(b"\n"):
+                    line = line.strip()
+                    if line:
+                        outputs.extend(self.pipeline.feed(line))
+                        self.stats["lines"] += 1
+                consumed = end + 1
+                cursor["offset"] += consumed
+                self.stats["bytes"] += consumed
+                self._dirty = True
+
+            if cursor["fp_len"] < FINGERPRINT_BYTES and cursor["offset"] > cursor["fp_len"]:
+                cursor["fp_len"] = min(FINGERPRINT_BYTES, cursor["offset"])
+                cursor["fp"] = fingerprint(f, cursor["fp_len"])
+        return outputs
+
+    def _emit(self, outputs):
+        if self.on_output is not None:
+            for output in outputs:
+                self.on_output(output)
+
+    # --- Ciclo de vida ---
+
+    def run(self, interval=POLL_INTERVAL_S, max_polls=None):
+        """Varre a pasta a cada `interval` segundos até Ctrl+C (ou `max_polls`)."""
+        polls = 0
+        try:
+            while True:
+                self.poll()
+                polls += 1
+                if max_polls is not None and polls >= max_polls:
+                    break
+                time.sleep(interval)
+        finally:
+            self.close()
+
+    def close(self):
+        """Fecha os grupos pendentes e grava o checkpoint (e o snapshot)."""
+        self._emit(self.pipeline.flush())
+        self.save_checkpoint()
+        if self.snapshot_path is not None:
+            self.save_snapshot()
+
+
+# ==========================================
+# LINHA DE COMANDO (python -m lora.watcher)
+# ==========================================
+
+def _printer(mode):
+    def on_output(output):
+        kind, result = output
+        if kind == "estimate" and mode in ("triangulation", "all"):
+            print(f"[{result['serial']}#{result.get('sequence')}] {result['lat']:.8f}, {result['lon']:.8f} "
+                  f"(erro {result['error']:.1f} m)")
+        elif kind == "battery" and mode in ("battery", "all"):
+            print(f"[{result['serial']}] bateria {result['pct_remaining']:.1f}%")
+        elif kind == "geofence" and mode in ("triangulation", "all"):
+            verb = "entrou em" if result['event'] == "enter" else "saiu de"
+            print(f"[{result['serial']}] {verb} {result['name']} (erro {result['error']:.1f} m)")
+    return on_output
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Processa logs NDJSON de uma pasta conforme chegam")
+    parser.add_argument("pasta")
+    parser.add_argument("--mode", choices=["triangulation", "battery", "all"], default="all",
+                        help="Saídas impressas")
+    parser.add_argument("--pattern", default="*", help="Padrão dos arquivos (ex.: '*.ndjson')")
+    parser.add_argument("--checkpoint", help=f"Arquivo de checkpoint (padrão: <pasta>/{CHECKPOINT_NAME})")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL_S, help="Intervalo entre varreduras (s)")
+    parser.add_argument("--db", help="Grava as estimativas neste banco SQLite")
+    parser.add_argument("--once", action="store_true", help="Uma varredura e sai")
+    parser.add_argument("--cluster", choices=CLUSTER_MODES, default=CLUSTER_LEADER,
+                        help="Filtro de gateways: líder + 1.5 km ou densidade adaptativa")
+    parser.add_argument("--stationary-tol", type=float,
+                        help="Reaproveita a estimativa de dispositivos parados (tolerância de RSSI em dB)")
+    parser.add_argument("--gateway-stats", action="store_true",
+                        help="Descarta/reduz o peso de gateways com histórico ruim (lora.reliability)")
+    parser.add_argument("--geofences", help="GeoJSON de cercas: imprime entradas e saídas por serial")
+    parser.add_argument("--shards", type=int,
+                        help="Divide o estado por serial entre N processos (lora.sharding; 0 = um por núcleo)")
+    parser.add_argument("--snapshot", help="Grava/restaura o estado do pipeline neste arquivo (lora.snapshot)")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL_S,
+                        help="Intervalo entre snapshots (s)")
+    args = parser.parse_args()
+    if args.snapshot and args.shards is not None:
+        parser.error("--snapshot não é suportado com --shards")
+
+    store = None
+    if args.db and args.shards is None:
+        from lora.storage import EstimateStore
+        store = EstimateStore(args.db)
+    reliability = None
+    if args.gateway_stats:
+        from lora.reliability import GatewayReliability
+        reliability = GatewayReliability()
+    geofences = None
+    if args.geofences:
+        from lora.geofence import GeofenceMonitor, load_geojson
+        geofences = GeofenceMonitor(load_geojson(args.geofences))
+    options = dict(cluster_mode=args.cluster, stationary_tol_db=args.stationary_tol, reliability=reliability,
+                   geofences=geofences)
+    if args.shards is not None:
+        from lora.sharding import ShardedPipeline
+        pipeline = ShardedPipeline(args.shards or None, db_path=args.db, **options)
+    else:
+        pipeline = Pipeline(store=store, **options)
+    watcher = DirectoryWatcher(args.pasta, pipeline, args.pattern, args.checkpoint,
+                               on_output=_printer(args.mode), snapshot_path=args.snapshot,
+                               snapshot_interval_s=args.snapshot_interval)
+    try:
+        watcher.run(args.interval, max_polls=1 if args.once else None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store is not None:
+            store.close()
+    print(json.dumps(dict(watcher.stats, pipeline=watcher.pipeline.stats)), file=sys.stderr)
+    if args.shards is not None:
+        pipeline.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,211 +1,446 @@
 import streamlit as st
 import json
 import math
+import os
+import time
+import weakref
 import folium
-from streamlit_folium import st_folium
 import pandas as pd
+from streamlit_folium import st_folium
+
+from lora.fingerprint import FINGERPRINT_MAP_PATH, FingerprintMap
+from lora.grid import DensityGrid, grid_zoom_for_map
+from lora.jobs import CANCELLED as JOB_CANCELLED, DONE as JOB_DONE, JobLimitError
+from lora.job_panel import job_owner, private_upload, show_jobs, submit_job
+from lora.metrics import count_cache_lookup, mark_cache_miss
+from lora.cluster import CLUSTER_DENSITY, CLUSTER_LEADER
+from lora.geofence import GEOFENCE_PATH, INSIDE, load_geojson
+from lora.multilateration import multilaterate
+from lora.propagation import PATH_LOSS_EXPONENT, RSSI_AT_1M_DBM
+from lora.reliability import GatewayReliability
+from lora.stationary import STATIONARY_TOL_DB, reuse_error_bound_m
+from lora.pipeline import Pipeline
+from lora.reader import iter_packet_batches
+from lora.sessions import MAX_POINTS as SESSION_MAX_POINTS, SESSION_TTL_S, SessionStore, slim_result
+from lora.render import (
+    FAST_RENDER_THRESHOLD, build_density_layer, build_triangulation_map, build_super_position_map,
+    build_track_map, map_html, result_hash
+)
+from lora.storage import KIND_SUPER_POSITION, KIND_TRIANGULATION, EstimateStore
+from lora.triangulation import DecayedSuperPosition, consolidate_super_position, process_triangulation
+from lora.track import (
+    TRACK_VERTEX_BUDGET, append_estimate, build_frames, list_tracked_serials, load_track, simplify_track,
+    track_path
+)
 
 # ==========================================
-# 1. FUNÇÕES MATEMÁTICAS (CORE BLINDADO)
+# CACHE DOS MAPAS (HTML POR HASH DO RESULTADO)
 # ==========================================
 
-def calculate_haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
-    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def process_triangulation(gateway_positions_raw):
+# Quantidade máxima de mapas mantidos em cache (os mais antigos são descartados)
+MAP_CACHE_MAX_ENTRIES = 32
+
+# Importação de arquivo: estimativas além deste limite vão só para a grade e o SQLite
+UPLOAD_MAX_POINTS = 5000
+UPLOAD_TYPES = ["json", "ndjson", "jsonl", "log", "txt", "gz"]
+# Tipo das tarefas desta página no pool compartilhado (lora.job_panel)
+JOB_KIND_LOG_IMPORT = "log_import"
+
+# Métodos de super posição da Aba 2
+SP_METHOD_ALL = "Todo o histórico (1/erro²)"
+SP_METHOD_DECAY = "Decaimento exponencial (meia-vida)"
+
+# Métodos de cálculo da Aba 1
+TRI_METHOD_CENTROID = "Centróide ponderado (RSSI)"
+TRI_METHOD_MULTILATERATION = "Multilateração (perda de percurso)"
+TRI_METHOD_FINGERPRINT = "Mapa de rádio (fingerprint)"
+TRI_CLUSTER_OPTIONS = {
+    "Líder + raio fixo (1.5 km)": CLUSTER_LEADER,
+    "Densidade (DBSCAN adaptativo)": CLUSTER_DENSITY,
+}
+
+@st.cache_data(max_entries=MAP_CACHE_MAX_ENTRIES, show_spinner=False)
+def triangulation_map_html(result_key, _res):
+    """HTML do mapa da Aba 1. Só é reconstruído quando o hash do resultado muda."""
+    mark_cache_miss()
+    return map_html(build_triangulation_map(_res))
+
+@st.cache_data(max_entries=MAP_CACHE_MAX_ENTRIES, show_spinner=False)
+def super_position_map_html(result_key, _points, _final_res):
+    """HTML do mapa da Aba 2. Só é reconstruído quando o hash dos pontos/resultado muda."""
+    mark_cache_miss()
+    return map_html(build_super_position_map(_points, _final_res))
+
+@st.cache_data(max_entries=MAP_CACHE_MAX_ENTRIES, show_spinner=False)
+def track_map_html(serial, file_size):
     """
-    Processa a lista de gateways, filtra outliers por distância (Cluster)
-    e calcula a posição ponderada pelo RSSI (mW).
-    Assume hardware GPS de alta precisão (erro ~3m).
+    HTML da trilha do dispositivo. O CSV é só acrescido, então (serial, tamanho)
+    identifica a versão. Retorna também o total de pontos e os exibidos.
     """
-    MAX_DISTANCE_KM = 1.5
-    GATEWAY_COORDINATE_DIVISOR = 10000000.0
-    
-    # Mapa para normalizar o Fix State (aceita int ou string)
-    FIX_MAP = {
-        "FS_FIX_NOT_AVAILABLE": 0, "FS_FIX_TIME_ONLY": 1,
-        "FS_FIX_2D": 2, "FS_FIX_3D": 3,
-        "0": 0, "1": 1, "2": 2, "3": 3
-    }
-
-    valid_gateways = []
-
-    # --- 1. Extração e Validação ---
-    for data in gateway_positions_raw:
-        try:
-            # Flexibilidade: aceita string JSON ou dict direto
-            if isinstance(data, str): data = json.loads(data)
-            
-            # Acesso direto assumindo estrutura garantida do hardware
-            payload = data.get('data', {})
-            
-            # Verifica se existe posição
-            pos_list = payload.get('gatewayPosition')
-            if not pos_list: continue
-            gw_pos = pos_list[0]
-            
-            gw_gps = payload.get('gatewayGps', {})
-            
-            # Tratamento do Fix State
-            raw_fix = gw_gps.get('fixState', 0)
-            fix_state = raw_fix if isinstance(raw_fix, int) else FIX_MAP.get(str(raw_fix), 0)
-            
-            # Filtro Básico: Só aceita 2D ou 3D fix
-            if fix_state < 2: continue
-
-            # RSSI é obrigatório para o cálculo de peso
-            lora_radio = payload.get('loraRadio', {})
-            if 'RSSI' not in lora_radio: continue
-            rssi = lora_radio['RSSI']
-
-            lat = gw_pos['latitude'] / GATEWAY_COORDINATE_DIVISOR
-            lon = gw_pos['longitude'] / GATEWAY_COORDINATE_DIVISOR
-
-            valid_gateways.append({'lat': lat, 'lon': lon, 'rssi': rssi})
-
-        except (KeyError, IndexError, ValueError, TypeError):
-            # Ignora pacotes corrompidos sem quebrar o loop
-            continue
-
-    if not valid_gateways: 
-        return None, "Nenhum gateway válido (Fix 2D/3D + RSSI) encontrado."
-
-    # --- 2. Filtragem de Cluster (Centróide) ---
-    # Identifica o "Líder" (quem está mais no centro da massa de gateways)
-    ref_lat, ref_lon = valid_gateways[0]['lat'], valid_gateways[0]['lon']
-    
-    if len(valid_gateways) > 1:
-        min_total_dist = float('inf')
-        best_gw = None
-        
-        for g1 in valid_gateways:
-            # Soma a distância deste gateway para todos os outros
-            dist_sum = sum(calculate_haversine_distance(g1['lat'], g1['lon'], g2['lat'], g2['lon']) for g2 in valid_gateways)
-            if dist_sum < min_total_dist:
-                min_total_dist = dist_sum
-                best_gw = g1
-        
-        if best_gw:
-            ref_lat, ref_lon = best_gw['lat'], best_gw['lon']
-
-    # Filtra gateways que estão muito longe do "Líder" (> 1.5km - possível reflexão atmosférica)
-    filtered_gateways = [
-        g for g in valid_gateways 
-        if calculate_haversine_distance(g['lat'], g['lon'], ref_lat, ref_lon) < MAX_DISTANCE_KM
-    ]
+    mark_cache_miss()
+    track = load_track(serial)
+    simplified = simplify_track(track, TRACK_VERTEX_BUDGET)
+    html = map_html(build_track_map(simplified, build_frames(simplified)))
+    return html, len(track), len(simplified)
 
-    if not filtered_gateways: 
-        return None, "Erro de dispersão: Gateways muito distantes entre si."
+def super_position_key(points, final_res):
+    # Só lat/lon/erro entram no mapa; 'gateways_used' fica fora do hash
+    return result_hash([(p['lat'], p['lon'], p['error']) for p in points], final_res)
 
-    # --- 3. Cálculo Ponderado (RSSI em mW) ---
-    lat_w = 0.0
-    lon_w = 0.0
-    total_w = 0.0
-    max_rssi = -999
-
-    for gw in filtered_gateways:
-        # Transforma dBm (log) em mW (linear) para usar como peso real
-        # Ex: -100dBm = 1e-10 mW / -80dBm = 1e-8 mW (peso 100x maior)
-        weight = 10**(gw['rssi'] / 10.0)
-        
-        lat_w += gw['lat'] * weight
-        lon_w += gw['lon'] * weight
-        total_w += weight
-        
-        if gw['rssi'] > max_rssi: max_rssi = gw['rssi']
-
-    if total_w == 0: return None, "Erro matemático: Peso zero."
-
-    final_lat = lat_w / total_w
-    final_lon = lon_w / total_w
-    
-    # --- 4. Cálculo da Incerteza (Raio de Erro) ---
-    # RSSI mais forte = Menor erro. 
-    # Fórmula baseada na física de propagação, não na imprecisão do GPS.
-    rssi_abs = abs(max_rssi)
-    estimated_error = rssi_abs - (rssi_abs * 0.15)
-    
-    # Trava de segurança: Erro nunca menor que 3m (precisão do hardware GPS)
-    if estimated_error < 3.0: estimated_error = 3.0
-
-    return {
-        "lat": final_lat,
-        "lon": final_lon,
-        "error": estimated_error,
-        "gateways_used": filtered_gateways,
-        "max_rssi": max_rssi,
-        "total_raw_gateways": len(valid_gateways)
-    }, None
-
-def consolidate_super_position(position_series):
-    latitude_weighted = 0.0
-    longitude_weighted = 0.0
-    error_weighted = 0.0
-    total_weight = 0.0
-    
-    for pos in position_series:
-        lat = pos.get('lat')
-        lon = pos.get('lon')
-        error_radius = pos.get('error')
-        
-        if error_radius is None or error_radius <= 0 or lat is None or lon is None:
-            continue 
-
-        # O peso é o inverso do quadrado do erro (Estatística Bayesiana simples)
-        weight = 1.0 / (error_radius ** 2)
-        
-        latitude_weighted += (lat * weight)
-        longitude_weighted += (lon * weight)
-        error_weighted += (error_radius * weight)
-        total_weight += weight
-        
-    if total_weight == 0: return None
-        
-    final_lat = latitude_weighted / total_weight
-    final_lon = longitude_weighted / total_weight
-    final_error = error_weighted / total_weight
+# ==========================================
+# PERSISTÊNCIA (SQLITE COMPARTILHADO ENTRE SESSÕES)
+# ==========================================
 
-    return {
-        "final_latitude": final_lat,
-        "final_longitude": final_lon,
-        "final_error_radius_m": final_error,
-        "total_positions_used": len(position_series)
-    }
+@st.cache_resource
+def get_estimate_store():
+    return EstimateStore()
+
+@st.cache_resource
+def get_session_store():
+    # Listas de clustering de todas as sessões, com limite de tamanho e TTL (lora.sessions)
+    return SessionStore()
+
+def stored_points():
+    """Lista de clustering desta sessão (no servidor, só lat/lon/erro/timestamp/GDOP/serial)."""
+    points = get_session_store().get(job_owner())
+    ref = st.session_state.get('points_ref')
+    if ref is None or ref() is not points or 'density_grid' not in st.session_state:
+        # Lista nova: primeira execução, ou a anterior expirou (TTL) ou foi
+        # descartada pelo limite de sessões com o st.session_state ainda vivo.
+        # Os derivados guardados na sessão eram da lista antiga.
+        st.session_state['points_ref'] = weakref.ref(points)
+        st.session_state['super_position_result'] = None
+        st.session_state['decayed_sp'] = None
+        st.session_state['density_grid'] = DensityGrid()
+        for p in points.points():
+            st.session_state['density_grid'].add_result(p)
+    return points
+
+@st.cache_resource(max_entries=1)
+def get_fingerprint_map(mtime):
+    # A data de modificação entra na chave: um `build` novo é recarregado sozinho
+    return FingerprintMap.load(FINGERPRINT_MAP_PATH)
+
+def load_fingerprint_map():
+    if not os.path.exists(FINGERPRINT_MAP_PATH):
+        return None
+    return get_fingerprint_map(os.path.getmtime(FINGERPRINT_MAP_PATH))
+
+@st.cache_resource(max_entries=1)
+def get_geofences(mtime):
+    return load_geojson(GEOFENCE_PATH)
+
+def show_geofence_status(lat, lon, error):
+    """Legenda com as geocercas (GEOFENCE_PATH) em que a estimativa está, considerando o raio de erro."""
+    if not os.path.exists(GEOFENCE_PATH):
+        return
+    try:
+        index = get_geofences(os.path.getmtime(GEOFENCE_PATH))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        st.warning(f"Geocercas ({GEOFENCE_PATH}) inválidas: {e}")
+        return
+    states = index.classify(lat, lon, error)
+    inside = [index.fences[f].name for f, s in states.items() if s == INSIDE]
+    maybe = [index.fences[f].name for f, s in states.items() if s != INSIDE]
+    if not states:
+        st.caption(f"🚧 Geocercas: fora de todas as {len(index)}.")
+        return
+    parts = []
+    if inside:
+        parts.append("dentro de " + ", ".join(inside))
+    if maybe:
+        parts.append("na borda (o raio de erro cruza) de " + ", ".join(maybe))
+    st.caption("🚧 Geocercas: " + "; ".join(parts) + ".")
 
 # ==========================================
-# 2. CONFIGURAÇÃO DA PÁGINA E ESTADO
+# 1. CONFIGURAÇÃO DA PÁGINA E ESTADO
 # ==========================================
 
 st.set_page_config(page_title="Sistema de Rastreamento LoRa", layout="wide", page_icon="🛰️")
 
-if 'stored_points' not in st.session_state:
-    st.session_state['stored_points'] = [] 
 if 'last_triangulation' not in st.session_state:
     st.session_state['last_triangulation'] = None
 if 'super_position_result' not in st.session_state:
     st.session_state['super_position_result'] = None
 if 'trigger_balloons' not in st.session_state:
     st.session_state['trigger_balloons'] = False
+# Grade de densidade (alimentada incrementalmente a cada estimativa) e demais
+# derivados da lista: criados, ou refeitos se a lista do servidor é outra
+stored_points()
+# Modelo de propagação (Aba 1): reatribuído a cada execução para o valor não
+# se perder quando a Aba 1 está fechada e os campos não são desenhados
+st.session_state['path_loss_p0'] = st.session_state.get('path_loss_p0', RSSI_AT_1M_DBM)
+st.session_state['path_loss_n'] = st.session_state.get('path_loss_n', PATH_LOSS_EXPONENT)
 
-st.title("🛰️ Normalização de Sequência & Otimização de Cluster")
+# ==========================================
+# 2. CALLBACKS (RERUN PARCIAL POR FRAGMENTO)
+# ==========================================
+# Cada aba é um fragmento com key própria. As ações abaixo alteram só o estado
+# e pedem rerun apenas dos fragmentos afetados, sem reexecutar a página inteira.
+# Callback que pede rerun de fragmento não pode desenhar nada (nem st.toast):
+# o aviso fica em 'pending_toast' e o fragmento do resumo, sempre incluído no
+# rerun, mostra.
+
+def queue_toast(message, icon):
+    st.session_state['pending_toast'] = (message, icon)
+
+def add_to_decayed(points, results, before):
+    # Incremental só se o acumulador é da lista como estava antes do acréscimo
+    # (`before` = (versão, descartados)) e nada saiu pelo limite; senão é
+    # refeito no próximo uso
+    acc = st.session_state.get('decayed_sp')
+    version_before, evicted_before = before
+    if (acc is not None and st.session_state.get('decayed_sp_version') == version_before
+            and points.evicted == evicted_before):
+        for p in results:
+            acc.add(p)
+        st.session_state['decayed_sp_version'] = points.version
+
+def send_to_clustering():
+    res = st.session_state['last_triangulation']
+    points = stored_points()
+    before = (points.version, points.evicted)
+    points.append(res)
+    add_to_decayed(points, [res], before)
+    st.session_state['density_grid'].add_result(res)
+    append_estimate(res)
+    st.session_state['last_triangulation'] = None
+    queue_toast(f"Adicionado! Total acumulado: {len(points)}", '➕')
+    st.rerun(["triangulacao", "resumo"])
 
-tab1, tab2 = st.tabs(["📡 1. Triangulação", "🎯 2. Otimização de Cluster"])
+def clear_clustering():
+    stored_points().clear()
+    st.session_state['super_position_result'] = None
+    st.session_state['trigger_balloons'] = False
+    st.session_state['density_grid'] = DensityGrid()
+    st.session_state['decayed_sp'] = None
+    st.rerun(["clustering", "resumo"])
+
+def decayed_super_position(half_life_s, use_gdop=False):
+    """
+    Acumulador O(1) da super posição com decaimento. É atualizado a cada ponto
+    enviado; só é refeito a partir da lista quando a meia-vida (ou o uso do
+    GDOP) muda ou a lista mudou por outro caminho (histórico, importação,
+    limpeza, pontos antigos descartados pelo limite da sessão).
+    """
+    acc = st.session_state.get('decayed_sp')
+    points = stored_points()
+    if (acc is None or acc.half_life_s != half_life_s or acc.use_gdop != use_gdop
+            or st.session_state.get('decayed_sp_version') != points.version):
+        acc = DecayedSuperPosition(half_life_s, use_gdop)
+        for p in points.points():
+            acc.add(p)
+        st.session_state['decayed_sp'] = acc
+        st.session_state['decayed_sp_version'] = points.version
+    return acc
+
+def density_view_state():
+    """Zoom e bounds atuais do mapa de densidade (devolvidos pelo st_folium)."""
+    view = st.session_state.get('map_density') or {}
+    zoom = view.get('zoom') or 15
+    bounds = view.get('bounds')
+    if bounds and bounds.get('_southWest') and bounds.get('_northEast'):
+        sw, ne = bounds['_southWest'], bounds['_northEast']
+        return zoom, ((sw['lat'], sw['lng']), (ne['lat'], ne['lng']))
+    return zoom, None
+
+def show_density_map(center):
+    # O mapa base é fixo; só a camada de células é trocada quando o zoom/área muda
+    zoom, bounds = density_view_state()
+    grid = st.session_state['density_grid']
+    cells = grid.cells(grid_zoom_for_map(zoom), bounds)
+    st.caption(f"🟥 {len(cells)} células (nível {grid_zoom_for_map(zoom)}) agregando {grid.total} estimativas.")
+    st_folium(
+        folium.Map(location=center, zoom_start=15, prefer_canvas=True),
+        height=600, use_container_width=True, key="map_density",
+        returned_objects=["zoom", "bounds"],
+        feature_group_to_add=build_density_layer(cells),
+    )
+
+def load_history_into_clustering():
+    # Substitui a lista de clustering pelas triangulações gravadas no SQLite
+    serial = st.session_state['history_serial'].strip()
+    since = time.time() - st.session_state['history_hours'] * 3600
+    rows = get_estimate_store().history(serial, since=since, kind=KIND_TRIANGULATION)
+    points = [
+        {"lat": r['lat'], "lon": r['lon'], "error": r['error'], "serial": r['serial'],
+         "timestamp": r['ts'], "max_rssi": r['max_rssi']}
+        for r in rows
+    ]
+    stored_points().replace(points)
+    st.session_state['super_position_result'] = None
+    st.session_state['decayed_sp'] = None
+    st.session_state['density_grid'] = DensityGrid()
+    for p in points:
+        st.session_state['density_grid'].add_result(p)
+    queue_toast(f"{len(points)} estimativa(s) carregada(s) do histórico.", '📂')
+    st.rerun(["clustering", "resumo"])
+
+def show_history_loader():
+    with st.expander("📂 Recarregar do histórico (SQLite)"):
+        h1, h2 = st.columns(2)
+        h1.text_input("Serial do dispositivo:", key="history_serial")
+        h2.number_input("Últimas horas:", min_value=1, value=24, step=1, key="history_hours")
+        st.button("Carregar no Clustering", on_click=load_history_into_clustering)
+
+def import_log_job(job, uploaded, store, stationary_tol_db=None, gateway_stats=False,
+                   path_loss=(RSSI_AT_1M_DBM, PATH_LOSS_EXPONENT)):
+    """
+    Tarefa em segundo plano (sem chamadas st.*): lê o arquivo em blocos
+    (lora.reader), agrupa por (serial, sequência), triangula e grava no SQLite.
+    Devolve as estimativas enxutas (até UPLOAD_MAX_POINTS) e a grade de densidade.
+    Com `stationary_tol_db`, dispositivos parados reaproveitam a estimativa anterior;
+    com `gateway_stats`, gateways com histórico ruim são descartados ou perdem peso
+    (viés de RSSI medido com o modelo `path_loss` = (P0, n)).
+    """
+    pipeline = Pipeline(store=store, stationary_tol_db=stationary_tol_db,
+                        reliability=GatewayReliability(p0=path_loss[0], n=path_loss[1]) if gateway_stats else None)
+    points = []
+    estimates = 0
+    error = None
+
+    def collect(outputs):
+        nonlocal estimates
+        for kind, res in outputs:
+            if kind != "estimate":
+                continue
+            estimates += 1
+            if len(points) < UPLOAD_MAX_POINTS:
+                points.append(slim_result(res))
+
+    try:
+        for packets, read in iter_packet_batches(uploaded):
+            for packet in packets:
+                collect(pipeline.feed(packet))
+            job.report(read / max(1, uploaded.size),
+                       f"{read / 1024 / 1024:.1f} MB lidos, {estimates} estimativas até agora")
+        collect(pipeline.flush())
+    except ValueError as e:
+        # O que foi lido antes do erro continua valendo
+        error = str(e)
+    finally:
+        store.flush()
+
+    summary = (
+        f"{uploaded.name}: {pipeline.stats['packets']} pacotes, {estimates} estimativas "
+        f"({pipeline.stats['rejected']} grupos rejeitados, {pipeline.stats['invalid']} pacotes inválidos)."
+    )
+    if pipeline.stationary is not None:
+        summary += (f" Dispositivos parados: {pipeline.stationary.skip_rate * 100:.1f}% dos grupos sem "
+                    f"triangulação completa ({pipeline.stats['reused']} reaproveitados, "
+                    f"{pipeline.stats['updated']} só com o centróide recalculado).")
+    if pipeline.reliability is not None:
+        suspects = pipeline.reliability.suspects()
+        dropped = sum(1 for trust, _ in suspects.values() if trust == 0.0)
+        summary += (f" Gateways: {len(pipeline.reliability.gateways)} vistos, {dropped} descartados por "
+                    f"histórico ruim e {len(suspects) - dropped} com peso reduzido.")
+    if error:
+        summary += f" Leitura interrompida: {error}"
+    return {"points": points, "estimates": estimates, "grid": pipeline.grid, "summary": summary, "ok": error is None}
+
+def apply_job_result(job):
+    """Aplica no estado da sessão o resultado de uma tarefa encerrada (na thread do script)."""
+    if job.state == JOB_DONE:
+        result = job.result
+        points = stored_points()
+        room = max(0, UPLOAD_MAX_POINTS - len(points))
+        added = result['points'][:room]
+        before = (points.version, points.evicted)
+        points.extend(added)
+        add_to_decayed(points, added, before)
+        st.session_state['density_grid'].merge(result['grid'])
+        st.session_state['super_position_result'] = None
+        summary = result['summary']
+        if result['estimates'] > room:
+            summary += (f" Só {room} entraram na lista (limite de {UPLOAD_MAX_POINTS}); "
+                        "todas estão na grade e no histórico.")
+        st.session_state['log_import_summary'] = (result['ok'], summary)
+    elif job.state == JOB_CANCELLED:
+        st.session_state['log_import_summary'] = (False, f"{job.label}: cancelada.")
+    else:
+        st.session_state['log_import_summary'] = (False, f"{job.label}: falhou ({job.error}).")
+
+def show_log_importer():
+    with st.expander("📤 Importar arquivo de log (JSON / NDJSON / .gz)"):
+        uploaded = st.file_uploader("Relatórios dos gateways:", type=UPLOAD_TYPES, key="log_upload")
+        stationary = st.checkbox(f"Reaproveitar estimativas de dispositivos parados (RSSI ± {STATIONARY_TOL_DB:g} dB)",
+                                 key="log_stationary",
+                                 help="Mesmos gateways e RSSI dentro da tolerância: repete a estimativa anterior "
+                                      "em vez de triangular de novo. Desvio máximo: "
+                                      f"{reuse_error_bound_m(1.0, STATIONARY_TOL_DB) * 100:.1f}% da maior "
+                                      "distância entre os gateways usados.")
+        gateway_stats = st.checkbox("Aprender a confiabilidade dos gateways", key="log_gateway_stats",
+                                    help="Descarta gateways que costumam ficar longe da posição final e reduz o "
+                                         "peso dos que têm Fix ruim ou RSSI inflado em relação aos vizinhos.")
+        if uploaded is not None and st.button("Processar arquivo", key="log_import"):
+            try:
+                submit_job(JOB_KIND_LOG_IMPORT, f"Importação de {uploaded.name}", import_log_job,
+                           private_upload(uploaded),
+                           get_estimate_store(), STATIONARY_TOL_DB if stationary else None, gateway_stats,
+                           (st.session_state['path_loss_p0'], st.session_state['path_loss_n']))
+            except JobLimitError as e:
+                st.warning(str(e))
+            else:
+                # Rerun completo para o painel de tarefas aparecer no topo
+                st.rerun()
+        if st.session_state.get('log_import_summary'):
+            ok, summary = st.session_state['log_import_summary']
+            (st.success if ok else st.warning)(summary)
+
+@st.fragment(key="resumo")
+def show_summary():
+    if st.session_state.get('pending_toast'):
+        message, icon = st.session_state.pop('pending_toast')
+        st.toast(message, icon=icon)
+    points = stored_points()
+    st.caption(f"📌 Pontos acumulados para clustering: **{len(points)}** · 💾 {points.nbytes / 1024:.0f} kB "
+               f"no servidor (até {SESSION_MAX_POINTS} pontos; a lista expira após "
+               f"{SESSION_TTL_S / 3600:g} h sem uso)")
+
+def show_track_view():
+    serials = list_tracked_serials()
+    if not serials:
+        st.info("Nenhuma trilha gravada ainda.")
+        return
+    serial = st.selectbox("Dispositivo (serial):", serials)
+    path = track_path(serial)
+    html, total, shown = count_cache_lookup("map_track", track_map_html, serial, os.path.getsize(path))
+    st.caption(f"🧭 {total} estimativas na trilha completa; {shown} vértices exibidos (Visvalingam). "
+               "Use o slider de tempo do mapa para a reprodução.")
+    st.iframe(html, height=600)
+    with open(path, "rb") as f:
+        st.download_button("⬇️ Baixar trilha completa (CSV)", f, file_name=os.path.basename(path), mime="text/csv")
+
+def show_path_loss_inputs():
+    p1, p2 = st.columns(2)
+    p1.number_input("P0 (RSSI a 1 m, dBm):", min_value=-120.0, max_value=0.0, step=0.5, key="path_loss_p0",
+                    help="Padrão de espaço livre. Calibre com um dispositivo parado em posição conhecida: "
+                         "`python -m lora.propagation log.json --lat ... --lon ...`.")
+    p2.number_input("Expoente de perda (n):", min_value=1.5, max_value=6.0, step=0.05, key="path_loss_n",
+                    help="2 = espaço livre; tipicamente 2,7 a 4 em área urbana ou com vegetação.")
+    if (st.session_state['path_loss_p0'], st.session_state['path_loss_n']) == (RSSI_AT_1M_DBM, PATH_LOSS_EXPONENT):
+        st.caption("⚠️ Modelo de espaço livre sem calibração: com n real maior a multilateração pode errar "
+                   "mais que o centróide.")
 
 # ==========================================
 # ABA 1: TRIANGULAÇÃO
 # ==========================================
-with tab1:
+@st.fragment(key="triangulacao")
+def triangulation_tab():
     st.markdown("### 1. Cole o JSON do Pacote e Calcule")
     input_text = st.text_area("JSON Raw dos Gateways:", height=150, placeholder='[{"data": {...}}, ...]')
+    method = st.radio("Método de cálculo:", [TRI_METHOD_CENTROID, TRI_METHOD_MULTILATERATION, TRI_METHOD_FINGERPRINT],
+                      horizontal=True, key="tri_method",
+                      help="A multilateração converte RSSI em distância e pode posicionar o dispositivo "
+                           "fora do polígono dos gateways. Com menos de 3 gateways usa o centróide. "
+                           "O mapa de rádio compara o RSSI com o histórico (gerado por `python -m lora.fingerprint build`).")
+    cluster_label = st.radio("Filtro de gateways:", list(TRI_CLUSTER_OPTIONS), horizontal=True, key="tri_cluster",
+                             help="Raio fixo: descarta quem está a mais de 1.5 km do gateway mais central. "
+                                  "Densidade: agrupa os gateways com raio adaptado ao espaçamento local e fica "
+                                  "com o grupo de maior potência (não corta gateways rurais distantes).")
+    cluster_mode = TRI_CLUSTER_OPTIONS[cluster_label]
+    if method == TRI_METHOD_MULTILATERATION:
+        show_path_loss_inputs()
 
     col_btn_1, col_btn_2 = st.columns([1, 4])
     with col_btn_1:
@@ -225,13 +460,27 @@ with tab1:
                 else:
                     parsed_data = json.loads(raw_data)
 
-                result, error_msg = process_triangulation(parsed_data)
+                if method == TRI_METHOD_MULTILATERATION:
+                    result, error_msg = multilaterate(parsed_data, st.session_state['path_loss_p0'],
+                                                      st.session_state['path_loss_n'], cluster_mode=cluster_mode)
+                elif method == TRI_METHOD_FINGERPRINT:
+                    fmap = load_fingerprint_map()
+                    if fmap is None:
+                        result, error_msg = None, (f"Mapa de rádio não encontrado ({FINGERPRINT_MAP_PATH}). "
+                                                   "Gere com `python -m lora.fingerprint build arquivo.lpa`.")
+                    else:
+                        result, error_msg = fmap.locate(parsed_data)
+                else:
+                    result, error_msg = process_triangulation(parsed_data, cluster_mode)
                 
                 if error_msg:
                     st.error(error_msg)
                     st.session_state['last_triangulation'] = None
                 else:
                     st.session_state['last_triangulation'] = result
+                    store = get_estimate_store()
+                    store.add(result, KIND_TRIANGULATION)
+                    store.flush()
                     st.toast('Cálculo realizado!', icon='✅')
             except Exception as e:
                 st.error(f"Erro no JSON ou Processamento: {e}")
@@ -244,6 +493,11 @@ with tab1:
         c1.metric("Lat", f"{res['lat']:.8f}")
         c2.metric("Lon", f"{res['lon']:.8f}")
         c3.metric("Erro (Raio)", f"{res['error']:.2f} m")
+        show_geofence_status(res['lat'], res['lon'], res['error'])
+        gdop = res.get('gdop')
+        if gdop is not None:
+            st.caption(f"📐 Geometria (GDOP): {gdop:.2f}" if math.isfinite(gdop) else
+                       "📐 Geometria (GDOP): ∞ — gateway único ou alinhados com a posição.")
 
         # Feedback visual de descarte
         discarded_count = res['total_raw_gateways'] - len(res['gateways_used'])
@@ -251,48 +505,29 @@ with tab1:
             st.warning(f"⚠️ Nota: {discarded_count} gateway(s) ignorado(s) (Distância ou Fix inválido).")
         else:
             st.success("Todos os gateways válidos foram utilizados.")
+        if res.get('method') == "centroid":
+            st.info("ℹ️ Gateways insuficientes para multilateração: posição calculada pelo centróide.")
+        elif res.get('method') == "fingerprint":
+            st.caption(f"🗺️ Mapa de rádio: célula mais parecida a {res['fingerprint_distance_db']:.1f} dB de distância RSSI.")
 
         with c4:
             st.write("") 
-            if st.button("➕ Enviar para Clustering"):
-                st.session_state['stored_points'].append(res)
-                st.success(f"Adicionado! Total acumulado: {len(st.session_state['stored_points'])}")
-                st.session_state['last_triangulation'] = None
-                st.rerun()
+            st.button("➕ Enviar para Clustering", on_click=send_to_clustering)
 
-        # Mapa
-        m = folium.Map(location=[res['lat'], res['lon']], zoom_start=16)
-        
-        # Círculo de incerteza
-        folium.Circle(
-            location=[res['lat'], res['lon']], radius=float(res['error']),
-            color="red", fill=True, fill_opacity=0.2
-        ).add_to(m)
-        
-        # Gateways usados (Azul)
-        for gw in res['gateways_used']:
-            folium.Marker(
-                [gw['lat'], gw['lon']],
-                tooltip=f"Gateway (RSSI: {gw['rssi']}dBm)",
-                icon=folium.Icon(color="blue", icon="wifi", prefix='fa') 
-            ).add_to(m)
-
-        # Posição Estimada (Vermelho)
-        folium.Marker(
-            [res['lat'], res['lon']], 
-            tooltip="Posição Estimada",
-            icon=folium.Icon(color="red", icon="star")
-        ).add_to(m)
-        
-        st_folium(m, height=400, use_container_width=True, key="map_single")
+        # Mapa (vira camada GeoJSON única acima de FAST_RENDER_THRESHOLD pontos)
+        html = count_cache_lookup("map_triangulation", triangulation_map_html, result_hash(res), res)
+        st.iframe(html, height=400)
 
 # ==========================================
 # ABA 2: OTIMIZAÇÃO DE CLUSTER (FINAL)
 # ==========================================
-with tab2:
+@st.fragment(key="clustering")
+def clustering_tab():
     st.markdown("### 2. Consolidação de Múltiplas Estimativas")
+    show_history_loader()
+    show_log_importer()
     
-    points = st.session_state['stored_points']
+    points = stored_points().points()
     count = len(points)
     
     if count == 0:
@@ -300,69 +535,93 @@ with tab2:
     else:
         st.write(f"Você tem **{count}** pontos prontos para processamento.")
         
-        df = pd.DataFrame(points)[['lat', 'lon', 'error']]
         with st.expander("Ver dados brutos acumulados"):
+            df = pd.DataFrame(points)[['lat', 'lon', 'error']]
             st.dataframe(df.style.format({"lat": "{:.8f}", "lon": "{:.8f}", "error": "{:.2f}"}))
             
-            if st.button("🗑️ Limpar Lista"):
-                st.session_state['stored_points'] = []
-                st.session_state['super_position_result'] = None
-                st.session_state['trigger_balloons'] = False
-                st.rerun()
+            st.button("🗑️ Limpar Lista", on_click=clear_clustering)
 
         st.divider()
         
+        method = st.radio("Método:", [SP_METHOD_ALL, SP_METHOD_DECAY], horizontal=True, key="sp_method")
+        if method == SP_METHOD_DECAY:
+            half_life_h = st.number_input("Meia-vida (horas):", min_value=0.1, value=24.0, step=1.0,
+                                          key="sp_half_life_h",
+                                          help="Uma estimativa com esta idade pesa metade de uma recente.")
+        use_gdop = st.checkbox("Ponderar pela geometria dos gateways (GDOP)", key="sp_use_gdop",
+                               help="Estimativas com gateways alinhados ou todos de um lado pesam menos "
+                                    "(peso × 1/GDOP²). Pontos sem GDOP (histórico antigo) não mudam.")
+
         if st.button("🎯 EXECUTAR SUPER POSIÇÃO", type="primary"):
-            final_res = consolidate_super_position(points)
+            if method == SP_METHOD_DECAY:
+                final_res = decayed_super_position(half_life_h * 3600, use_gdop).result()
+            else:
+                final_res = consolidate_super_position(points, use_gdop)
             
             if final_res:
+                if final_res != st.session_state['super_position_result']:
+                    st.session_state['density_grid'].add_result(final_res)
+                    # Serial só é registrado quando todos os pontos são do mesmo dispositivo
+                    serials = {p.get('serial') for p in points}
+                    store = get_estimate_store()
+                    store.add(dict(final_res, serial=serials.pop() if len(serials) == 1 else None), KIND_SUPER_POSITION)
+                    store.flush()
                 st.session_state['super_position_result'] = final_res
                 st.session_state['trigger_balloons'] = True
             else:
                 st.error("Erro ao consolidar dados.")
 
-        if st.session_state['super_position_result']:
+        view_mode = st.radio("Visualização:", ["Pontos", "Grade de densidade", "Trilha por dispositivo"], horizontal=True)
+        if view_mode == "Trilha por dispositivo":
+            show_track_view()
+
+        elif view_mode == "Grade de densidade":
+            final_res = st.session_state['super_position_result']
+            if final_res:
+                center = [final_res['final_latitude'], final_res['final_longitude']]
+            else:
+                center = [points[-1]['lat'], points[-1]['lon']]
+            show_density_map(center)
+
+        elif st.session_state['super_position_result']:
             final_res = st.session_state['super_position_result']
             
             fc1, fc2, fc3 = st.columns(3)
             fc1.metric("Latitude Final", f"{final_res['final_latitude']:.8f}")
             fc2.metric("Longitude Final", f"{final_res['final_longitude']:.8f}")
             fc3.metric("Erro Consolidado", f"{final_res['final_error_radius_m']:.2f} m", delta_color="inverse")
+            if final_res.get('half_life_s'):
+                st.caption(f"⏳ Com decaimento exponencial: meia-vida de {final_res['half_life_s'] / 3600:g} h.")
+            show_geofence_status(final_res['final_latitude'], final_res['final_longitude'],
+                                 final_res['final_error_radius_m'])
             
-            # Ajuste de zoom
-            lats = [p['lat'] for p in points] + [final_res['final_latitude']]
-            lons = [p['lon'] for p in points] + [final_res['final_longitude']]
-            sw = [min(lats), min(lons)]
-            ne = [max(lats), max(lons)]
-
-            m_super = folium.Map(location=[final_res['final_latitude'], final_res['final_longitude']])
-            m_super.fit_bounds([sw, ne])
-
-            # Pontos individuais (Cinza)
-            for p in points:
-                folium.CircleMarker(
-                    location=[float(p['lat']), float(p['lon'])],
-                    radius=3, color="gray", fill=True, fill_opacity=0.5,
-                    tooltip=f"Amostra (Erro: {p['error']:.1f}m)"
-                ).add_to(m_super)
-
-            # Área Final (Verde)
-            folium.Circle(
-                location=[float(final_res['final_latitude']), float(final_res['final_longitude'])],
-                radius=float(final_res['final_error_radius_m']),
-                color="green", weight=3, fill=True, fill_color="green", fill_opacity=0.3,
-                tooltip="Área de Confiança Final"
-            ).add_to(m_super)
-
-            folium.Marker(
-                [float(final_res['final_latitude']), float(final_res['final_longitude'])],
-                tooltip="SUPER POSIÇÃO",
-                icon=folium.Icon(color="green", icon="flag")
-            ).add_to(m_super)
-
-            # Key dinâmica: garante que o mapa atualize o zoom/centro se a quantidade de pontos mudar
-            st_folium(m_super, height=600, use_container_width=True, key=f"map_super_{len(points)}")
-
-if st.session_state['trigger_balloons']:
-    st.balloons()
-    st.session_state['trigger_balloons'] = False
\ No newline at end of file
+            # Mapa (vira camada GeoJSON única acima de FAST_RENDER_THRESHOLD pontos)
+            # O iframe só é recarregado quando o HTML muda, ou seja, quando o hash muda
+            html_super = count_cache_lookup("map_super_position", super_position_map_html,
+                                            super_position_key(points, final_res), points, final_res)
+            if count > FAST_RENDER_THRESHOLD:
+                st.caption(f"⚡ Modo rápido: {count} pontos desenhados em uma única camada GeoJSON.")
+            st.iframe(html_super, height=600)
+
+    if st.session_state['trigger_balloons']:
+        st.balloons()
+        st.session_state['trigger_balloons'] = False
+
+# ==========================================
+# 3. LAYOUT
+# ==========================================
+
+st.title("🛰️ Normalização de Sequência & Otimização de Cluster")
+show_summary()
+show_jobs(JOB_KIND_LOG_IMPORT, apply_job_result)
+
+# Troca de aba dispara rerun; só a aba aberta é executada e desenhada
+tab1, tab2 = st.tabs(["📡 1. Triangulação", "🎯 2. Otimização de Cluster"], key="aba_ativa", on_change="rerun")
+
+with tab1:
+    if tab1.open:
+        triangulation_tab()
+
+with tab2:
+    if tab2.open:
+        clustering_tab()
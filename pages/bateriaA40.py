@@ -1,7 +1,18 @@
 import streamlit as st
 import json
-from datetime import datetime, timedelta
-import time
+import pandas as pd
+
+from lora.battery import (
+    BATTERY_CAPACITY_NOMINAL, BATTERY_CAPACITY_REAL, EFFICIENCY_FACTOR, BatteryTrend, analyze_battery_packet,
+    is_battery_packet
+)
+from lora.jobs import DONE as JOB_DONE, JobLimitError
+from lora.job_panel import private_upload, show_jobs, submit_job
+from lora.reader import iter_packet_batches
+
+FLEET_UPLOAD_TYPES = ["json", "ndjson", "jsonl", "log", "txt", "gz"]
+# Tipo das tarefas desta página no pool compartilhado (lora.job_panel)
+JOB_KIND_FLEET = "fleet"
 
 # --- Configuração da Página e CSS ---
 st.set_page_config(
@@ -32,83 +43,164 @@ hide_anchor_links = """
 """
 st.markdown(hide_anchor_links, unsafe_allow_html=True)
 
-# --- Constantes do Hardware (Modelo A40 Primário) ---
-BATTERY_CAPACITY_NOMINAL = 1850  # mAh
-EFFICIENCY_FACTOR = 0.85         # 85% (Margem para picos e autodescarga)
-BATTERY_CAPACITY_REAL = BATTERY_CAPACITY_NOMINAL * EFFICIENCY_FACTOR # 1572.5 mAh
-
 # --- Funções Auxiliares ---
 
-def format_duration(seconds: int) -> str:
-    """Formata segundos em H:M:S legível."""
-    if seconds < 0: seconds = 0
-    return str(timedelta(seconds=int(seconds))).split('.')[0]
-
 def process_packet_data(packet: dict):
     """Extrai e calcula os dados cruciais do JSON com tratamento de tipos."""
     try:
-        data = packet.get('data', {})
-        diag = data['accessories'][0]['diagnostic']
-        
-        # --- ÁREA DE CORREÇÃO (Blindagem contra Strings) ---
-        raw_ts = data.get('deviceDateTime', time.time())
-        device_ts = float(raw_ts) 
-        serial = packet.get('serial', 'Desconhecido')
-        
-        interval_total_use_mas = float(diag['battery']['intervalTotalUse'])
-        uptime_seconds = float(data['flags']['deviceInfo']['uptime'])
-        sleep_ms = float(diag['core']['intervalSleep'])
-        # --- FIM DA ÁREA DE CORREÇÃO ---
-
-        # Cálculos
-        sleep_seconds = sleep_ms / 1000.0
-        active_seconds = uptime_seconds - sleep_seconds
-
-        # 2. Cálculos da Bateria (Matemática do Coulomb Counting)
-        used_mah = interval_total_use_mas / 3600.0
-        remaining_mah = BATTERY_CAPACITY_REAL - used_mah
-        
-        remaining_mah = max(0.0, remaining_mah)
-        
-        pct_used = (used_mah / BATTERY_CAPACITY_REAL) * 100.0
-        pct_remaining = (remaining_mah / BATTERY_CAPACITY_REAL) * 100.0
-
-        # 3. Cálculo de Predição
-        uptime_hours = uptime_seconds / 3600.0
-        prediction_data = None
-
-        if uptime_hours > 0.1 and used_mah > 0:
-            hourly_rate_mah = used_mah / uptime_hours
-            hours_left = remaining_mah / hourly_rate_mah
-            device_dt = datetime.fromtimestamp(device_ts)
-            estimated_end_date = device_dt + timedelta(hours=hours_left)
-            
-            prediction_data = {
-                'hourly_rate': hourly_rate_mah,
-                'hours_left': hours_left,
-                'end_date': estimated_end_date.strftime("%d/%m/%Y às %H:%M"),
-                'days_left': hours_left / 24.0
-            }
-            
-        return {
-            'serial': serial,
-            'device_ts': datetime.fromtimestamp(device_ts).strftime("%d/%m/%Y %H:%M:%S"),
-            'uptime_str': format_duration(uptime_seconds),
-            'sleep_str': format_duration(sleep_seconds),
-            'active_str': format_duration(active_seconds),
-            'sleep_pct': (sleep_seconds / uptime_seconds) * 100 if uptime_seconds > 0 else 0,
-            'used_mah': used_mah,
-            'remaining_mah': remaining_mah,
-            'pct_used': pct_used,
-            'pct_remaining': pct_remaining,
-            'prediction': prediction_data
-        }
-
+        return analyze_battery_packet(packet)
     except (KeyError, IndexError, TypeError, ValueError) as e:
         st.error(f"Erro ao processar estrutura do JSON: {e}")
         st.caption(f"Dica de Debug: O erro ocorreu ao tentar ler o campo que causou {type(e).__name__}")
         return None
 
+def show_battery_report(results):
+    """Painel completo de um resultado de `analyze_battery_packet`."""
+    st.divider()
+    
+    # Cabeçalho
+    col_head1, col_head2, col_head3 = st.columns(3)
+    col_head1.metric("Serial do Dispositivo", results['serial'])
+    col_head2.metric("Data do Pacote (Device)", results['device_ts'])
+    col_head3.metric("Tempo Total Ligado (Uptime)", results['uptime_str'])
+    
+    st.divider()
+
+    # Seção 1: Perfil Operacional
+    st.subheader("1. Perfil Operacional")
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Tempo em Sleep (Dormindo)", results['sleep_str'], delta=f"{results['sleep_pct']:.1f}% do tempo")
+    c2.metric("Tempo Ativo (Acordado)", results['active_str'])
+    c3.info("Esse tipo de dispositivo deve passar a maior parte do tempo em Sleep para durar anos.")
+
+    # Seção 2: Análise Profunda da Bateria
+    st.subheader(f"2. Saúde da Bateria (Base: {BATTERY_CAPACITY_REAL:.1f} mAh Reais)")
+    
+    # --- BARRA DE PROGRESSO COLORIDA CUSTOMIZADA (HTML/CSS) ---
+    pct = results['pct_remaining']
+    
+    if pct > 50:
+        bar_color = "#28a745" # Verde
+    elif pct > 20:
+        bar_color = "#ffc107" # Amarelo
+    elif pct > 5:
+        bar_color = "#dc3545" # Vermelho
+    else:
+        bar_color = "#6f42c1" # Roxo
+    
+    # Renderização HTML da Barra
+    st.markdown(f"""
+        <div style="margin-bottom: 10px;">Bateria Restante Estimada: <b>{pct:.2f}%</b></div>
+        <div style="background-color: #e9ecef; border-radius: 10px; padding: 2px; margin-bottom: 20px;">
+            <div style="width: {pct}%; background-color: {bar_color}; height: 25px; border-radius: 8px; text-align: center; color: white; font-weight: bold; line-height: 25px; transition: width 0.5s;">
+                {pct:.0f}%
+            </div>
+        </div>
+    """, unsafe_allow_html=True)
+    # --- FIM DA BARRA ---
+
+    b1, b2, b3 = st.columns(3)
+    
+    b1.metric(
+        label="Já Consumido (Gasto)",
+        value=f"{results['used_mah']:.2f} mAh",
+        delta=f"-{results['pct_used']:.2f}%",
+        delta_color="inverse"
+    )
+    
+    b2.metric(
+        label="Disponível para Uso",
+        value=f"{results['remaining_mah']:.2f} mAh",
+        help="Capacidade Real - Consumido"
+    )
+    
+    # Seção 3: Predição de Término
+    st.subheader("3. Predição de Esgotamento")
+    
+    pred = results['prediction']
+    if pred:
+        p1, p2 = st.columns([2, 1])
+        
+        with p1:
+            st.error(f"### Data Estimada do Fim: {pred['end_date']}")
+            st.caption(f"Faltam aproximadamente **{pred['days_left']:.1f} dias** ({int(pred['hours_left'])} horas).")
+        
+        with p2:
+            st.metric(
+                "Ritmo de Consumo Atual", 
+                f"{pred['hourly_rate']:.4f} mAh/h",
+                help="Média de consumo por hora baseada no uptime atual."
+            )
+    else:
+        st.warning("Não há dados suficientes de tempo/consumo para gerar uma predição confiável ainda.")
+
+def analyze_fleet_job(job, uploaded):
+    """
+    Tarefa em segundo plano (sem chamadas st.*): lê o arquivo em blocos e
+    mantém só o estado por dispositivo (BatteryTrend, O(1) por serial), então
+    a memória não cresce com o tamanho do arquivo.
+    """
+    fleet = {}
+    counts = {"packets": 0, "skipped": 0, "errors": 0}
+    error = None
+    try:
+        for packets, read in iter_packet_batches(uploaded):
+            for packet in packets:
+                counts["packets"] += 1
+                if not isinstance(packet, dict) or not is_battery_packet(packet):
+                    counts["skipped"] += 1
+                    continue
+                try:
+                    result = analyze_battery_packet(packet)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    counts["errors"] += 1
+                    continue
+                trend = fleet.get(result['serial'])
+                if trend is None:
+                    trend = fleet[result['serial']] = BatteryTrend()
+                trend.add(result)
+            # Resultado parcial a cada bloco
+            job.report(read / max(1, uploaded.size),
+                       f"{read / 1024 / 1024:.1f} MB lidos, {len(fleet)} dispositivos",
+                       partial=fleet_table(fleet) if fleet else None)
+    except ValueError as e:
+        error = str(e)
+
+    summary = (f"{uploaded.name}: {counts['packets']} pacotes, {len(fleet)} dispositivos "
+               f"({counts['skipped']} sem dados de bateria, {counts['errors']} com erro de estrutura).")
+    if error:
+        summary += f" Leitura interrompida antes do fim do arquivo: {error}"
+    return {"fleet": fleet, "summary": summary}
+
+def apply_fleet_job(job):
+    """Aplica no estado da sessão o resultado de uma análise encerrada."""
+    if job.state == JOB_DONE:
+        st.session_state['fleet'] = job.result['fleet']
+        st.session_state['fleet_summary'] = job.result['summary']
+    else:
+        st.session_state['fleet_summary'] = f"{job.label}: {job.error or 'cancelada'}."
+
+def show_partial_fleet(partial):
+    st.dataframe(partial, hide_index=True, width="stretch")
+
+def fleet_table(fleet):
+    """Uma linha por dispositivo, os com menos bateria primeiro."""
+    rows = []
+    for serial, trend in fleet.items():
+        last = trend.last
+        rate = trend.hourly_rate()
+        hours_left = trend.hours_left()
+        rows.append({
+            "Serial": serial,
+            "Pacotes": trend.n,
+            "Bateria (%)": round(last['pct_remaining'], 2),
+            "Consumido (mAh)": round(last['used_mah'], 2),
+            "Consumo (mAh/h)": round(rate, 4) if rate else None,
+            "Dias restantes": round(hours_left / 24, 1) if hours_left else None,
+            "Último pacote": last['device_ts'],
+        })
+    return pd.DataFrame(rows).sort_values("Bateria (%)")
+
 # --- Interface do Streamlit ---
 
 st.title("🔋 Diagnóstico Avançado de Bateria - A40B v3")
@@ -135,86 +227,32 @@ if submitted and json_input:
         results = process_packet_data(packet_raw)
 
         if results:
-            st.divider()
-            
-            # Cabeçalho
-            col_head1, col_head2, col_head3 = st.columns(3)
-            col_head1.metric("Serial do Dispositivo", results['serial'])
-            col_head2.metric("Data do Pacote (Device)", results['device_ts'])
-            col_head3.metric("Tempo Total Ligado (Uptime)", results['uptime_str'])
-            
-            st.divider()
-
-            # Seção 1: Perfil Operacional
-            st.subheader("1. Perfil Operacional")
-            c1, c2, c3 = st.columns(3)
-            c1.metric("Tempo em Sleep (Dormindo)", results['sleep_str'], delta=f"{results['sleep_pct']:.1f}% do tempo")
-            c2.metric("Tempo Ativo (Acordado)", results['active_str'])
-            c3.info("Esse tipo de dispositivo deve passar a maior parte do tempo em Sleep para durar anos.")
-
-            # Seção 2: Análise Profunda da Bateria
-            st.subheader(f"2. Saúde da Bateria (Base: {BATTERY_CAPACITY_REAL:.1f} mAh Reais)")
-            
-            # --- BARRA DE PROGRESSO COLORIDA CUSTOMIZADA (HTML/CSS) ---
-            pct = results['pct_remaining']
-            
-            if pct > 50:
-                bar_color = "#28a745" # Verde
-            elif pct > 20:
-                bar_color = "#ffc107" # Amarelo
-            elif pct > 5:
-                bar_color = "#dc3545" # Vermelho
-            else:
-                bar_color = "#6f42c1" # Roxo
-            
-            # Renderização HTML da Barra
-            st.markdown(f"""
-                <div style="margin-bottom: 10px;">Bateria Restante Estimada: <b>{pct:.2f}%</b></div>
-                <div style="background-color: #e9ecef; border-radius: 10px; padding: 2px; margin-bottom: 20px;">
-                    <div style="width: {pct}%; background-color: {bar_color}; height: 25px; border-radius: 8px; text-align: center; color: white; font-weight: bold; line-height: 25px; transition: width 0.5s;">
-                        {pct:.0f}%
-                    </div>
-                </div>
-            """, unsafe_allow_html=True)
-            # --- FIM DA BARRA ---
-
-            b1, b2, b3 = st.columns(3)
-            
-            b1.metric(
-                label="Já Consumido (Gasto)",
-                value=f"{results['used_mah']:.2f} mAh",
-                delta=f"-{results['pct_used']:.2f}%",
-                delta_color="inverse"
-            )
-            
-            b2.metric(
-                label="Disponível para Uso",
-                value=f"{results['remaining_mah']:.2f} mAh",
-                help="Capacidade Real - Consumido"
-            )
-            
-            # Seção 3: Predição de Término
-            st.subheader("3. Predição de Esgotamento")
-            
-            pred = results['prediction']
-            if pred:
-                p1, p2 = st.columns([2, 1])
-                
-                with p1:
-                    st.error(f"### Data Estimada do Fim: {pred['end_date']}")
-                    st.caption(f"Faltam aproximadamente **{pred['days_left']:.1f} dias** ({int(pred['hours_left'])} horas).")
-                
-                with p2:
-                    st.metric(
-                        "Ritmo de Consumo Atual", 
-                        f"{pred['hourly_rate']:.4f} mAh/h",
-                        help="Média de consumo por hora baseada no uptime atual."
-                    )
-            else:
-                st.warning("Não há dados suficientes de tempo/consumo para gerar uma predição confiável ainda.")
+            show_battery_report(results)
 
     except json.JSONDecodeError:
         st.error("Erro: O texto colado não é um JSON válido. Verifique a formatação.")
 
 elif not json_input and submitted:
-    st.warning("Por favor, cole o JSON antes de clicar em verificar.")
\ No newline at end of file
+    st.warning("Por favor, cole o JSON antes de clicar em verificar.")
+
+# 4. Arquivo de Log da Frota (Upload em Blocos)
+st.divider()
+st.subheader("📤 Análise da Frota por Arquivo de Log")
+st.caption("JSON, NDJSON ou .gz com vários pacotes. O arquivo é lido em blocos, sem carregar tudo na memória.")
+
+uploaded = st.file_uploader("Arquivo de log:", type=FLEET_UPLOAD_TYPES, key="fleet_upload")
+if uploaded is not None and st.button("📊 Analisar Arquivo", key="fleet_analyze"):
+    try:
+        submit_job(JOB_KIND_FLEET, f"Análise de {uploaded.name}", analyze_fleet_job, private_upload(uploaded))
+    except JobLimitError as e:
+        st.warning(str(e))
+
+show_jobs(JOB_KIND_FLEET, apply_fleet_job, show_partial_fleet)
+
+if st.session_state.get('fleet_summary'):
+    st.caption(st.session_state['fleet_summary'])
+fleet = st.session_state.get('fleet')
+if fleet:
+    st.dataframe(fleet_table(fleet), hide_index=True, width="stretch")
+    serial = st.selectbox("Detalhar dispositivo:", sorted(fleet), key="fleet_serial")
+    show_battery_report(fleet[serial].last)